@@ -1,72 +1,149 @@
+import json
 import pandas as pd
 import xgboost as xgb  # Import the XGBoost library
 import matplotlib.pyplot as plt
 import numpy as np
+from daily_panel import load_panel  # Columnar cache, day-level columns stored once per day
+from features import load_feature_matrix  # Sparse one-hot feature builder (cached)
+from importance import grouped_importance, plot_grouped_importance  # Importance of the original variables
+from tuning import search  # Budgeted hyperparameter search
+from streaming import XGB_PARAMS, train_xgboost_streaming  # Out-of-core training
+from profiling import section, note  # Stage timings, on with PM25_PROFILE=1 (see profiling.py)
 
-# --- 1. Load Data ---
-# Replace 'your_data.dta' with the actual path to your Stata file
-file_path = 'data0327.dta' 
-try:
-    df = pd.read_stata(file_path)
-    print("Stata .dta file loaded successfully.")
-
-
-
-# --- 2. Define Variables and One-Hot Encode ---
-# This part is identical to the previous script
-target_variable = 'logCash'
-Y = df[target_variable]
-numerical_features = ['logPM', 'logPre', 'rh', 'awin', 'ctemp']
-categorical_features = ['vacation', 'month', 'weekday', 'card']
-X_numerical = df[numerical_features]
-X_categorical_encoded = pd.get_dummies(df[categorical_features], columns=categorical_features, drop_first=True, dtype=int)
-X_final = pd.concat([X_numerical, X_categorical_encoded], axis=1)
-print(f"Shape of the final feature matrix X (rows, columns): {X_final.shape}")
-
-
-# --- 3. Initialize and Train the XGBoost Model ---
-print("\nTraining XGBoost model...")
-
-# Initialize the XGBoost Regressor model
-# objective='reg:squarederror' is the standard setting for regression tasks.
-# n_estimators, learning_rate, max_depth are key hyperparameters that can be tuned.
-xgb_model = xgb.XGBRegressor(
-    objective='reg:squarederror',
-    n_estimators=100,       # Number of trees
-    learning_rate=0.1,      # Learning rate (eta)
-    max_depth=5,            # Maximum depth of each tree
-    random_state=42,
-    n_jobs=-1               # Use all available CPU cores
-)
-
-# Train the model
-xgb_model.fit(X_final, Y)
-
-print("XGBoost model training complete.")
-
-
-# --- 4. Extract and Visualize Feature Importance ---
-# XGBoost offers several ways to measure importance, 'weight' and 'gain' are most common.
-# 'weight': The total number of times a feature is used to split the data across all trees.
-# 'gain': The average gain (contribution to reducing loss) of splits which use the feature. 'gain' is often more informative.
-
-# Method 1: Visualize by 'gain'
-fig, ax = plt.subplots(figsize=(12, 10))
-xgb.plot_importance(xgb_model, max_num_features=20, ax=ax, importance_type='gain', title='Top 20 Features by Gain (XGBoost)')
-plt.tight_layout()
-plt.savefig('feature_importance_xgb_gain.png')
-print("\nXGBoost feature importance plot (by gain) saved as 'feature_importance_xgb_gain.png'")
-
-# Method 2: Visualize by 'weight' (frequency)
-fig, ax = plt.subplots(figsize=(12, 10))
-xgb.plot_importance(xgb_model, max_num_features=20, ax=ax, importance_type='weight', title='Top 20 Features by Weight (XGBoost)')
-plt.tight_layout()
-plt.savefig('feature_importance_xgb_weight.png')
-print("XGBoost feature importance plot (by weight) saved as 'feature_importance_xgb_weight.png'")
-
-
-# You can also manually extract the importance data for analysis
-importance_gain_data = xgb_model.get_booster().get_score(importance_type='gain')
-importance_gain_df = pd.DataFrame(importance_gain_data.items(), columns=['feature', 'gain']).sort_values('gain', ascending=False)
-print("\nTop 20 most important features and their gain scores (XGBoost):")
-print(importance_gain_df.head(20))
\ No newline at end of file
+# --- 0. Configuration ---
+# STREAMING = True trains out of core (see streaming.py): the data is read from the
+# columnar cache in chunks of CHUNK_SIZE rows and X_final is never built in memory.
+# Peak memory then depends on CHUNK_SIZE instead of the number of transactions.
+STREAMING = False
+CHUNK_SIZE = 100_000
+# SEARCH_BUDGET = <seconds> first tunes the hyperparameters below on the most recent
+# days held out (tuning.py, successive halving) and trains with the best configuration.
+# The search writes 'tuning_xgb_best.json' and a per-trial log 'tuning_xgb_trials.csv'.
+SEARCH_BUDGET = None
+
+# Worker processes (grouped_importance, search) re-import this script on Windows,
+# where they are started with spawn: only the main process runs the steps below.
+if __name__ == '__main__':
+    # --- 1. Load Data ---
+    # Replace 'data0327.dta' with the actual path to your Stata file
+    # The file is read through the columnar cache in data_cache.py: the first run
+    # converts the .dta once, later runs only read the columns listed here.
+    # The weather and calendar columns are kept once per day (daily_panel.py) and
+    # broadcast to the transactions only when used; here only Y is taken from df.
+    file_path = 'data0327.dta'
+    section('load')
+    if not STREAMING:
+        df = load_panel(file_path, columns=['logCash', 'logPM', 'logPre', 'rh', 'awin', 'ctemp', 'vacation', 'month', 'weekday', 'card'])
+        note(rows=len(df))
+        print("Stata .dta file loaded successfully.")
+
+
+
+    # --- 2. Define Variables and One-Hot Encode ---
+    # This part is identical to the previous script
+    target_variable = 'logCash'
+    numerical_features = ['logPM', 'logPre', 'rh', 'awin', 'ctemp']
+    categorical_features = ['vacation', 'month', 'weekday', 'card']
+    section('encode')
+    if not STREAMING:
+        Y = df[target_variable]
+        # build_feature_matrix returns a sparse CSR matrix: the one-hot 'card' block holds
+        # one non-zero per row instead of one dense int column per student.
+        # feature_names follows the pd.get_dummies(drop_first=True) naming (e.g. 'card_1001').
+        # The matrix is cached next to the data (features.load_feature_matrix), later runs read it back.
+        X_final, feature_names = load_feature_matrix(file_path, numerical_features, categorical_features)
+        note(rows=X_final.shape[0])
+        print(f"Shape of the final feature matrix X (rows, columns): {X_final.shape}")
+
+
+    # --- 3. Initialize and Train the XGBoost Model ---
+    section('fit')
+    print("\nTraining XGBoost model...")
+
+    if STREAMING:
+        # Same hyperparameters as below, fed chunk by chunk into a QuantileDMatrix.
+        # The chunks have the one-hot columns of X_final (features.FeatureEncoder), so
+        # the saved booster can be used in place of the in-memory one.
+        booster = train_xgboost_streaming(file_path, chunk_size=CHUNK_SIZE)
+        booster.set_attr(params=json.dumps(XGB_PARAMS))
+    else:
+        # Initialize the XGBoost Regressor model
+        # objective='reg:squarederror' is the standard setting for regression tasks.
+        # n_estimators, learning_rate, max_depth are key hyperparameters that can be tuned.
+        xgb_model = xgb.XGBRegressor(
+            objective='reg:squarederror',
+            n_estimators=100,       # Number of trees
+            learning_rate=0.1,      # Learning rate (eta)
+            max_depth=5,            # Maximum depth of each tree
+            random_state=42,
+            n_jobs=-1               # Use all available CPU cores
+        )
+
+        if SEARCH_BUDGET:
+            section('search')
+            best = search(file_path, model='xgb', budget=SEARCH_BUDGET)
+            xgb_model.set_params(n_estimators=best['n_rounds'], **best['params'])
+            print(f"Tuned hyperparameters: {best['params']}, {best['n_rounds']} rounds")
+            section('fit')
+
+        # Train the model
+        note(rows=X_final.shape[0], model=xgb_model)
+        xgb_model.fit(X_final, Y)
+        booster = xgb_model.get_booster()
+        # A sparse matrix carries no column names, attach them to the trained booster
+        booster.feature_names = feature_names
+        booster.set_attr(params=json.dumps({k: v for k, v in xgb_model.get_xgb_params().items() if v is not None}))
+
+    # Saved with its hyperparameters: daily_update.py continues boosting from it on
+    # new days and scenarios.py predicts with it
+    booster.save_model('xgb_model.json')
+
+    note(model=booster)
+    print("XGBoost model training complete.")
+
+
+    # --- 4. Extract and Visualize Feature Importance ---
+    # XGBoost offers several ways to measure importance, 'weight' and 'gain' are most common.
+    # 'weight': The total number of times a feature is used to split the data across all trees.
+    # 'gain': The average gain (contribution to reducing loss) of splits which use the feature. 'gain' is often more informative.
+    section('importance')
+
+    # Method 1: Visualize by 'gain'
+    fig, ax = plt.subplots(figsize=(12, 10))
+    xgb.plot_importance(booster, max_num_features=20, ax=ax, importance_type='gain', title='Top 20 Features by Gain (XGBoost)')
+    plt.tight_layout()
+    plt.savefig('feature_importance_xgb_gain.png')
+    print("\nXGBoost feature importance plot (by gain) saved as 'feature_importance_xgb_gain.png'")
+
+    # Method 2: Visualize by 'weight' (frequency)
+    fig, ax = plt.subplots(figsize=(12, 10))
+    xgb.plot_importance(booster, max_num_features=20, ax=ax, importance_type='weight', title='Top 20 Features by Weight (XGBoost)')
+    plt.tight_layout()
+    plt.savefig('feature_importance_xgb_weight.png')
+    print("XGBoost feature importance plot (by weight) saved as 'feature_importance_xgb_weight.png'")
+
+
+    # You can also manually extract the importance data for analysis
+    importance_gain_data = booster.get_score(importance_type='gain')
+    importance_gain_df = pd.DataFrame(importance_gain_data.items(), columns=['feature', 'gain']).sort_values('gain', ascending=False)
+    print("\nTop 20 most important features and their gain scores (XGBoost):")
+    print(importance_gain_df.head(20))
+
+
+    # --- 5. Importance of the Original Variables ---
+    # The scores above are per one-hot column. importance.py groups the columns back into
+    # the nine original variables (every 'card_*' dummy counts as 'card') and computes
+    # permutation importance and TreeSHAP on samples of the training data, in parallel.
+    # (Not computed with STREAMING, which never builds X_final in memory.)
+    section('grouped_importance')
+    if not STREAMING:
+        grouped = grouped_importance(xgb_model, X_final, Y, feature_names, numerical_features, categorical_features)
+        print("\nImportance of the original variables (XGBoost):")
+        print(grouped)
+        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 6))
+        plot_grouped_importance(grouped['permutation'], ax=ax1, xerr=grouped['permutation_std'],
+                                title='Permutation Importance (XGBoost)', xlabel='Increase in MSE')
+        plot_grouped_importance(grouped['shap'], ax=ax2, title='TreeSHAP Importance (XGBoost)', xlabel='Mean |SHAP value|')
+        plt.tight_layout()
+        plt.savefig('feature_importance_xgb_grouped.png')
+        print("Grouped feature importance plot saved as 'feature_importance_xgb_grouped.png'")
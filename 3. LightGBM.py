@@ -2,56 +2,134 @@ import pandas as pd
 import lightgbm as lgb  # Import the LightGBM library
 import matplotlib.pyplot as plt
 import numpy as np
+from daily_panel import load_panel  # Columnar cache, day-level columns stored once per day
+from features import load_feature_matrix  # Sparse one-hot feature builder (cached)
+from importance import grouped_importance, plot_grouped_importance  # Importance of the original variables
+from tuning import search  # Budgeted hyperparameter search
+from streaming import train_lightgbm_streaming  # Out-of-core training
+from profiling import section, note  # Stage timings, on with PM25_PROFILE=1 (see profiling.py)
 
-# --- 1. Load Data ---
-# Replace 'your_data.dta' with the actual path to your Stata file
-file_path = 'data0327.dta' 
-try:
-    df = pd.read_stata(file_path)
-    print("Stata .dta file loaded successfully.")
-
-
-# --- 2. Define Variables and One-Hot Encode ---
-# This part is identical to the previous scripts
-target_variable = 'logCash'
-Y = df[target_variable]
-numerical_features = ['logPM', 'logPre', 'rh', 'awin', 'ctemp']
-categorical_features = ['vacation', 'month', 'weekday', 'card']
-X_numerical = df[numerical_features]
-X_categorical_encoded = pd.get_dummies(df[categorical_features], columns=categorical_features, drop_first=True, dtype=int)
-X_final = pd.concat([X_numerical, X_categorical_encoded], axis=1)
-print(f"Shape of the final feature matrix X (rows, columns): {X_final.shape}")
-
-
-# --- 3. Initialize and Train the LightGBM Model ---
-print("\nTraining LightGBM model...")
-
-# Initialize the LightGBM Regressor model
-# Default parameters are often very fast and effective.
-lgbm_model = lgb.LGBMRegressor(random_state=42, n_jobs=-1)
-
-# Train the model on the full dataset
-lgbm_model.fit(X_final, Y)
-
-print("LightGBM model training complete.")
-
-# --- 4. Extract and Visualize Feature Importance ---
-# LightGBM has a convenient built-in plotting function.
-# max_num_features=20 displays only the top 20 most important features.
-# importance_type='gain' measures importance by the total gains of splits which use the feature.
-fig, ax = plt.subplots(figsize=(12, 10))
-lgb.plot_importance(lgbm_model, max_num_features=20, ax=ax, importance_type='gain')
-plt.title('Top 20 Important Features (LightGBM)')
-plt.tight_layout()
-# Save the figure
-plt.savefig('feature_importance_lgbm.png')
-print("\nLightGBM feature importance plot saved as 'feature_importance_lgbm.png'")
-
-# You can also manually extract the importance data
-feature_importance_df_lgbm = pd.DataFrame({
-    'feature': X_final.columns,
-    'importance': lgbm_model.feature_importances_
-}).sort_values('importance', ascending=False)
-
-print("\nTop 20 most important features and their scores (LightGBM):")
-print(feature_importance_df_lgbm.head(20))
\ No newline at end of file
+# --- 0. Configuration ---
+# STREAMING = True trains out of core (see streaming.py): the data is read from the
+# columnar cache in chunks of CHUNK_SIZE rows (at most one chunk decoded at a time)
+# and X_final is never built in memory.
+# Peak memory then depends on CHUNK_SIZE instead of the number of transactions.
+# In this mode 'card', 'month', 'weekday' and 'vacation' are LightGBM categorical
+# features, so importances are reported per variable instead of per dummy.
+STREAMING = False
+CHUNK_SIZE = 100_000
+# SEARCH_BUDGET = <seconds> first tunes the hyperparameters below on the most recent
+# days held out (tuning.py, successive halving) and trains with the best configuration.
+# The search writes 'tuning_lgbm_best.json' and a per-trial log 'tuning_lgbm_trials.csv'.
+SEARCH_BUDGET = None
+
+# Worker processes (grouped_importance, search) re-import this script on Windows,
+# where they are started with spawn: only the main process runs the steps below.
+if __name__ == '__main__':
+    # --- 1. Load Data ---
+    # Replace 'data0327.dta' with the actual path to your Stata file
+    # The file is read through the columnar cache in data_cache.py: the first run
+    # converts the .dta once, later runs only read the columns listed here.
+    # The weather and calendar columns are kept once per day (daily_panel.py) and
+    # broadcast to the transactions only when used; here only Y is taken from df.
+    file_path = 'data0327.dta'
+    section('load')
+    if not STREAMING:
+        df = load_panel(file_path, columns=['logCash', 'logPM', 'logPre', 'rh', 'awin', 'ctemp', 'vacation', 'month', 'weekday', 'card'])
+        note(rows=len(df))
+        print("Stata .dta file loaded successfully.")
+
+
+    # --- 2. Define Variables and One-Hot Encode ---
+    # This part is identical to the previous scripts
+    target_variable = 'logCash'
+    numerical_features = ['logPM', 'logPre', 'rh', 'awin', 'ctemp']
+    categorical_features = ['vacation', 'month', 'weekday', 'card']
+    section('encode')
+    if not STREAMING:
+        Y = df[target_variable]
+        # build_feature_matrix returns a sparse CSR matrix: the one-hot 'card' block holds
+        # one non-zero per row instead of one dense int column per student.
+        # feature_names follows the pd.get_dummies(drop_first=True) naming (e.g. 'card_1001').
+        # The matrix is cached next to the data (features.load_feature_matrix), later runs read it back.
+        X_final, feature_names = load_feature_matrix(file_path, numerical_features, categorical_features)
+        note(rows=X_final.shape[0])
+        print(f"Shape of the final feature matrix X (rows, columns): {X_final.shape}")
+
+
+    # --- 3. Initialize and Train the LightGBM Model ---
+    section('fit')
+    print("\nTraining LightGBM model...")
+
+    if STREAMING:
+        # The Dataset is built row group by row group from the cache. Its factors are
+        # native categorical columns, not the one-hot columns of X_final, so the model
+        # is not interchangeable with the one below: it cannot be fed the one-hot
+        # matrix of scenarios.TreeModel or daily_update.py and is not saved as
+        # 'lgbm_model.txt'.
+        booster = train_lightgbm_streaming(file_path, chunk_size=CHUNK_SIZE)
+        feature_names = booster.feature_name()
+        feature_importances = booster.feature_importance()
+    else:
+        # Initialize the LightGBM Regressor model
+        # Default parameters are often very fast and effective.
+        lgbm_model = lgb.LGBMRegressor(random_state=42, n_jobs=-1)
+
+        if SEARCH_BUDGET:
+            section('search')
+            best = search(file_path, model='lgbm', budget=SEARCH_BUDGET)
+            lgbm_model.set_params(n_estimators=best['n_rounds'], **best['params'])
+            print(f"Tuned hyperparameters: {best['params']}, {best['n_rounds']} rounds")
+            section('fit')
+
+        # Train the model on the full dataset
+        note(rows=X_final.shape[0], model=lgbm_model)
+        lgbm_model.fit(X_final, Y, feature_name=feature_names)
+        booster = lgbm_model.booster_
+        feature_importances = lgbm_model.feature_importances_
+        # daily_update.py continues boosting from the saved model on new days
+        booster.save_model('lgbm_model.txt')
+
+    note(model=booster)
+    print("LightGBM model training complete.")
+
+    # --- 4. Extract and Visualize Feature Importance ---
+    # LightGBM has a convenient built-in plotting function.
+    # max_num_features=20 displays only the top 20 most important features.
+    # importance_type='gain' measures importance by the total gains of splits which use the feature.
+    section('importance')
+    fig, ax = plt.subplots(figsize=(12, 10))
+    lgb.plot_importance(booster, max_num_features=20, ax=ax, importance_type='gain')
+    plt.title('Top 20 Important Features (LightGBM)')
+    plt.tight_layout()
+    # Save the figure
+    plt.savefig('feature_importance_lgbm.png')
+    print("\nLightGBM feature importance plot saved as 'feature_importance_lgbm.png'")
+
+    # You can also manually extract the importance data
+    feature_importance_df_lgbm = pd.DataFrame({
+        'feature': feature_names,
+        'importance': feature_importances
+    }).sort_values('importance', ascending=False)
+
+    print("\nTop 20 most important features and their scores (LightGBM):")
+    print(feature_importance_df_lgbm.head(20))
+
+
+    # --- 5. Importance of the Original Variables ---
+    # The scores above are per one-hot column. importance.py groups the columns back into
+    # the nine original variables (every 'card_*' dummy counts as 'card') and computes
+    # permutation importance and TreeSHAP on samples of the training data, in parallel.
+    # (The streaming models use native categorical columns and are not covered.)
+    section('grouped_importance')
+    if not STREAMING:
+        grouped = grouped_importance(lgbm_model, X_final, Y, feature_names, numerical_features, categorical_features)
+        print("\nImportance of the original variables (LightGBM):")
+        print(grouped)
+        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 6))
+        plot_grouped_importance(grouped['permutation'], ax=ax1, xerr=grouped['permutation_std'],
+                                title='Permutation Importance (LightGBM)', xlabel='Increase in MSE')
+        plot_grouped_importance(grouped['shap'], ax=ax2, title='TreeSHAP Importance (LightGBM)', xlabel='Mean |SHAP value|')
+        plt.tight_layout()
+        plt.savefig('feature_importance_lgbm_grouped.png')
+        print("Grouped feature importance plot saved as 'feature_importance_lgbm_grouped.png'")
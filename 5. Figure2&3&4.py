@@ -13,6 +13,10 @@ import seaborn as sns
 import matplotlib.gridspec as gridspec
 import ptitprince as pt
 from scipy import interpolate
+from data_cache import load_data
+from daily_cube import load_cube
+from raincloud import RaincloudSummary, raincloud
+from profiling import section, note  # Stage timings, on with PM25_PROFILE=1 (see profiling.py)
 
 # --- SCRIPT CONFIGURATION ---
 
@@ -22,9 +26,15 @@ plt.rcParams['font.sans-serif'] = ['Microsoft YaHei']
 plt.rcParams['axes.unicode_minus'] = False # Allows the display of the minus sign
 
 # Set the working directory for the project
-os.chdir("E://") 
-Data_Base0 = pd.read_stata("./data0327.dta")
+os.chdir(os.environ.get("PM25_WORKDIR", "E://")) 
+# Only the columns used by the figures are read from the columnar cache
+section('load')
+Data_Base0 = load_data("./data0327.dta", columns=['cash', 'Meal', 'Gender', 'Type'])
+note(rows=len(Data_Base0))
 pd.set_option('display.max_rows', 10)
+# Draw the raincloud panels of Fig 2 from per-group histograms (raincloud.py)
+# instead of from every transaction; set to False for the raw-row plots
+AGGREGATE_RAINCLOUDS = True
 # Filter out extreme outliers for better visualization
 Data_Base = Data_Base0[Data_Base0.cash < 5000]
 
@@ -35,12 +45,33 @@ gs1 = gridspec.GridSpec(nrows=2, ncols=3, left=0.05, right=0.48)
 # Define properties for the median line in boxplots
 medianprops = dict(linestyle='-', linewidth=2, color='red')
 
+
+def raincloud_panel(ax, x, y, pal):
+    """Half violin, strip and box plot of `y` by `x` (set the y limits first)."""
+    if AGGREGATE_RAINCLOUDS:
+        return raincloud(RaincloudSummary.from_values(x, y), ax=ax, palette=pal, bw=.2, cut=0., width=.6,
+                         jitter=1, size=0.25, box_width=.1, notch=True, medianprops=medianprops,
+                         whiskerprops={'linewidth':2, "zorder":10})
+    ax = pt.half_violinplot(x=x, y=y, palette=pal, bw=.2, cut=0., ax=ax,
+                            scale="count", width=.6, inner=None, orient="v")
+    ax = sns.stripplot(x=x, y=y, palette=pal, edgecolor="white", ax=ax,
+                       size=0.25, jitter=1, zorder=0, orient="v")
+    ax = sns.boxplot(x=x, y=y, color="black", width=.1, zorder=10, ax=ax,
+                     showcaps=True, boxprops={'facecolor':'none', "zorder":10},
+                     showfliers=False, whiskerprops={'linewidth':2, "zorder":10},
+                     saturation=1, notch=True, medianprops=medianprops, orient="v")
+    return ax
+
+
 # Fig 2(a): Time-series of expenditure and PM2.5 concentration
-# Create a pivot table to get daily mean/max of cash and PM2.5
-Fig2_Data = pd.pivot_table(Data_Base, index='Date', values=['cash', 'APM25'], aggfunc=[np.mean, np.max])
-Date = range(len(Fig1_Data))
+section('fig2.a')
+# Daily mean/max of cash and PM2.5 from the cached aggregate cube (daily_cube.py),
+# same layout as pd.pivot_table(Data_Base, index='Date', aggfunc=[np.mean, np.max])
+Fig2_Data = load_cube("./data0327.dta").query(by='Date', values=['cash', 'APM25'], stats=['mean', 'max'],
+                                              where={'outlier': 0})
+Date = range(len(Fig2_Data))
 Cash = Fig2_Data['mean', 'cash'] / 100 * 3 # Adjusting scale for visualization
-AQI = Fig2_Data['amax', 'APM25']
+AQI = Fig2_Data['max', 'APM25']
 
 ax1 = fig.add_subplot(gs1[0, :])
 ax1y = ax1.twinx() # Create a second y-axis
@@ -63,7 +94,7 @@ lines2, labels2 = ax1y.get_legend_handles_labels()
 ax1y.legend(lines + lines2, labels + labels2, fontsize=14)
 
 # Format x-axis ticks to show dates
-LableAx1 = Fig1_Data.index.tolist()
+LableAx1 = Fig2_Data.index.tolist()
 date = []
 tick = np.arange(0, 250, 25)
 ticks = np.append(tick, 244)
@@ -75,19 +106,11 @@ ax1.set_xticklabels(ticks_label, rotation=45)
 
 
 # Fig 2(b): Expenditure by meal type (Raincloud Plot)
+section('fig2.b', rows=len(Data_Base))
 ax2 = fig.add_subplot(gs1[-1, 0])
 pal = sns.color_palette(n_colors=3)
-ax2 = pt.half_violinplot(x=Data_Base.Meal, y=Data_Base.cash / 100, data=Data_Base, 
-                         palette=pal, bw=.2, cut=0.,
-                         scale="count", width=.6, inner=None, orient="v")
-ax2 = sns.stripplot(x=Data_Base.Meal, y=Data_Base.cash / 100, data=Data_Base, 
-                    palette=pal, edgecolor="white",
-                    size=0.25, jitter=1, zorder=0, orient="v")
-bp2 = sns.boxplot(x=Data_Base.Meal, y=Data_Base.cash / 100, data=Data_Base,
-                  color="black", width=.1, zorder=10,
-                  showcaps=True, boxprops={'facecolor':'none', "zorder":10},
-                  showfliers=False, whiskerprops={'linewidth':2, "zorder":10},
-                  saturation=1, notch=True, medianprops=medianprops, orient="v")
+ax2.set_ylim(0, 35)
+ax2 = raincloud_panel(ax2, Data_Base.Meal, Data_Base.cash / 100, pal)
 ax2.tick_params(axis='both', labelsize=14)
 ax2.text(-0.4, 33, "(b)", fontsize=14)
 ax2.set_ylim(0, 35)
@@ -95,16 +118,11 @@ ax2.set_ylabel('Expenditure per capita($CNY)', fontsize=18, color='b')
 
 
 # Fig 2(c): Daily expenditure by gender (Raincloud Plot)
+section('fig2.c', rows=len(Data_Base))
 ax3 = fig.add_subplot(gs1[-1, 1])
 pal = sns.color_palette(n_colors=2)
-ax3 = pt.half_violinplot(x=Data_Base.Gender, y=Data_Base.cash / 100 * 3, data=Data_Base, palette=pal, bw=.2, cut=0, 
-                         scale="count", width=0.6, inner=None, orient="v")
-ax3 = sns.stripplot(x=Data_Base.Gender, y=Data_Base.cash / 100 * 3, data=Data_Base, palette=pal, edgecolor="white",
-                    size=0.25, jitter=1, zorder=0, orient="v")
-ax3 = sns.boxplot(x=Data_Base.Gender, y=Data_Base.cash / 100 * 3, data=Data_Base, color="black", width=.1, zorder=10,
-                  showcaps=True, boxprops={'facecolor':'none', "zorder":10},
-                  showfliers=False, whiskerprops={'linewidth':2, "zorder":10},
-                  saturation=1, notch=True, medianprops=medianprops, orient="v")
+ax3.set_ylim(0, 100)
+ax3 = raincloud_panel(ax3, Data_Base.Gender, Data_Base.cash / 100 * 3, pal)
 
 ax3.tick_params(axis='both', labelsize=14)
 ax3.text(-0.4, 95, "(c)", fontsize=14)
@@ -112,6 +130,7 @@ ax3.set_ylim(0, 100)
 ax3.set_ylabel('Daily meal expenditure($CNY)', fontsize=18, color='b')
 
 # Fig 2(d): Daily expenditure by academic degree (Raincloud Plot)
+section('fig2.d', rows=len(Data_Base))
 ax4 = fig.add_subplot(gs1[-1, -1])
 pal = sns.color_palette(n_colors=3)
 labels = ['Undergraduate', 'Master\nStudent', 'Ph.D\nStudent']
@@ -120,22 +139,17 @@ ax4.tick_params(axis='both', labelsize=14)
 ax4.text(-0.4, 95, "(d)", fontsize=14)
 ax4.set_ylim(0, 100)
 
-ax4 = pt.half_violinplot(x=Data_Base.Type, y=Data_Base.cash / 100 * 3, data=Data_Base, palette=pal, bw=.2, cut=0, 
-                         scale="count", width=0.6, inner=None, orient="v")
-ax4 = sns.stripplot(x=Data_Base.Type, y=Data_Base.cash / 100 * 3, data=Data_Base, palette=pal, edgecolor="white",
-                    size=0.25, jitter=1, zorder=0, orient="v")
-ax4 = sns.boxplot(x=Data_Base.Type, y=Data_Base.cash / 100 * 3, data=Data_Base, color="black", width=.1, zorder=10,
-                  showcaps=True, boxprops={'facecolor':'none', "zorder":10},
-                  showfliers=False, whiskerprops={'linewidth':2, "zorder":10},
-                  saturation=1, notch=True, orient="v", medianprops=medianprops)
+ax4 = raincloud_panel(ax4, Data_Base.Type, Data_Base.cash / 100 * 3, pal)
 ax4.set_xticklabels(labels, rotation=30)
 ax4.set_ylabel('Daily meal expenditure($CNY)', fontsize=18, color='b')
         
 # Save the combined Figure 2
+section('fig2.save')
 fig.savefig('Fig2.JPG', dpi=600, bbox_inches='tight', pad_inches=0)
 
 
 # --- FIGURE 3: NON-LINEAR EFFECT ON EXPENDITURE ---
+section('fig3.data')
 DataFig2 = pd.read_csv("./Figure3.csv")
 fig2, (ax2_1, ax2_2) = plt.subplots(nrows=1, ncols=2, figsize=(14, 5))
 Fig2_X_linear = DataFig2.X.apply(lambda x: np.exp(x))
@@ -146,6 +160,7 @@ Knot6 = DataFig2.spline_est_6
 Knot7 = DataFig2.spline_est_7
 
 # Panel (a): Effect on ln(PM2.5) scale
+section('fig3.a')
 ax2_1.axhline(y=0, color='grey', linestyle='--')
 splines3 = interpolate.splrep(DataFig2.X, Knot3, k=1)
 y_bspline3 = interpolate.splev(DataFig2.X, splines3)
@@ -175,6 +190,7 @@ ax2_1.set_yticks(np.arange(-0.16, 0.09, 0.04))
 ax2_1.text(6, -0.14, "(a)", fontsize=14)
 
 # Panel (b): Effect on original PM2.5 scale
+section('fig3.b')
 ax2_2.axhline(y=0, color='grey', linestyle='--')
 ax2_2.plot(Fig2_X_linear, Knot3, "o", fillstyle='none', color='xkcd:aqua')
 splines3 = interpolate.splrep(Fig2_X_linear, Knot3)
@@ -208,33 +224,38 @@ ax2_2.tick_params(axis='both', labelsize=14)
 ax2_2.text(500, -0.14, "(b)", fontsize=14)
 
 # Create a shared legend for Figure 3
+section('fig3.save')
 lines, labels = ax2_1.get_legend_handles_labels()
 fig2.legend(lines, labels, loc='upper center', ncol=5, fontsize=14, frameon=False)
 fig2.savefig('Fig3.JPG', dpi=600, bbox_inches='tight', pad_inches=0)
 
 
 # --- FIGURE 4: NON-LINEAR EFFECT ON CONSUMPTION CHOICE ---
+section('fig4.data')
 DataFig3 = pd.read_csv("./Figure4.csv")
+# spline_sweep.py writes the odds-ratio effects exp(estimate)-1 directly;
+# the Stata output only has the log-odds estimates, so convert those here.
+for k in (3, 4, 5):
+    if f'odds_est_{k}' not in DataFig3:
+        DataFig3[f'odds_est_{k}'] = np.exp(DataFig3[f'spline_est_{k}']) - 1
 fig3, (ax3_1, ax3_2) = plt.subplots(nrows=1, ncols=2, figsize=(14, 5))
 Fig3_X_linear = DataFig3.X.apply(lambda x: np.exp(x))
-Knot3 = DataFig3.spline_est_3
-Knot4 = DataFig3.spline_est_4
-Knot5 = DataFig3.spline_est_5
+Knot3 = DataFig3.odds_est_3
+Knot4 = DataFig3.odds_est_4
+Knot5 = DataFig3.odds_est_5
 
-# Panel (a): Effect on ln(PM2.5) scale, converted to odds ratio effect
+# Panel (a): Odds ratio effect on ln(PM2.5) scale
+section('fig4.a')
 splines3 = interpolate.splrep(DataFig3.X, Knot3, k=1)
 y_bspline3 = interpolate.splev(DataFig3.X, splines3)
-y_bspline3 = np.exp(y_bspline3) - 1
 Fit3 = ax3_1.plot(DataFig3.X, y_bspline3, "o-", fillstyle='none', color='xkcd:aqua', label="knots=3")
 
 splines4 = interpolate.splrep(DataFig3.X, Knot4, k=2)
 y_bspline4 = interpolate.splev(DataFig3.X, splines4)
-y_bspline4 = np.exp(y_bspline4) - 1
 Fit4 = ax3_1.plot(DataFig3.X, y_bspline4, "o-", fillstyle='none', color='xkcd:coral', label="knots=4")
 
 splines5 = interpolate.splrep(DataFig3.X, Knot5, k=3)
 y_bspline5 = interpolate.splev(DataFig3.X, splines5)
-y_bspline5 = np.exp(y_bspline5) - 1
 Fit5 = ax3_1.plot(DataFig3.X, y_bspline5, "o-", fillstyle='none', color='xkcd:azure', label="knots=5")
 
 ax3_1.set_xlabel('ln(daily PM2.5 concentration($\mathit{ug/{m^3}}$))', fontsize=14, color='b')
@@ -245,20 +266,18 @@ ax3_1.set_yticks(np.arange(0, 5.01, 1))
 ax3_1.legend(loc='best', fontsize=14)
 ax3_1.text(6, 0.25, "(a)", fontsize=14)
 
-# Panel (b): Effect on original PM2.5 scale, converted to odds ratio effect
+# Panel (b): Odds ratio effect on original PM2.5 scale
+section('fig4.b')
 splines3 = interpolate.splrep(Fig3_X_linear, Knot3)
 y_bspline3 = interpolate.splev(Fig3_X_linear, splines3)
-y_bspline3 = np.exp(y_bspline3) - 1
 ax3_2.plot(Fig3_X_linear, y_bspline3, "o-", fillstyle='none', color='xkcd:aqua', label="knots=3")
 
 splines4 = interpolate.splrep(Fig3_X_linear, Knot4)
 y_bspline4 = interpolate.splev(Fig3_X_linear, splines4)
-y_bspline4 = np.exp(y_bspline4) - 1
 ax3_2.plot(Fig3_X_linear, y_bspline4, "o-", fillstyle='none', color='xkcd:coral', label="knots=4")
 
 splines5 = interpolate.splrep(Fig3_X_linear, Knot5)
 y_bspline5 = interpolate.splev(Fig3_X_linear, splines5)
-y_bspline5 = np.exp(y_bspline5) - 1
 ax3_2.plot(Fig3_X_linear, y_bspline5, "o-", fillstyle='none', color='xkcd:azure', label="knots=5")
 
 ax3_2.set_xlabel('Daily PM2.5 concentration($\mathit{ug/{m^3}}$)', fontsize=14, color='b')
@@ -266,4 +285,5 @@ ax3_2.set_yticks(np.arange(0, 5.01, 1))
 ax3_2.tick_params(axis='both', labelsize=14)
 ax3_2.text(500, 0.2, "(b)", fontsize=14)
 
+section('fig4.save')
 fig3.savefig('Fig4.JPG', dpi=600, bbox_inches='tight', pad_inches=0)
\ No newline at end of file
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the three tree-model pipelines.
+
+Drives the feature build (features.build_feature_matrix) and the fit stage of
+the Random Forest, XGBoost and LightGBM scripts on synthetic transactions
+(synthetic_data.py; the real data is proprietary) at several row counts,
+numbers of `card` levels and thread counts. Each case runs in a fresh process so peak
+RSS is measured per case. Results go to a JSON file that can be diffed
+against an earlier run.
+
+Usage
+-----
+    python benchmarks/bench_trainers.py --rows 20000 100000 --cards 100 1000 --threads 1 4
+    python benchmarks/bench_trainers.py --compare old.json new.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import pandas as pd
+
+# The benchmark lives one folder below the shared modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from features import CATEGORICAL_FEATURES, NUMERICAL_FEATURES, TARGET_VARIABLE, build_feature_matrix  # noqa: E402
+from synthetic_data import generate_shard  # noqa: E402
+
+TRAINERS = ['rf', 'xgb', 'lgbm']
+DEFAULT_ROWS = [20_000, 100_000]
+DEFAULT_CARDS = [100, 1_000]
+DEFAULT_THREADS = [1, os.cpu_count()]
+
+
+def make_fixture(n_rows, n_cards, seed=0):
+    """Synthetic transactions (synthetic_data.py) with the dtypes load_data returns."""
+    df = generate_shard('data0327', 0, n_rows, (0, n_cards), n_cards, seed=seed)
+    for col in CATEGORICAL_FEATURES:
+        df[col] = df[col].astype('category')
+    return df
+
+
+def _model(trainer, n_threads):
+    if trainer == 'rf':
+        from sklearn.ensemble import RandomForestRegressor
+        return RandomForestRegressor(n_estimators=100, random_state=42, n_jobs=n_threads)
+    if trainer == 'xgb':
+        import xgboost as xgb
+        return xgb.XGBRegressor(objective='reg:squarederror', n_estimators=100, learning_rate=0.1,
+                                max_depth=5, random_state=42, n_jobs=n_threads)
+    if trainer == 'lgbm':
+        import lightgbm as lgb
+        return lgb.LGBMRegressor(random_state=42, n_jobs=n_threads, verbose=-1)
+    raise ValueError(f"Unknown trainer '{trainer}'")
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _stage(name, func, n_rows, n_threads):
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    result = func()
+    wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+    record = {
+        'stage': name,
+        'wall_s': wall,
+        'cpu_s': cpu,
+        'rows_per_s': n_rows / wall if wall > 0 else None,
+        # Share of the available threads kept busy (1.0 = all threads at 100%)
+        'cpu_utilisation': cpu / wall / n_threads if wall > 0 else None,
+        'peak_rss_mb': _peak_rss_mb(),
+    }
+    return result, record
+
+
+def run_case(case):
+    """Run one (trainer, rows, cards, threads) case; called in a fresh process."""
+    trainer, n_rows, n_cards, n_threads = case['trainer'], case['rows'], case['cards'], case['threads']
+    df = make_fixture(n_rows, n_cards)
+    fixture_rss = _peak_rss_mb()
+    (X, names), features = _stage(
+        'features', lambda: build_feature_matrix(df, NUMERICAL_FEATURES, CATEGORICAL_FEATURES), n_rows, 1)
+    model = _model(trainer, n_threads)
+    _, fit = _stage('fit', lambda: model.fit(X, df[TARGET_VARIABLE]), n_rows, n_threads)
+    return [dict(case, n_features=len(names), fixture_rss_mb=fixture_rss, **record) for record in (features, fit)]
+
+
+def run_suite(trainers, rows, cards, threads):
+    cases = [{'trainer': t, 'rows': r, 'cards': c, 'threads': n}
+             for t in trainers for r in rows for c in cards for n in threads]
+    # A fresh spawned process per case keeps peak RSS from leaking between cases
+    context = multiprocessing.get_context('spawn')
+    records = []
+    for case in cases:
+        with context.Pool(1, maxtasksperchild=1) as pool:
+            case_records = pool.apply(run_case, (case,))
+        for record in case_records:
+            print(f"{record['trainer']:>5} rows={record['rows']:>9} cards={record['cards']:>6} "
+                  f"threads={record['threads']:>3} {record['stage']:>8}: {record['wall_s']:8.3f} s "
+                  f"{record['rows_per_s']:>12,.0f} rows/s  peak RSS {record['peak_rss_mb']:8.1f} MB")
+        records.extend(case_records)
+    return records
+
+
+def environment():
+    versions = {}
+    for module in ['numpy', 'pandas', 'scipy', 'sklearn', 'xgboost', 'lightgbm']:
+        try:
+            versions[module] = __import__(module).__version__
+        except ImportError:
+            versions[module] = None
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'cpu_count': os.cpu_count(), 'versions': versions,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(old_path, new_path, metric='wall_s'):
+    """Relative change of `metric` for every case present in both result files."""
+    def load(path):
+        with open(path) as f:
+            records = json.load(f)['results']
+        return pd.DataFrame(records).set_index(['trainer', 'rows', 'cards', 'threads', 'stage'])[metric]
+    old, new = load(old_path), load(new_path)
+    table = pd.DataFrame({'old': old, 'new': new}).dropna()
+    table['change_%'] = (table['new'] / table['old'] - 1) * 100
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trainers', nargs='+', default=TRAINERS, choices=TRAINERS)
+    parser.add_argument('--rows', nargs='+', type=int, default=DEFAULT_ROWS)
+    parser.add_argument('--cards', nargs='+', type=int, default=DEFAULT_CARDS)
+    parser.add_argument('--threads', nargs='+', type=int, default=DEFAULT_THREADS)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Compare two result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        print(compare(*args.compare).to_string(float_format='%.3f'))
+        return
+
+    records = run_suite(args.trainers, args.rows, args.cards, sorted(set(args.threads)))
+    with open(args.output, 'w') as f:
+        json.dump({'environment': environment(), 'results': records}, f, indent=2)
+    print(f"\nBenchmark results saved as '{args.output}'")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Cluster-robust inference for the fixed-effects results of fe_regression.py.
+
+- cluster_cov: one-way or two-way (Cameron, Gelbach and Miller) clustered
+  covariance, e.g. by student (`card`) and by day (`Date`), from the
+  per-cluster sums of the scores x~_i e_i. The small-sample factor is
+  areg's, G/(G-1) * (N-1)/(N-K) with K counting the absorbed levels, and
+  the t distribution has G-1 degrees of freedom (the smallest G for two-way).
+- wild_cluster_bootstrap: restricted wild cluster bootstrap (WCR) p-values.
+  With the null imposed, a bootstrap sample is y* = X~ b_r + v_g e_r, and
+  b* - b_r = (X~'X~)^-1 S_r' v is linear in the cluster weights v (S_r are
+  the per-cluster scores of the restricted residuals). So are the clustered
+  scores of the bootstrap residuals. Each replication is then a few
+  matrix products over clusters instead of a regression, and the draws are
+  computed in batches (one weight matrix per batch) spread over processes.
+  Clusters nested in the bootstrap clusters (card x Date in card) are summed
+  through their cross-products, so no product over the cells is formed per draw.
+
+Example
+-------
+    fe = AbsorbedData(df, absorb='card')
+    bs5 = fe.fit('logCash', BASELINE_REGRESSORS, factors=BASELINE_FACTORS)
+    clustered = cluster_cov(fe, bs5, clusters=['card', 'Date'])
+    print(esttab({'areg': bs5, 'two-way': clustered}, keep=['logPM']))
+    print(wild_cluster_bootstrap(fe, bs5, params=['logPM'], clusters=['card', 'Date']))
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from scipy import stats
+
+from fe_regression import group_codes
+
+# Bootstrap replications and draws per weight matrix
+BOOT_REPS = 9999
+BOOT_BATCH = 256
+# Webb's six-point weights, better than Rademacher with few clusters
+WEBB_WEIGHTS = np.array([-np.sqrt(1.5), -1.0, -np.sqrt(0.5), np.sqrt(0.5), 1.0, np.sqrt(1.5)])
+
+
+def _sums(values, codes, n_groups):
+    """Per-cluster column sums of an (n, k) array."""
+    return np.column_stack([np.bincount(codes, weights=values[:, j], minlength=n_groups)
+                            for j in range(values.shape[1])])
+
+
+def _within_design(fe, result):
+    """Demeaned regressors (n, k), demeaned y and estimation rows of a fitted result."""
+    X = np.column_stack([fe._cache[(result.sample_key, name)] for name in result.params.index])
+    y = fe._cache[(result.sample_key, result.depvar)]
+    return X, y, fe._samples[result.sample_key][0]
+
+
+def cluster_codes(fe, result, col, rows=None):
+    """Cluster codes (0..G-1) of `col` on the estimation sample, and G."""
+    # Rows outside the sample may miss `col`: only the estimation rows need a cluster
+    codes = group_codes(fe.df[col], allow_missing=True)[0]
+    if rows is not None:
+        codes = codes[rows]
+    if (codes < 0).any():
+        raise ValueError(f"Error: {int((codes < 0).sum())} rows of the estimation sample have no '{col}' cluster, "
+                         f"drop them from the sample (subset=) before fitting.")
+    _, codes = np.unique(codes, return_inverse=True)
+    return codes, int(codes.max()) + 1
+
+
+def _dimensions(fe, result, clusters, rows):
+    """(codes, G, sign) of every term of the covariance: +card, or +card +Date -card x Date."""
+    clusters = [clusters] if isinstance(clusters, str) else list(clusters)
+    if len(clusters) not in (1, 2):
+        raise ValueError("Error: Clustering is one-way or two-way.")
+    dims = [cluster_codes(fe, result, col, rows) + (1.0,) for col in clusters]
+    if len(dims) == 2:
+        (a, _, _), (b, n_b, _) = dims
+        _, both = np.unique(a * n_b + b, return_inverse=True)
+        dims.append((both, int(both.max()) + 1, -1.0))
+    return dims
+
+
+def _scale(n_groups, result):
+    # areg's small-sample factor
+    return n_groups / (n_groups - 1) * (result.nobs - 1) / result.df_resid
+
+
+def cluster_cov(fe, result, clusters=('card',)):
+    """
+    `result` with one-way or two-way cluster-robust standard errors.
+
+    Parameters
+    ----------
+    fe : AbsorbedData
+        The data `result` was fitted on (its demeaned columns must be cached).
+    result : FEResult
+    clusters : str or list of str
+        One or two cluster variables, e.g. 'card' or ['card', 'Date'].
+    """
+    X, y, rows = _within_design(fe, result)
+    resid = y - X @ result.params.to_numpy()
+    bread = np.linalg.inv(X.T @ X)
+    dims = _dimensions(fe, result, clusters, rows)
+    meat = np.zeros_like(bread)
+    for codes, n_groups, sign in dims:
+        scores = _sums(X * resid[:, None], codes, n_groups)
+        meat += sign * _scale(n_groups, result) * (scores.T @ scores)
+    cov = bread @ meat @ bread
+    if len(dims) > 1:
+        # Two-way: the difference can lose positive definiteness, drop negative eigenvalues
+        values, vectors = np.linalg.eigh(cov)
+        if values.min() < 0:
+            cov = (vectors * np.maximum(values, 0)) @ vectors.T
+    names = list(result.params.index)
+    clusters = [clusters] if isinstance(clusters, str) else list(clusters)
+    return result.with_cov(pd.DataFrame(cov, index=names, columns=names), vce='cluster ' + ' '.join(clusters),
+                           df_t=min(n for _, n, _ in dims[:2]) - 1)
+
+
+# --- Wild cluster bootstrap ---
+
+# State shared by the worker processes, set once per worker by _init_worker
+_STATE = {}
+
+
+def _init_worker(state):
+    _STATE.update(state)
+
+
+def _draw_weights(rng, n_groups, size, weights):
+    if weights == 'rademacher':
+        return rng.integers(0, 2, size=(n_groups, size)).astype(np.float64) * 2 - 1
+    return WEBB_WEIGHTS[rng.integers(0, 6, size=(n_groups, size))]
+
+
+def _bootstrap_block(tasks):
+    """Bootstrap t statistics for every (parameter, batch, size) of a block."""
+    s = _STATE
+    results = []
+    for p, batch, size in tasks:
+        test = s['tests'][p]
+        rng = np.random.default_rng([s['seed'], p, batch])
+        V = _draw_weights(rng, s['n_boot'], size, s['weights'])
+        # b* - b_r for every draw (k, size)
+        W = test['P'] @ V
+        var = np.zeros(size)
+        for kind, C, Q, QtQ, scale in test['terms']:
+            if kind == 'nested':
+                # sum_h T_h^2 = v'C'Cv - 2 v'C'Q w + w'Q'Q w, with C'C diagonal (C holds its diagonal)
+                var += scale * (C @ (V * V) - 2 * np.einsum('ij,ij->j', V, Q @ W)
+                                + np.einsum('ij,ij->j', W, QtQ @ W))
+            else:
+                T = C @ V - Q @ W
+                var += scale * np.einsum('ij,ij->j', T, T)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = W[test['j']] / np.sqrt(np.maximum(var, 0))
+        results.append((p, batch, t))
+    return results
+
+
+def wild_cluster_bootstrap(fe, result, params=None, clusters=('card',), bootcluster=None, null=0.0,
+                           reps=BOOT_REPS, weights='rademacher', n_jobs=None, seed=42):
+    """
+    Wild cluster bootstrap (WCR) tests of H0: coefficient = `null`.
+
+    The bootstrap t statistics use the same one-way or two-way clustered
+    standard errors as cluster_cov. Weights are drawn per `bootcluster`
+    cluster (default: the cluster variable with the fewest clusters).
+    Results depend on `seed` only, not on `n_jobs`.
+
+    Returns a DataFrame indexed by parameter with columns 'coef', 'se', 't',
+    'p' (clustered t test) and 'p_boot' (symmetric bootstrap p-value).
+    """
+    if weights not in ('rademacher', 'webb'):
+        raise ValueError("Error: weights must be 'rademacher' or 'webb'.")
+    params = list(result.params.index if params is None else params)
+    clustered = cluster_cov(fe, result, clusters)
+    X, y, rows = _within_design(fe, result)
+    names = list(result.params.index)
+    dims = _dimensions(fe, result, clusters, rows)
+    if bootcluster is None:
+        clusters = [clusters] if isinstance(clusters, str) else list(clusters)
+        bootcluster = clusters[int(np.argmin([n for _, n, _ in dims[:len(clusters)]]))]
+    boot_codes, n_boot = cluster_codes(fe, result, bootcluster, rows)
+
+    xtx = X.T @ X
+    bread = np.linalg.inv(xtx)
+    tests = []
+    for name in params:
+        j = names.index(name)
+        others = [i for i in range(len(names)) if i != j]
+        # Restricted fit: coefficient j fixed at the null
+        y_r = y - null * X[:, j]
+        beta = np.linalg.solve(xtx[np.ix_(others, others)], X[:, others].T @ y_r)
+        resid = y_r - X[:, others] @ beta
+        a = bread[j]
+        xa = X @ a
+        terms = []
+        for codes, n_groups, sign in dims:
+            # a' s*_h = (C v)_h - (Q (b* - b_r))_h for every cluster h of this term
+            C = sp.csr_matrix((xa * resid, (codes, boot_codes)), shape=(n_groups, n_boot))
+            Q = _sums(X * xa[:, None], codes, n_groups)
+            scale = sign * _scale(n_groups, result)
+            if C.getnnz(axis=1).max() <= 1:
+                terms.append(('nested', (C.T @ C).diagonal(), np.asarray(C.T @ Q), Q.T @ Q, scale))
+            else:
+                terms.append(('direct', C, Q, None, scale))
+        P = bread @ _sums(X * resid[:, None], boot_codes, n_boot).T
+        tests.append({'j': j, 'P': P, 'terms': terms})
+
+    sizes = [min(BOOT_BATCH, reps - start) for start in range(0, reps, BOOT_BATCH)]
+    tasks = [(p, batch, size) for p in range(len(params)) for batch, size in enumerate(sizes)]
+    state = {'tests': tests, 'n_boot': n_boot, 'weights': weights, 'seed': seed}
+    n_jobs = min(n_jobs or os.cpu_count(), len(tasks))
+    if n_jobs == 1:
+        _init_worker(state)
+        blocks = [_bootstrap_block(tasks)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(state,)) as pool:
+            blocks = list(pool.map(_bootstrap_block, np.array_split(np.array(tasks), n_jobs)))
+
+    draws = {p: [None] * len(sizes) for p in range(len(params))}
+    for block in blocks:
+        for p, batch, t in block:
+            draws[p][batch] = t
+    rows = []
+    for p, name in enumerate(params):
+        t_boot = np.concatenate(draws[p])
+        t = (clustered.params[name] - null) / clustered.bse[name]
+        rows.append({'coef': clustered.params[name], 'se': clustered.bse[name], 't': t,
+                     'p': 2 * stats.t.sf(abs(t), clustered.df_t), 'p_boot': float(np.mean(np.abs(t_boot) >= abs(t)))})
+    return pd.DataFrame(rows, index=pd.Index(params, name='param'))
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Daily aggregate cube for the descriptive outputs (Table 1, Fig 2(a)).
+
+One groupby pass reduces the transactions to cells keyed by Date x Meal x
+Gender x Type (plus the `outlier` flag the figures filter on). Every cell
+holds, for each value column, the count, sum, sum of squares, min and max,
+and a quantile sketch (log-spaced buckets with 1% relative accuracy, which
+add up exactly when cells are merged). Any roll-up of the cells (daily means
+and maxima, tabstat-style summaries, quantiles by group) is answered from the
+cube without touching the rows.
+
+The cube is cached next to the columnar cache of the .dta file. When the file
+changes by appending new days, only the new rows are aggregated and merged in.
+
+Example
+-------
+    cube = load_cube('data0327.dta')
+    daily = cube.query(by='Date', values=['cash', 'APM25'], stats=['mean', 'max'])
+    print(cube.describe(TABLE1_VARIABLES))
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from data_cache import CACHE_DIR, cache_metadata, cache_path, load_data
+
+CUBE_KEYS = ['Date', 'Meal', 'Gender', 'Type']
+# Variables of `tabstat cash total_pre ctemp maxtemp mintemp PM` (Table 1)
+TABLE1_VARIABLES = ['cash', 'total_pre', 'ctemp', 'maxtemp', 'mintemp', 'PM']
+CUBE_VALUES = ['cash', 'APM25', 'total_pre', 'ctemp', 'maxtemp', 'mintemp', 'PM']
+# Transactions the figures leave out ('Data_Base0.cash < 5000' in the figure script)
+OUTLIER_CASH = 5000
+# Relative accuracy of the quantile sketches
+SKETCH_ACCURACY = 0.01
+# Bump when the layout of the cached cube changes
+CUBE_VERSION = 1
+
+_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+# Values closer to zero than this share the zero bucket
+_SKETCH_MIN = 1e-9
+_OFFSET = int(np.ceil(-np.log(_SKETCH_MIN) / np.log(_GAMMA))) + 1
+
+
+def sketch_bucket(values):
+    """Signed log-bucket of every value (0 for |x| < 1e-9); values must not be NaN."""
+    magnitude = np.abs(values)
+    index = np.ceil(np.log(np.maximum(magnitude, _SKETCH_MIN)) / np.log(_GAMMA)).astype(np.int64) + _OFFSET
+    return np.where(magnitude < _SKETCH_MIN, 0, np.sign(values).astype(np.int64) * index)
+
+
+def bucket_value(buckets):
+    """Representative value of each bucket (within SKETCH_ACCURACY of every value in it)."""
+    buckets = np.asarray(buckets, dtype=np.int64)
+    magnitude = 2 * _GAMMA ** (np.abs(buckets) - _OFFSET) / (_GAMMA + 1)
+    return np.where(buckets == 0, 0.0, np.sign(buckets) * magnitude)
+
+
+def add_outlier_flag(df):
+    return df.assign(outlier=(df['cash'] >= OUTLIER_CASH).astype(np.int8))
+
+
+class DailyCube:
+    """
+    Aggregated cells and quantile sketches.
+
+    cells  : one row per key combination; columns <value>_count, _sum, _sumsq, _min, _max
+    sketch : long table (keys, variable, bucket, count)
+    """
+
+    def __init__(self, cells, sketch, keys, values):
+        self.cells = cells
+        self.sketch = sketch
+        self.keys = list(keys)
+        self.values = list(values)
+
+    @classmethod
+    def build(cls, df, keys=None, values=None):
+        """Aggregate a transaction frame in one groupby pass."""
+        keys = list(CUBE_KEYS if keys is None else keys)
+        if 'cash' in df.columns and 'outlier' not in keys:
+            df = add_outlier_flag(df)
+            keys.append('outlier')
+        values = [v for v in (CUBE_VALUES if values is None else values) if v in df.columns]
+
+        # Sums in float64 whatever the storage type
+        numbers = {v: df[v].astype(np.float64) for v in values}
+        squares = {f'{v}_sq': numbers[v] ** 2 for v in values}
+        frame = df[keys].assign(**numbers, **squares)
+        grouped = frame.groupby(keys, observed=True, dropna=False, sort=True)
+        agg = grouped.agg({**{v: ['count', 'sum', 'min', 'max'] for v in values}, **{s: 'sum' for s in squares}})
+        cells = pd.DataFrame(index=agg.index)
+        for v in values:
+            cells[f'{v}_count'] = agg[v, 'count'].astype(np.int64)
+            cells[f'{v}_sum'] = agg[v, 'sum'].astype(np.float64)
+            cells[f'{v}_sumsq'] = agg[f'{v}_sq', 'sum']
+            cells[f'{v}_min'] = agg[v, 'min'].astype(np.float64)
+            cells[f'{v}_max'] = agg[v, 'max'].astype(np.float64)
+        cells = cells.reset_index()
+        # Plain key columns, so cubes read back from Parquet merge with new ones
+        for k in keys:
+            if isinstance(cells[k].dtype, pd.CategoricalDtype):
+                levels = cells[k].cat.categories
+                if cells[k].isna().any():
+                    cells[k] = cells[k].astype(np.float64 if pd.api.types.is_numeric_dtype(levels) else object)
+                else:
+                    cells[k] = cells[k].astype(levels.dtype)
+
+        # Sketches: bucket counts per (cell, variable), reusing the cell numbering of the groupby
+        cell = grouped.ngroup().to_numpy()
+        parts = []
+        for v in values:
+            x = df[v].to_numpy(dtype=np.float64)
+            ok = ~np.isnan(x)
+            # One int64 key per (cell, bucket) pair: |bucket| < 2**20 for any float64
+            pairs, counts = np.unique(cell[ok] * 2 ** 21 + sketch_bucket(x[ok]) + 2 ** 20, return_counts=True)
+            part = cells.loc[pairs // 2 ** 21, keys].reset_index(drop=True)
+            part['variable'] = v
+            part['bucket'] = pairs % 2 ** 21 - 2 ** 20
+            part['count'] = counts
+            parts.append(part)
+        sketch = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=keys + ['variable', 'bucket', 'count'])
+        return cls(cells, sketch, keys, values)
+
+    def merge(self, other):
+        """Cube of the union of the rows of two cubes (e.g. the cached one and newly appended days)."""
+        cells = pd.concat([self.cells, other.cells], ignore_index=True)
+        grouped = cells.groupby(self.keys, observed=True, dropna=False, sort=True)
+        how = {}
+        for v in self.values:
+            how.update({f'{v}_count': 'sum', f'{v}_sum': 'sum', f'{v}_sumsq': 'sum',
+                        f'{v}_min': 'min', f'{v}_max': 'max'})
+        sketch = pd.concat([self.sketch, other.sketch], ignore_index=True)
+        sketch = sketch.groupby(self.keys + ['variable', 'bucket'], observed=True, dropna=False,
+                                sort=True)['count'].sum().reset_index()
+        return DailyCube(grouped.agg(how).reset_index(), sketch, self.keys, self.values)
+
+    def update(self, df):
+        """Add new transactions (e.g. newly appended days)."""
+        return self.merge(DailyCube.build(df, [k for k in self.keys if k != 'outlier'], self.values))
+
+    # --- Queries ---
+
+    def _select(self, table, where):
+        if not where:
+            return table
+        mask = np.ones(len(table), dtype=bool)
+        for key, value in where.items():
+            mask &= table[key].isin(value if isinstance(value, (list, tuple, set)) else [value]).to_numpy()
+        return table[mask]
+
+    def query(self, by=('Date',), values=None, stats=('count', 'mean', 'sd', 'min', 'max'), where=None):
+        """
+        Roll the cells up to the `by` keys.
+
+        Returns a frame indexed by `by` with (stat, variable) columns, the layout of
+        pd.pivot_table(..., aggfunc=[...]). Stats: count, sum, mean, sd, min, max.
+        `where` filters cells by key values, e.g. {'outlier': 0, 'Meal': [1, 2]}.
+        """
+        by = [by] if isinstance(by, str) else list(by)
+        values = self.values if values is None else values
+        cells = self._select(self.cells, where)
+        if by:
+            grouped = cells.groupby(by, observed=True, sort=True)
+        else:
+            grouped = cells.assign(_all=0).groupby('_all')
+        totals = {}
+        for v in values:
+            n = grouped[f'{v}_count'].sum()
+            s = grouped[f'{v}_sum'].sum()
+            ss = grouped[f'{v}_sumsq'].sum()
+            with np.errstate(invalid='ignore', divide='ignore'):
+                variance = ((ss - s ** 2 / n) / (n - 1)).clip(lower=0)
+            totals[v] = {'count': n, 'sum': s, 'mean': s / n, 'sd': np.sqrt(variance),
+                         'min': grouped[f'{v}_min'].min(), 'max': grouped[f'{v}_max'].max()}
+        table = pd.DataFrame({(stat, v): totals[v][stat] for stat in stats for v in values})
+        if not by:
+            table.index = ['all']
+        # Drop key combinations without any value of these variables
+        observed = sum(totals[v]['count'].to_numpy() for v in values) > 0
+        return table[observed]
+
+    def quantile(self, q, variable, by=(), where=None):
+        """Quantile(s) `q` of `variable` from the sketches, overall or by keys."""
+        by = [by] if isinstance(by, str) else list(by)
+        sketch = self._select(self.sketch, where)
+        sketch = sketch[sketch['variable'] == variable]
+        counts = sketch.groupby(by + ['bucket'], observed=True)['count'].sum().reset_index()
+        counts['value'] = bucket_value(counts['bucket'])
+        counts = counts.sort_values(by + ['value'])
+        qs = np.atleast_1d(q)
+
+        def one(group):
+            cumulative = group['count'].cumsum().to_numpy()
+            # Nearest rank, like the rank-based definition the sketch guarantees
+            ranks = np.clip(np.ceil(qs * cumulative[-1]), 1, None)
+            return pd.Series(group['value'].to_numpy()[np.searchsorted(cumulative, ranks)], index=qs)
+
+        if not by:
+            return one(counts)
+        return counts.groupby(by, observed=True).apply(one)
+
+    def describe(self, variables=TABLE1_VARIABLES, where=None):
+        """`tabstat variables, s(n mean sd min max) c(s)` over all cells."""
+        table = self.query(by=(), values=variables, stats=['count', 'mean', 'sd', 'min', 'max'], where=where)
+        out = table.iloc[0].unstack(level=0)[['count', 'mean', 'sd', 'min', 'max']]
+        out.columns = ['N', 'mean', 'sd', 'min', 'max']
+        return out.loc[variables]
+
+    # --- Persistence ---
+
+    def save(self, stem):
+        """Write `<stem>.cube.parquet` and `<stem>.sketch.parquet`."""
+        self.cells.to_parquet(stem + '.cube.parquet', index=False)
+        self.sketch.to_parquet(stem + '.sketch.parquet', index=False)
+
+    @classmethod
+    def read(cls, stem, keys, values):
+        return cls(pd.read_parquet(stem + '.cube.parquet'), pd.read_parquet(stem + '.sketch.parquet'), keys, values)
+
+
+def _cube_stem(source_path):
+    folder = os.path.join(os.path.dirname(os.path.abspath(source_path)), CACHE_DIR)
+    return os.path.join(folder, os.path.splitext(os.path.basename(source_path))[0])
+
+
+def _read_rows(source_path, columns, after=None):
+    """Cube input columns from the columnar cache, optionally only the rows dated after `after`."""
+    if after is None:
+        return load_data(source_path, columns=columns)
+    meta = cache_metadata(source_path)
+    table = pq.read_table(cache_path(source_path), columns=columns,
+                          filters=[('Date', '>', pd.Timestamp(after))])
+    df = table.to_pandas()
+    for col, levels in meta['categories'].items():
+        if col in df.columns:
+            df[col] = pd.Categorical(df[col], categories=levels)
+    return df
+
+
+def load_cube(source_path, keys=None, values=None):
+    """
+    Cube of a .dta file, cached next to its columnar cache.
+
+    If the file changed only by appending rows dated after the last cached
+    day, just those rows are aggregated and merged into the cached cube;
+    otherwise the cube is rebuilt.
+    """
+    keys = list(CUBE_KEYS if keys is None else keys)
+    meta = cache_metadata(source_path)
+    values = [v for v in (CUBE_VALUES if values is None else values) if v in meta['columns']]
+    columns = [k for k in keys if k in meta['columns']] + values
+    stem = _cube_stem(source_path)
+    meta_path = stem + '.cube.json'
+    present_keys = [k for k in keys if k in meta['columns']]
+    all_keys = present_keys + (['outlier'] if 'cash' in values else [])
+
+    cube_meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            cube_meta = json.load(f)
+        if cube_meta.get('version') != CUBE_VERSION or cube_meta.get('columns') != columns:
+            cube_meta = None
+
+    if cube_meta is not None and cube_meta['source'] == meta['source']:
+        return DailyCube.read(stem, all_keys, values)
+
+    cube = None
+    if cube_meta is not None:
+        # Appended days: the rows up to the last cached day must be exactly the cached ones
+        dates = load_data(source_path, columns=['Date'])['Date']
+        last = pd.Timestamp(cube_meta['last_date'])
+        if (dates <= last).sum() == cube_meta['n_rows']:
+            print(f"Updating the aggregate cube of '{source_path}' with days after {last.date()}...")
+            new_rows = _read_rows(source_path, columns, after=last)
+            cube = DailyCube.read(stem, all_keys, values)
+            if len(new_rows):
+                cube = cube.update(new_rows)
+    if cube is None:
+        print(f"Building the aggregate cube of '{source_path}'...")
+        cube = DailyCube.build(_read_rows(source_path, columns), keys=present_keys, values=values)
+
+    cube.save(stem)
+    with open(meta_path, 'w') as f:
+        json.dump({'source': meta['source'], 'version': CUBE_VERSION, 'columns': columns,
+                   'n_rows': meta['n_rows'], 'last_date': str(cube.cells['Date'].max())}, f)
+    return cube
+
+
+if __name__ == '__main__':
+    # Table 1: tabstat cash total_pre ctemp maxtemp mintemp PM, s(n mean sd min max) c(s)
+    cube = load_cube('data0327.dta')
+    table1 = cube.describe([v for v in TABLE1_VARIABLES if v in cube.values])
+    table1.to_csv('table1_python.csv')
+    print(f"table1\n{table1.round(3)}")
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Day-level storage of the weather, pollution and calendar variables.
+
+logPM, logPre, rh, awin, ctemp, vacation, month, weekday (and the PM lags)
+only vary by Date, yet the .dta files repeat them on every transaction. A
+DailyPanel keeps them once per calendar day, plus an int16 day index per
+transaction:
+
+- `panel.days` : one row per date, sorted by Date;
+- `panel.day`  : row of `panel.days` of every transaction (int16);
+- `panel.rows` : the transaction-level columns (logCash, card, Meal, ...).
+
+Day-level columns are broadcast to the transactions only when a consumer asks
+for them (`panel['logPM']`, `panel.frame([...])`). Lags such as L1logPM are not
+stored: they are generated from the daily table by calendar date. Regressions
+whose regressors are all day-level (the baseline areg) are solved from
+day-collapsed cross-products with `fit_day_level`, without building the
+transaction-level design.
+
+Example
+-------
+    panel = load_panel('data0327.dta', columns=['logCash', 'card', 'Meal'])
+    result = fit_day_level(panel, 'logCash', BASELINE_REGRESSORS, BASELINE_FACTORS)
+    df = panel.frame(['logCash', 'logPM', 'L1logPM', 'card'])
+"""
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from data_cache import CACHE_DIR, cache_metadata, load_data
+from fe_regression import absorbed_dof, group_codes, solve_cross_products
+
+# Columns that are constant within a day in both .dta files (checked when the
+# table is built; columns that turn out to vary stay transaction-level)
+DAY_COLUMNS = ['logPM', 'logPre', 'rh', 'awin', 'ctemp', 'vacation', 'month', 'weekday',
+               'logAPM', 'logMaxPM', 'PM', 'APM25', 'atemp', 'total_pre', 'maxtemp', 'mintemp']
+# Lag columns: 'L<k><column>' is <column> k calendar days earlier
+LAG_PATTERN = re.compile(r'^L(\d+)(\w+)$')
+# Bump when the layout of the day cache changes
+DAY_CACHE_VERSION = 2
+
+
+def lagged(days, column, k, date='Date'):
+    """`column` of the daily table k calendar days earlier (NaN where the date is not in the table)."""
+    values = days.set_index(date)[column]
+    return values.reindex(days[date] - pd.Timedelta(days=k)).to_numpy()
+
+
+def _parse_lag(name, columns):
+    match = LAG_PATTERN.match(name)
+    if match and match.group(2) in columns:
+        return match.group(2), int(match.group(1))
+    return None
+
+
+class DailyPanel:
+    """Transaction-level columns plus a daily table joined on demand through an int16 day index."""
+
+    def __init__(self, rows, days, day, date='Date'):
+        if len(days) > np.iinfo(np.int16).max:
+            raise ValueError("Error: Too many days for an int16 day index.")
+        self.rows = rows
+        self.days = days.reset_index(drop=True)
+        self.day = np.asarray(day, dtype=np.int16)
+        self.date = date
+
+    def __len__(self):
+        return len(self.day)
+
+    @property
+    def day_columns(self):
+        return list(self.days.columns)
+
+    @property
+    def columns(self):
+        return list(self.rows.columns) + [c for c in self.day_columns if c not in self.rows.columns]
+
+    def has_column(self, name):
+        return name in self.rows.columns or name in self.days.columns or \
+            _parse_lag(name, self.days.columns) is not None
+
+    def daily(self, name):
+        """Values of a day-level (or lag) column, one per row of `days`."""
+        if name in self.days.columns:
+            return self.days[name]
+        lag = _parse_lag(name, self.days.columns)
+        if lag is None:
+            raise KeyError(f"Error: '{name}' is not a day-level column.")
+        return pd.Series(lagged(self.days, lag[0], lag[1], self.date), name=name)
+
+    def __getitem__(self, name):
+        """One column at transaction level; day-level columns are broadcast here."""
+        if name in self.rows.columns:
+            return self.rows[name]
+        values = self.daily(name)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            broadcast = pd.Categorical.from_codes(values.cat.codes.to_numpy()[self.day], dtype=values.dtype)
+        else:
+            broadcast = values.to_numpy()[self.day]
+        return pd.Series(broadcast, index=self.rows.index, name=name)
+
+    def frame(self, columns=None, subset=None):
+        """Transaction-level DataFrame of `columns` (all by default), optionally for a subset of rows."""
+        columns = self.columns if columns is None else columns
+        df = pd.DataFrame({name: self[name] for name in columns}, index=self.rows.index)
+        return df if subset is None else df[np.asarray(subset, dtype=bool)]
+
+    def day_counts(self, subset=None):
+        """Number of transactions on every row of `days`."""
+        day = self.day if subset is None else self.day[np.asarray(subset, dtype=bool)]
+        return np.bincount(day, minlength=len(self.days))
+
+    def nbytes(self):
+        """Memory held by the panel (rows, daily table and day index)."""
+        return int(self.rows.memory_usage(deep=True).sum() + self.days.memory_usage(deep=True).sum()
+                   + self.day.nbytes)
+
+
+def split_days(df, date='Date', columns=None):
+    """
+    Split the day-level columns of a transaction frame into a daily table.
+
+    Returns (days, day). Candidate `columns` (DAY_COLUMNS by default) that
+    vary within a day are left out. Lag columns (L1logPM, ...) are dropped when
+    the daily table reproduces them; the dates they refer to before the first
+    transaction day are added to the table, so nothing is lost.
+    """
+    candidates = [c for c in (DAY_COLUMNS if columns is None else columns) if c in df.columns and c != date]
+    codes, dates = pd.factorize(df[date], sort=True)
+    if (codes < 0).any():
+        raise ValueError(f"Error: Missing values in '{date}'.")
+    grouped = df[candidates].groupby(codes, observed=True)
+    constant = [c for c in candidates if (grouped[c].nunique(dropna=False) <= 1).all()]
+    days = df[constant].groupby(codes, observed=True).first()
+    days.insert(0, date, dates)
+
+    lag_columns = [c for c in df.columns if _parse_lag(c, constant)]
+    if lag_columns:
+        first = df[lag_columns].groupby(codes, observed=True).first()
+        extra = []
+        for name in lag_columns:
+            column, k = _parse_lag(name, constant)
+            # Values of `column` on the dates the lag refers to
+            extra.append(pd.DataFrame({date: dates - pd.Timedelta(days=k), column: first[name].to_numpy()}))
+        implied = pd.concat(extra)
+        implied = implied[~implied[date].isin(dates)].drop_duplicates(date)
+        days = pd.concat([days, implied], ignore_index=True).sort_values(date, ignore_index=True)
+        for name in lag_columns:
+            column, k = _parse_lag(name, constant)
+            if not np.allclose(lagged(days, column, k, date)[days[date].isin(dates)],
+                               first[name].to_numpy(dtype=np.float64), equal_nan=True):
+                # Not a calendar-day lag (e.g. previous observed day): keep it as stored
+                days[name] = days[date].map(pd.Series(first[name].to_numpy(), index=dates))
+        for col in days.columns:
+            if col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype):
+                days[col] = pd.Categorical(days[col], categories=df[col].cat.categories)
+
+    day = days[date].searchsorted(dates)[codes]
+    return days, day.astype(np.int16)
+
+
+def from_frame(df, date='Date', columns=None):
+    """DailyPanel of an in-memory transaction frame."""
+    days, day = split_days(df, date, columns)
+    row_columns = [c for c in df.columns
+                   if c != date and c not in days.columns and not _parse_lag(c, days.columns)]
+    return DailyPanel(df[row_columns], days, day, date)
+
+
+# --- Cache ---
+
+def _day_cache_paths(source_path, float_dtype='float32'):
+    folder = os.path.join(os.path.dirname(os.path.abspath(source_path)), CACHE_DIR)
+    # One daily table per float dtype, as the columnar caches
+    stem = os.path.splitext(os.path.basename(source_path))[0] + '.' + float_dtype
+    return (os.path.join(folder, stem + '.days.parquet'), os.path.join(folder, stem + '.day_index.npy'),
+            os.path.join(folder, stem + '.days.json'))
+
+
+def build_day_cache(source_path, date='Date', float_dtype='float32'):
+    """Write the daily table and the day index of a .dta file next to its columnar cache."""
+    meta = cache_metadata(source_path, float_dtype=float_dtype)
+    days_path, index_path, meta_path = _day_cache_paths(source_path, float_dtype)
+    candidates = [c for c in meta['columns'] if c in DAY_COLUMNS or LAG_PATTERN.match(c)]
+    days, day = split_days(load_data(source_path, columns=[date] + candidates, float_dtype=float_dtype), date)
+    days.to_parquet(days_path, index=False)
+    np.save(index_path, day)
+    # Candidates that vary within a day stay in the columnar cache (read as transaction columns)
+    stored = [c for c in [date] + candidates if c in days.columns or _parse_lag(c, days.columns)]
+    day_meta = {'source': meta['source'], 'version': DAY_CACHE_VERSION, 'day_columns': list(days.columns),
+                'stored_columns': stored}
+    with open(meta_path, 'w') as f:
+        json.dump(day_meta, f)
+    return day_meta
+
+
+def day_cache_metadata(source_path, date='Date', float_dtype='float32'):
+    """Metadata of an up-to-date day cache, (re)building it if needed."""
+    meta = cache_metadata(source_path, float_dtype=float_dtype)
+    days_path, index_path, meta_path = _day_cache_paths(source_path, float_dtype)
+    if os.path.exists(meta_path) and os.path.exists(days_path) and os.path.exists(index_path):
+        with open(meta_path) as f:
+            day_meta = json.load(f)
+        if day_meta.get('source') == meta['source'] and day_meta.get('version') == DAY_CACHE_VERSION:
+            return day_meta
+    print(f"Building daily table for '{source_path}'...")
+    return build_day_cache(source_path, date, float_dtype)
+
+
+def load_panel(source_path, columns=None, date='Date', float_dtype='float32'):
+    """
+    Load a Stata panel as a DailyPanel.
+
+    Only the transaction-level `columns` (all by default) are read from the
+    columnar cache; day-level and lag columns come from the daily table,
+    whichever of them are requested.
+    """
+    day_meta = day_cache_metadata(source_path, date, float_dtype)
+    days_path, index_path, _ = _day_cache_paths(source_path, float_dtype)
+    stored = set(day_meta['stored_columns'])
+    meta = cache_metadata(source_path, float_dtype=float_dtype)
+    if columns is None:
+        row_columns = [c for c in meta['columns'] if c not in stored]
+    else:
+        row_columns = [c for c in columns if c not in stored]
+    rows = load_data(source_path, columns=row_columns, float_dtype=float_dtype)
+    days = pd.read_parquet(days_path)
+    # Parquet does not keep the categories of the pre-sample rows: restore the cache's levels
+    for col, levels in meta['categories'].items():
+        if col in days.columns:
+            days[col] = pd.Categorical(days[col], categories=levels)
+    return DailyPanel(rows, days, np.load(index_path, mmap_mode='r'), date)
+
+
+# --- Regression on day-level regressors ---
+
+def _day_design(panel, x, factors, day_n):
+    """Day-level design (one row per day) and column names; factor levels are those present in the sample."""
+    columns, names = [], []
+    for col in x:
+        columns.append(panel.daily(col).to_numpy(dtype=np.float64))
+        names.append(col)
+    for col in factors:
+        values = panel.daily(col)
+        levels = np.sort(np.asarray(values[day_n > 0].dropna().unique()))
+        for level in levels[1:]:
+            columns.append((values.to_numpy() == level).astype(np.float64))
+            names.append(f'{col}_{level}')
+    return np.column_stack(columns), names
+
+
+def fit_day_level(panel, y, x, factors=(), absorb='card', subset=None):
+    """
+    `areg y x i.factors, absorb(absorb)` when every regressor is day-level.
+
+    The transaction-level design is never formed. With D the day-level design,
+    n_d the rows per day and N the (card x day) count matrix,
+        Z'Z = D' diag(n_d) D,   s_c = (N D)_c,   Z~'Z~ = Z'Z - sum_c s_c s_c' / n_c,
+    and the same for y using per-day and per-card sums. Cost is proportional to
+    the number of distinct (card, day) pairs, not rows. Returns an FEResult
+    identical to AbsorbedData.fit, including its listwise deletion of rows
+    with a missing y, absorbed variable, regressor or factor.
+    """
+    yv = panel[y].to_numpy(dtype=np.float64)
+    card, n_cards = group_codes(panel[absorb], allow_missing=True)
+    day_complete = np.logical_and.reduce([panel.daily(col).notna().to_numpy() for col in list(x) + list(factors)])
+    mask = ~np.isnan(yv) & (card >= 0) & day_complete[panel.day]
+    if subset is not None:
+        mask &= np.asarray(subset, dtype=bool)
+    day, yv, card = panel.day[mask], yv[mask], card[mask]
+    n_days = len(panel.days)
+
+    day_n = np.bincount(day, minlength=n_days).astype(np.float64)
+    D, names = _day_design(panel, x, factors, day_n)
+    # Days without rows in the sample (e.g. pre-sample lag dates) carry no weight
+    D[day_n == 0] = 0.0
+    # Center on the sample means (invariant under the absorbed effects, better conditioned)
+    D = D - (day_n @ D) / day_n.sum()
+    y_center = yv.mean()
+    yv = yv - y_center
+
+    N = sparse.csr_matrix((np.ones(len(day)), (card, day)), shape=(n_cards, n_days))
+    card_n = np.asarray(N.sum(axis=1)).ravel()
+    present = card_n > 0
+    S = (N @ D)[present]
+    card_y = np.bincount(card, weights=yv, minlength=n_cards)[present]
+    day_y = np.bincount(day, weights=yv, minlength=n_days)
+    inv_n = 1.0 / card_n[present]
+
+    xtx = D.T @ (D * day_n[:, None]) - S.T @ (S * inv_n[:, None])
+    xty = D.T @ day_y - S.T @ (card_y * inv_n)
+    yty = yv @ yv - card_y @ (card_y * inv_n)
+    n_absorbed = absorbed_dof([card], [card_n])
+    key = 'all' if subset is None else 'subset'
+    return solve_cross_products(xtx, xty, yty, names, len(day), n_absorbed, y, key)
@@ -0,0 +1,474 @@
+# -*- coding: utf-8 -*-
+"""
+Append mode: refresh the baseline models with one new day of transactions.
+
+After a full run (fe_regression.py, '2. Xgboost.py', '3. LightGBM.py'),
+`init` stores what the models need to take in new rows without the history:
+
+- the sufficient statistics of `areg logCash x i.vac i.month i.weekday,
+  absorb(card)`: the pooled cross-products Z'Z of Z = [x, dummies, y] and,
+  per card, the count n_c and the column sums s_c. The within cross-products
+  are Z'Z - sum_c s_c s_c' / n_c, so the coefficients and areg standard
+  errors follow from solve_cross_products. A new day adds its rows to Z'Z
+  and updates only the cards it touches;
+- the saved XGBoost / LightGBM boosters, the one-hot layout they were
+  trained with and the rows of the last WINDOW_DAYS days. `append` continues
+  boosting from them (`rounds` more trees) on this window: a single day has
+  no variation in the day-level variables and a handful of rows per card,
+  too little for a tree to split on;
+- reference values to detect drift.
+
+`append` flags that a full refit is needed when:
+
+- a factor level or too large a share of cards appear that the boosters'
+  one-hot columns do not have (they are read as the reference level);
+- an FE coefficient moved more than `max_shift` standard errors of the
+  last full fit;
+- a model's error on the new day, before it is updated, exceeds the typical
+  error of the first `reference_days` appended days by more than `max_loss_increase`.
+
+Each append reads only the new rows; its cost grows with them, the cards
+they touch and the window, not with the history.
+
+Usage
+-----
+    python daily_update.py init --data data0327.dta --xgb xgb_model.json --lgbm lgbm_model.txt
+    python daily_update.py append day_20191101.dta
+"""
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from data_cache import CACHE_DIR, load_data
+from fe_regression import BASELINE_FACTORS, BASELINE_REGRESSORS, esttab, solve_cross_products
+from features import CATEGORICAL_FEATURES, NUMERICAL_FEATURES, TARGET_VARIABLE, FeatureEncoder
+
+# More boosting rounds per appended day
+DAILY_ROUNDS = 10
+# Recent days the boosters continue training on
+WINDOW_DAYS = 7
+# Drift thresholds
+MAX_SHIFT = 3.0
+MAX_NEW_CARD_SHARE = 0.05
+MAX_LOSS_INCREASE = 0.25
+REFERENCE_DAYS = 7
+
+
+class FEStats:
+    """
+    Sufficient statistics of `areg y x i.factors, absorb(card)` that can be
+    updated with new rows.
+
+    Columns are shifted by their means in the first batch (the within
+    transformation does not depend on the shift), which keeps the
+    Z'Z - sum_c s_c s_c' / n_c difference accurate. Factor levels first seen
+    in a later batch get a new dummy column; the base level stays the lowest
+    level of the first batch.
+    """
+
+    def __init__(self, y=TARGET_VARIABLE, x=BASELINE_REGRESSORS, factors=BASELINE_FACTORS, absorb='card'):
+        self.y = y
+        self.x = list(x)
+        self.factors = list(factors)
+        self.absorb = absorb
+        self.levels = {}
+        # (factor, level) of each dummy column, in column order
+        self.dummies = []
+        self.shift = None
+        self.cards = pd.Index([])
+        self.ztz = None
+        self.card_sums = None
+        self.card_n = np.zeros(0)
+        self.between = None
+        self.nobs = 0
+
+    @classmethod
+    def from_frame(cls, df, **spec):
+        return cls(**spec).update(df)
+
+    def _design(self, df, register=True):
+        """
+        Shifted [x, dummies, y] of the rows. With `register` (new rows taken
+        in), new factor levels first get a column; otherwise unseen or missing
+        levels are read as the base level and the statistics are left as they are.
+        """
+        for col in self.factors if register else []:
+            values = np.sort(np.asarray(pd.unique(df[col].dropna())).astype(np.int64))
+            if col not in self.levels:
+                self.levels[col] = [int(v) for v in values]
+                self.dummies.extend((col, level) for level in self.levels[col][1:])
+            else:
+                for level in values:
+                    if int(level) not in self.levels[col]:
+                        self.levels[col].append(int(level))
+                        self._add_column(col, int(level))
+
+        columns = [df[col].to_numpy(dtype=np.float64) for col in self.x]
+        # As float, a missing factor matches no dummy
+        factors = {col: df[col].to_numpy(dtype=np.float64) for col in self.factors}
+        columns.extend((factors[col] == level).astype(np.float64) for col, level in self.dummies)
+        columns.append(df[self.y].to_numpy(dtype=np.float64))
+        Z = np.column_stack(columns)
+        if self.shift is None:
+            self.shift = np.zeros(Z.shape[1])
+            self.shift[:len(self.x)] = Z[:, :len(self.x)].mean(axis=0)
+            self.shift[-1] = Z[:, -1].mean()
+            q = Z.shape[1]
+            self.ztz = np.zeros((q, q))
+            self.between = np.zeros((q, q))
+            self.card_sums = np.zeros((0, q))
+        return Z - self.shift
+
+    @property
+    def names(self):
+        return self.x + [f'{col}_{level}' for col, level in self.dummies]
+
+    def _add_column(self, col, level):
+        # A new dummy is zero on every earlier row: pad the statistics before y
+        p = len(self.x) + len(self.dummies)
+        self.dummies.append((col, level))
+        if self.shift is None:
+            return
+        self.shift = np.insert(self.shift, p, 0.0)
+        self.ztz = np.insert(np.insert(self.ztz, p, 0.0, axis=0), p, 0.0, axis=1)
+        self.between = np.insert(np.insert(self.between, p, 0.0, axis=0), p, 0.0, axis=1)
+        self.card_sums = np.insert(self.card_sums, p, 0.0, axis=1)
+
+    def update(self, df):
+        """Add new rows (rows with a missing value are dropped, as areg does)."""
+        df = df.dropna(subset=[self.y, self.absorb] + self.x + self.factors)
+        Z = self._design(df)
+        cards = df[self.absorb].to_numpy()
+        new_cards = pd.Index(pd.unique(cards)).difference(self.cards)
+        if len(new_cards):
+            self.cards = self.cards.append(new_cards)
+            self.card_sums = np.vstack([self.card_sums, np.zeros((len(new_cards), Z.shape[1]))])
+            self.card_n = np.concatenate([self.card_n, np.zeros(len(new_cards))])
+
+        codes = self.cards.get_indexer(cards)
+        touched, local = np.unique(codes, return_inverse=True)
+        sums = np.zeros((len(touched), Z.shape[1]))
+        np.add.at(sums, local, Z)
+        old_sums, old_n = self.card_sums[touched], self.card_n[touched]
+        seen = old_n > 0
+        # Replace the touched cards' terms of sum_c s_c s_c' / n_c
+        self.between -= (old_sums[seen] / old_n[seen, None]).T @ old_sums[seen]
+        new_sums, new_n = old_sums + sums, old_n + np.bincount(local, minlength=len(touched))
+        self.between += (new_sums / new_n[:, None]).T @ new_sums
+        self.card_sums[touched], self.card_n[touched] = new_sums, new_n
+        self.ztz += Z.T @ Z
+        self.nobs += len(Z)
+        return self
+
+    def fit(self):
+        """FEResult of the rows added so far (same as AbsorbedData.fit on them)."""
+        within = self.ztz - self.between
+        p = len(self.names)
+        return solve_cross_products(within[:p, :p], within[:p, p], within[p, p], self.names, self.nobs,
+                                    int((self.card_n > 0).sum()), self.y, 'all')
+
+    def predict(self, df, result):
+        """
+        Fitted values x'b + card effect for new rows (cards not seen yet get the
+        average effect, factor levels not seen yet the base level). Does not change the statistics.
+        """
+        Z = self._design(df, register=False)
+        beta = result.params.reindex(self.names).fillna(0.0).to_numpy()
+        effects = np.divide(self.card_sums[:, -1] - self.card_sums[:, :-1] @ beta, self.card_n,
+                            out=np.zeros(len(self.card_n)), where=self.card_n > 0)
+        codes = self.cards.get_indexer(df[self.absorb].to_numpy())
+        mean_effect = effects @ self.card_n / self.card_n.sum()
+        card_effect = np.where(codes >= 0, effects[np.maximum(codes, 0)], mean_effect)
+        return Z[:, :-1] @ beta + card_effect + self.shift[-1]
+
+    def save(self, stem):
+        np.savez(stem + '.fe.npz', shift=self.shift, ztz=self.ztz, card_sums=self.card_sums, card_n=self.card_n,
+                 between=self.between, cards=self.cards.to_numpy())
+        with open(stem + '.fe.json', 'w') as f:
+            json.dump({'y': self.y, 'x': self.x, 'factors': self.factors, 'absorb': self.absorb,
+                       'levels': self.levels, 'dummies': self.dummies, 'nobs': self.nobs}, f)
+
+    @classmethod
+    def load(cls, stem):
+        with open(stem + '.fe.json') as f:
+            meta = json.load(f)
+        stats = cls(meta['y'], meta['x'], meta['factors'], meta['absorb'])
+        stats.levels, stats.nobs = meta['levels'], meta['nobs']
+        stats.dummies = [(col, level) for col, level in meta['dummies']]
+        arrays = np.load(stem + '.fe.npz', allow_pickle=False)
+        stats.shift, stats.ztz, stats.between = arrays['shift'], arrays['ztz'], arrays['between']
+        stats.card_sums, stats.card_n = arrays['card_sums'], arrays['card_n']
+        stats.cards = pd.Index(arrays['cards'])
+        return stats
+
+
+# --- Boosters ---
+# LightGBM settings kept from the saved model when boosting continues (the file
+# also records run-time settings such as num_iterations and num_threads)
+LGB_CONTINUE_KEYS = ['objective', 'learning_rate', 'num_leaves', 'max_depth', 'min_data_in_leaf',
+                     'min_sum_hessian_in_leaf', 'lambda_l1', 'lambda_l2', 'min_gain_to_split',
+                     'feature_fraction', 'bagging_fraction', 'bagging_freq', 'max_bin', 'seed']
+
+
+def _continue_xgboost(path, X, y, feature_names, rounds):
+    import xgboost as xgb
+    booster = xgb.Booster(model_file=path)
+    # '2. Xgboost.py' stores the training hyperparameters in the model file
+    params = json.loads(booster.attr('params') or '{}')
+    dtrain = xgb.DMatrix(X, label=y, feature_names=feature_names)
+    booster = xgb.train(params, dtrain, num_boost_round=rounds, xgb_model=booster)
+    booster.save_model(path)
+
+
+def _continue_lightgbm(path, X, y, feature_names, rounds):
+    import lightgbm as lgb
+    saved = lgb.Booster(model_file=path).params
+    params = {key: saved[key] for key in LGB_CONTINUE_KEYS if key in saved}
+    params.update(verbose=-1, feature_pre_filter=False)
+    train_set = lgb.Dataset(X, label=y, feature_name=feature_names, params=params)
+    booster = lgb.train(params, train_set, num_boost_round=rounds, init_model=path)
+    booster.save_model(path)
+
+
+def _predict_booster(kind, path, X, feature_names):
+    if kind == 'xgb':
+        import xgboost as xgb
+        return xgb.Booster(model_file=path).inplace_predict(X)
+    import lightgbm as lgb
+    return lgb.Booster(model_file=path).predict(X)
+
+
+# --- Updater ---
+
+def state_dir(source_path):
+    """Folder of the append-mode state of a .dta file (next to its columnar cache)."""
+    folder = os.path.join(os.path.dirname(os.path.abspath(source_path)), CACHE_DIR)
+    return os.path.join(folder, os.path.splitext(os.path.basename(source_path))[0] + '.daily')
+
+
+def read_rows(path, columns=None):
+    """New transactions from a .dta, .parquet or .csv file."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.dta':
+        return pd.read_stata(path, columns=columns, convert_categoricals=False)
+    if ext == '.parquet':
+        return pd.read_parquet(path, columns=columns)
+    if ext == '.csv':
+        return pd.read_csv(path, usecols=columns, parse_dates=['Date'])
+    raise ValueError(f"Error: cannot read '{path}', expected a .dta, .parquet or .csv file.")
+
+
+def _save_window(df, columns, folder):
+    # Plain values instead of the cache's categoricals, so new rows concatenate
+    window = df[columns].copy()
+    for col in window.columns:
+        if isinstance(window[col].dtype, pd.CategoricalDtype):
+            window[col] = window[col].astype(window[col].cat.categories.dtype)
+    window.to_parquet(os.path.join(folder, 'window.parquet'), index=False)
+
+
+def _rmse(y, prediction):
+    residual = np.asarray(y, dtype=np.float64) - prediction
+    return float(np.sqrt(np.mean(residual ** 2)))
+
+
+class DailyUpdater:
+    """
+    Append-mode state of the FE regression and the boosted models.
+
+    Created by `initialize` after a full fit, then refreshed one day at a time
+    with `append`.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, 'state.json')) as f:
+            self.state = json.load(f)
+        self.fe = FEStats.load(os.path.join(folder, 'baseline'))
+        self.encoder = FeatureEncoder(self.state['numerical'], self.state['categorical'])
+        self.encoder.fit(None, levels=self.state['encoder_levels'])
+
+    @classmethod
+    def initialize(cls, source_path, xgb_model=None, lgbm_model=None, rounds=DAILY_ROUNDS,
+                   numerical_features=None, categorical_features=None):
+        """
+        Store the sufficient statistics of the full history of `source_path`
+        and copy the saved boosters (trained on the one-hot matrix of
+        features.py, i.e. with STREAMING = False). Run again after every full
+        refit.
+        """
+        numerical_features = list(numerical_features or NUMERICAL_FEATURES)
+        categorical_features = list(categorical_features or CATEGORICAL_FEATURES)
+        folder = state_dir(source_path)
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+        os.makedirs(folder)
+        columns = ['Date', TARGET_VARIABLE, 'card'] + BASELINE_REGRESSORS + BASELINE_FACTORS
+        columns += [c for c in numerical_features + categorical_features if c not in columns]
+        # float64 like fe_regression.py, so the coefficients match its tables
+        df = load_data(source_path, columns=columns, float_dtype='float64')
+        # One-hot layout of the boosters: the categories of the data they were trained on
+        encoder = FeatureEncoder(numerical_features, categorical_features).fit(df)
+        fe = FEStats.from_frame(df)
+        fe.save(os.path.join(folder, 'baseline'))
+        reference = fe.fit()
+        last = df['Date'].max()
+        _save_window(df[df['Date'] > last - pd.Timedelta(days=WINDOW_DAYS)], columns, folder)
+
+        boosters = {}
+        for kind, path in (('xgb', xgb_model), ('lgbm', lgbm_model)):
+            if path is not None:
+                target = os.path.join(folder, os.path.basename(path))
+                shutil.copy2(path, target)
+                boosters[kind] = target
+        state = {
+            'source': source_path,
+            'last_date': str(last),
+            'columns': columns,
+            'rounds': rounds,
+            'numerical': numerical_features,
+            'categorical': categorical_features,
+            'encoder_levels': {col: [int(v) for v in levels] for col, levels in encoder.levels_.items()},
+            'boosters': boosters,
+            'reference': {'params': reference.params.to_dict(), 'bse': reference.bse.to_dict()},
+            'day_losses': {},
+            'days': 0,
+        }
+        with open(os.path.join(folder, 'state.json'), 'w') as f:
+            json.dump(state, f, indent=2)
+        return cls(folder)
+
+    def _loss_flag(self, model, loss, flags, max_loss_increase, reference_days):
+        history = self.state['day_losses'].setdefault(model, [])
+        if len(history) >= reference_days:
+            reference = float(np.median(history[:reference_days]))
+            if loss > (1 + max_loss_increase) * reference:
+                flags.append(f"{model}: error on the new day {loss:.4f} is above the reference {reference:.4f}")
+        history.append(loss)
+
+    def append(self, df, max_shift=MAX_SHIFT, max_new_card_share=MAX_NEW_CARD_SHARE,
+               max_loss_increase=MAX_LOSS_INCREASE, reference_days=REFERENCE_DAYS):
+        """
+        Take in the rows of one or more new days. Returns a report dict with
+        the refreshed coefficients, the errors on the new rows and the drift
+        flags ('needs_refit' is True when there is any).
+        """
+        # Rows with a missing value are dropped, as areg does and as the boosters need
+        # (a missing label stops XGBoost and a missing error hides the drift flags)
+        columns = ['Date', self.fe.y, self.fe.absorb] + self.fe.x + self.fe.factors
+        columns += [c for c in self.encoder.numerical_features + self.encoder.categorical_features
+                    if c not in columns]
+        n_rows = len(df)
+        df = df.dropna(subset=columns)
+        if df.empty:
+            raise ValueError("Error: none of the new rows is complete.")
+        last = pd.Timestamp(self.state['last_date'])
+        dates = pd.to_datetime(df['Date'])
+        if (dates <= last).any():
+            raise ValueError(f"Error: rows dated on or before {last.date()} were already taken in.")
+        flags = []
+
+        # Drift of the inputs against the boosters' one-hot layout
+        for col in self.encoder.categorical_features:
+            unseen = self.encoder.codes(df, col) < 0
+            if col == 'card':
+                if unseen.mean() > max_new_card_share:
+                    flags.append(f"card: {unseen.mean():.1%} of the rows are from cards the boosters have not seen")
+            elif unseen.any():
+                levels = sorted(pd.unique(df.loc[unseen, col]).tolist())
+                flags.append(f"{col}: levels {levels} are new to the boosters")
+
+        # Errors on the new rows before updating (out of sample)
+        y = df[TARGET_VARIABLE].to_numpy(dtype=np.float64)
+        losses = {'fe': _rmse(y, self.fe.predict(df, self.fe.fit()))}
+        X = self.encoder.transform(df)
+        for kind, path in self.state['boosters'].items():
+            losses[kind] = _rmse(y, _predict_booster(kind, path, X, self.encoder.feature_names_))
+        for model, loss in losses.items():
+            self._loss_flag(model, loss, flags, max_loss_increase, reference_days)
+
+        # Update the sufficient statistics and refresh the coefficients
+        self.fe.update(df)
+        result = self.fe.fit()
+        reference = self.state['reference']
+        for name in self.fe.x:
+            shift = abs(result.params[name] - reference['params'][name]) / reference['bse'][name]
+            if shift > max_shift:
+                flags.append(f"{name}: coefficient moved {shift:.1f} standard errors since the last full fit")
+
+        # Continue boosting on the last WINDOW_DAYS days
+        window = pd.concat([pd.read_parquet(os.path.join(self.folder, 'window.parquet')),
+                            df[self.state['columns']]], ignore_index=True)
+        window = window[window['Date'] > dates.max() - pd.Timedelta(days=WINDOW_DAYS)]
+        X = self.encoder.transform(window)
+        for kind, path in self.state['boosters'].items():
+            update = _continue_xgboost if kind == 'xgb' else _continue_lightgbm
+            update(path, X, window[TARGET_VARIABLE].to_numpy(dtype=np.float64), self.encoder.feature_names_,
+                   self.state['rounds'])
+        _save_window(window, self.state['columns'], self.folder)
+
+        self.fe.save(os.path.join(self.folder, 'baseline'))
+        self.state['last_date'] = str(dates.max())
+        self.state['days'] += dates.dt.normalize().nunique()
+        with open(os.path.join(self.folder, 'state.json'), 'w') as f:
+            json.dump(self.state, f, indent=2)
+
+        report = {
+            'last_date': self.state['last_date'],
+            'rows': len(df),
+            'dropped': n_rows - len(df),
+            'nobs': self.fe.nobs,
+            'params': {name: float(result.params[name]) for name in self.fe.x},
+            'losses': losses,
+            'flags': flags,
+            'needs_refit': bool(flags),
+        }
+        with open(os.path.join(self.folder, 'log.jsonl'), 'a') as f:
+            f.write(json.dumps(report) + '\n')
+        self.result = result
+        return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Append new days to the baseline FE and boosted models.")
+    sub = parser.add_subparsers(dest='command', required=True)
+    init = sub.add_parser('init', help="Store the state after a full refit")
+    init.add_argument('--data', default='data0327.dta')
+    init.add_argument('--xgb', default=None, help="Saved XGBoost model (xgb_model.json)")
+    init.add_argument('--lgbm', default=None, help="Saved LightGBM model (lgbm_model.txt)")
+    init.add_argument('--rounds', type=int, default=DAILY_ROUNDS, help="Boosting rounds added per append")
+    append = sub.add_parser('append', help="Take in new days")
+    append.add_argument('files', nargs='+', help="New transactions (.dta, .parquet or .csv), oldest first")
+    append.add_argument('--data', default='data0327.dta', help="Data file the state was initialised from")
+    args = parser.parse_args(argv)
+
+    if args.command == 'init':
+        updater = DailyUpdater.initialize(args.data, xgb_model=args.xgb, lgbm_model=args.lgbm, rounds=args.rounds)
+        print(f"Append-mode state saved in '{updater.folder}' ({updater.fe.nobs} rows, "
+              f"last day {updater.state['last_date']})")
+        return
+    folder = state_dir(args.data)
+    if not os.path.exists(os.path.join(folder, 'state.json')):
+        raise ValueError(f"Error: no append-mode state for '{args.data}', run 'python daily_update.py init' first.")
+    updater = DailyUpdater(folder)
+    reference = updater.fe.fit()
+    for path in args.files:
+        report = updater.append(read_rows(path))
+        print(f"\n{path}: {report['rows']} rows ({report['dropped']} incomplete rows dropped), "
+              f"last day {report['last_date'][:10]}, "
+              f"errors " + ', '.join(f"{k} {v:.4f}" for k, v in report['losses'].items()))
+        for flag in report['flags']:
+            print(f"  DRIFT  {flag}")
+    print(esttab({'before': reference, 'now': updater.result}, keep=BASELINE_REGRESSORS))
+    with open(os.path.join(folder, 'log.jsonl')) as f:
+        needs_refit = any(json.loads(line)['needs_refit'] for line in f)
+    if needs_refit:
+        print("\nA full refit is recommended (see the DRIFT lines); run 'init' again afterwards.")
+
+
+if __name__ == '__main__':
+    main()
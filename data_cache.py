@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Shared loader for the transaction panels (data0327.dta, Eatingout.dta).
+
+The first call converts the Stata file into a columnar Parquet cache with
+downcast dtypes and categorical ID/grouping columns. Later calls read only the
+requested columns from the memory-mapped cache instead of re-parsing the .dta.
+The cache is rebuilt automatically when the source file changes.
+
+There is one cache per float dtype ('float32' for the ML scripts and figures,
+'float64' for the regressions), so scripts reading different dtypes do not
+rebuild each other's cache.
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# --- CONFIGURATION ---
+
+# Cache files live in this folder next to the source .dta file
+CACHE_DIR = '.dta_cache'
+# Bump this when the on-disk layout changes so old caches are rebuilt
+CACHE_VERSION = 1
+# Columns stored as pandas categoricals (matched case-insensitively, the
+# Stata files use both 'Meal' and 'meal')
+CATEGORICAL_COLUMNS = ['card', 'month', 'weekday', 'vacation', 'Meal', 'Gender', 'Type']
+# Rows read from the .dta file per chunk while building the cache
+READ_CHUNK_SIZE = 1_000_000
+# Rows per Parquet row group (the unit of a column read)
+ROW_GROUP_SIZE = 1_000_000
+
+
+def _cache_paths(source_path, float_dtype='float32'):
+    folder = os.path.join(os.path.dirname(os.path.abspath(source_path)), CACHE_DIR)
+    stem = os.path.splitext(os.path.basename(source_path))[0] + '.' + float_dtype
+    return folder, os.path.join(folder, stem + '.parquet'), os.path.join(folder, stem + '.meta.json')
+
+
+def _fingerprint(source_path):
+    # Size + modification time is enough to notice a replaced or edited file
+    # without hashing several GB of data on every load.
+    stat = os.stat(source_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'version': CACHE_VERSION}
+
+
+def _is_categorical_name(column):
+    return column.lower() in {c.lower() for c in CATEGORICAL_COLUMNS}
+
+
+def _downcast_chunk(chunk, float_dtype):
+    """Shrink one chunk read from the .dta file to compact dtypes."""
+    for col in chunk.columns:
+        series = chunk[col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # Stata value labels: keep the labels, categories are rebuilt later
+            chunk[col] = series.astype(object)
+        elif pd.api.types.is_float_dtype(series.dtype):
+            chunk[col] = series.astype(float_dtype)
+    return chunk
+
+
+def _smallest_int(low, high):
+    for dtype in (np.int8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return dtype
+    return np.int64
+
+
+def build_cache(source_path, float_dtype='float32'):
+    """
+    Convert a .dta file into the Parquet cache and return the cache metadata.
+
+    Two passes, each holding one chunk in memory: the .dta file is parsed
+    once into downcast Parquet parts while the column ranges and category
+    levels are collected, then the parts are rewritten with the final dtypes
+    into the cache through a ParquetWriter.
+    """
+    folder, parquet_path, meta_path = _cache_paths(source_path, float_dtype)
+    os.makedirs(folder, exist_ok=True)
+    parts_dir = parquet_path + '.parts'
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir)
+
+    # Pass 1: parse the .dta file, recording what the final dtypes need
+    parts, columns, floats, ranges, levels = [], None, set(), {}, {}
+    with pd.read_stata(source_path, chunksize=READ_CHUNK_SIZE) as reader:
+        for chunk in reader:
+            chunk = _downcast_chunk(chunk, float_dtype)
+            columns = list(chunk.columns)
+            for col in columns:
+                series = chunk[col]
+                if _is_categorical_name(col):
+                    levels.setdefault(col, set()).update(series.dropna().unique().tolist())
+                elif pd.api.types.is_float_dtype(series.dtype):
+                    # An integer column becomes float in the chunks where it has missing values
+                    floats.add(col)
+                elif pd.api.types.is_integer_dtype(series.dtype) and len(series):
+                    low, high = ranges.get(col, (np.inf, -np.inf))
+                    ranges[col] = (min(low, series.min()), max(high, series.max()))
+            parts.append(os.path.join(parts_dir, f'{len(parts)}.parquet'))
+            chunk.to_parquet(parts[-1], engine='pyarrow', index=False)
+
+    # Integer columns: the smallest type that holds the full column.
+    # Categorical columns: sorted, stable categories.
+    dtypes = {col: float_dtype for col in floats}
+    dtypes.update({col: _smallest_int(*bounds) for col, bounds in ranges.items() if col not in floats})
+    categories = {col: np.sort(np.array(list(values))) for col, values in levels.items()}
+
+    # Pass 2: write to a temporary file first so an interrupted build never
+    # leaves a half-written cache that looks valid.
+    tmp_path = parquet_path + '.tmp'
+    writer = None
+    n_rows = 0
+    try:
+        for part in parts:
+            df = pd.read_parquet(part)
+            for col, dtype in dtypes.items():
+                df[col] = df[col].astype(dtype)
+            for col, values in categories.items():
+                df[col] = pd.Categorical(df[col], categories=values)
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, table.schema)
+            writer.write_table(table.cast(writer.schema), row_group_size=ROW_GROUP_SIZE)
+            n_rows += len(df)
+            os.remove(part)
+    finally:
+        if writer is not None:
+            writer.close()
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    os.replace(tmp_path, parquet_path)
+
+    meta = {
+        'source': _fingerprint(source_path),
+        'float_dtype': float_dtype,
+        'n_rows': n_rows,
+        'columns': columns,
+        'categories': {col: values.tolist() for col, values in categories.items()},
+    }
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def cache_metadata(source_path, float_dtype='float32'):
+    """Return the metadata of an up-to-date cache, (re)building it if needed."""
+    _, parquet_path, meta_path = _cache_paths(source_path, float_dtype)
+    if os.path.exists(parquet_path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get('source') == _fingerprint(source_path) and meta.get('float_dtype') == float_dtype:
+            return meta
+    print(f"Building columnar cache for '{source_path}'...")
+    return build_cache(source_path, float_dtype=float_dtype)
+
+
+def cache_path(source_path, float_dtype='float32'):
+    """Path of the up-to-date Parquet cache for a .dta file."""
+    cache_metadata(source_path, float_dtype=float_dtype)
+    return _cache_paths(source_path, float_dtype)[1]
+
+
+def load_data(source_path, columns=None, float_dtype='float32'):
+    """
+    Load a Stata panel through the columnar cache.
+
+    Parameters
+    ----------
+    source_path : str
+        Path to the .dta file.
+    columns : list of str, optional
+        Columns to read. Only these columns are read from disk; None reads all.
+    float_dtype : str
+        Storage type for floating point columns ('float32' or 'float64').
+    """
+    meta = cache_metadata(source_path, float_dtype=float_dtype)
+    _, parquet_path, _ = _cache_paths(source_path, float_dtype)
+
+    if columns is not None:
+        missing = [c for c in columns if c not in meta['columns']]
+        if missing:
+            raise ValueError(f"Error: Column(s) {missing} not found in '{source_path}'. Please check spelling and case.")
+
+    table = pq.read_table(parquet_path, columns=columns, memory_map=True)
+    return _restore_categories(table.to_pandas(), meta)
+
+
+def _restore_categories(df, meta):
+    # Restore the sorted levels recorded at build time, so category codes are
+    # identical across scripts, chunks and runs whatever dictionaries Parquet used.
+    for col, levels in meta['categories'].items():
+        if col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].cat.set_categories(levels)
+            else:
+                df[col] = pd.Categorical(df[col], categories=levels)
+    return df
+
+
+def iter_chunks(source_path, columns=None, chunk_size=1_000_000, float_dtype='float32'):
+    """
+    Stream a Stata panel from the columnar cache in chunks of about
+    `chunk_size` rows, so only one chunk is held in memory at a time.
+
+    Categorical columns carry the full-file levels in every chunk.
+    """
+    meta = cache_metadata(source_path, float_dtype=float_dtype)
+    _, parquet_path, _ = _cache_paths(source_path, float_dtype)
+    parquet = pq.ParquetFile(parquet_path, memory_map=True)
+    for batch in parquet.iter_batches(batch_size=chunk_size, columns=columns):
+        yield _restore_categories(batch.to_pandas(), meta)
+
+
+def row_group_sizes(source_path, float_dtype='float32'):
+    """Number of rows in each Parquet row group of the cache."""
+    parquet = pq.ParquetFile(cache_path(source_path, float_dtype=float_dtype))
+    return [parquet.metadata.row_group(i).num_rows for i in range(parquet.num_row_groups)]
+
+
+def iter_row_group(source_path, index, columns=None, chunk_size=1_000_000, float_dtype='float32'):
+    """Stream one row group of the cache in chunks of `chunk_size` rows (the last one shorter)."""
+    meta = cache_metadata(source_path, float_dtype=float_dtype)
+    _, parquet_path, _ = _cache_paths(source_path, float_dtype)
+    parquet = pq.ParquetFile(parquet_path, memory_map=True)
+    for batch in parquet.iter_batches(batch_size=chunk_size, row_groups=[index], columns=columns):
+        yield _restore_categories(batch.to_pandas(), meta)
+
+
+def read_row_group(source_path, index, columns=None, float_dtype='float32'):
+    """Read one row group of the cache (random access by chunk)."""
+    meta = cache_metadata(source_path, float_dtype=float_dtype)
+    _, parquet_path, _ = _cache_paths(source_path, float_dtype)
+    table = pq.ParquetFile(parquet_path, memory_map=True).read_row_group(index, columns=columns)
+    return _restore_categories(table.to_pandas(), meta)
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+Python equivalent of Stata's `areg y x i.vac i.month i.weekday, absorb(card)`.
+
+The absorbed effects are removed with the within-transformation (one absorbed
+variable) or alternating projections (several absorbed variables), computed
+column by column with np.bincount. Demeaned columns are cached per estimation
+sample and absorbed effect, so the Table 2-6 specifications that share a sample
+only demean each variable once.
+
+Example
+-------
+    fe = AbsorbedData(df, absorb='card')
+    bs5 = fe.fit('logCash', ['logPM', 'logPre', 'rh', 'awin', 'ctemp'],
+                 factors=['vacation', 'month', 'weekday'])
+    meal1 = fe.fit('logCash', [...], factors=[...], subset=df['Meal'] == 1)
+    print(esttab({'bs5': bs5, 'meal1': meal1}, keep=['logPM', 'ctemp']))
+"""
+import hashlib
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# Regressors of the baseline expenditure model (Table 2, model bs5)
+BASELINE_REGRESSORS = ['logPM', 'logPre', 'rh', 'awin', 'ctemp']
+BASELINE_FACTORS = ['vacation', 'month', 'weekday']
+
+
+def group_codes(values, allow_missing=False):
+    """
+    Integer codes (0..G-1) for a grouping column, categorical or not.
+
+    Missing values raise, or get code -1 with `allow_missing=True`.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, n_groups = values.cat.codes.to_numpy(), len(values.cat.categories)
+    else:
+        codes, uniques = pd.factorize(values, sort=True)
+        n_groups = len(uniques)
+    if not allow_missing and (codes < 0).any():
+        raise ValueError("Error: Missing values in an absorbed variable.")
+    return codes.astype(np.int64), n_groups
+
+
+def _group_means(x, codes, counts):
+    sums = np.bincount(codes, weights=x, minlength=len(counts))
+    return sums / np.where(counts > 0, counts, 1)
+
+
+def demean(x, codes_list, counts_list, tol=1e-10, maxiter=10000):
+    """
+    Remove the group means of one or more grouping variables from `x`.
+
+    With a single grouping variable this is the exact within-transformation.
+    With several, the group means are swept out in turn (alternating
+    projections) until the largest change falls below `tol`.
+    """
+    x = np.array(x, dtype=np.float64)
+    if len(codes_list) == 1:
+        x -= _group_means(x, codes_list[0], counts_list[0])[codes_list[0]]
+        return x
+    for _ in range(maxiter):
+        largest_step = 0.0
+        for codes, counts in zip(codes_list, counts_list):
+            means = _group_means(x, codes, counts)
+            largest_step = max(largest_step, np.abs(means).max())
+            x -= means[codes]
+        if largest_step < tol:
+            return x
+    raise RuntimeError(f"Alternating projections did not converge in {maxiter} iterations.")
+
+
+def absorbed_dof(codes_list, counts_list):
+    """Degrees of freedom used by the absorbed effects (as areg / reghdfe count them)."""
+    levels = [int((counts > 0).sum()) for counts in counts_list]
+    if len(codes_list) == 1:
+        return levels[0]
+    if len(codes_list) == 2:
+        # Two effects: one redundant level per connected component of the
+        # bipartite graph linking the two sets of groups.
+        a, b = codes_list
+        n_a = len(counts_list[0])
+        graph = coo_matrix((np.ones(len(a)), (a, b + n_a)),
+                           shape=(n_a + len(counts_list[1]),) * 2)
+        n_components, labels = connected_components(graph, directed=False)
+        used = np.concatenate([counts_list[0] > 0, counts_list[1] > 0])
+        return sum(levels) - len(np.unique(labels[used]))
+    # Three or more effects: conservative count, one redundant level per extra effect
+    return sum(levels) - (len(levels) - 1)
+
+
+def independent_columns(xtx, tol=1e-9):
+    """Positions of a maximal set of linearly independent columns (Stata's 'omitted')."""
+    keep = []
+    for j in range(xtx.shape[0]):
+        diag = xtx[j, j]
+        if diag <= 0:
+            continue
+        if keep:
+            b = xtx[keep, j]
+            resid = diag - b @ np.linalg.solve(xtx[np.ix_(keep, keep)], b)
+        else:
+            resid = diag
+        if resid > tol * diag:
+            keep.append(j)
+    return keep
+
+
+class FEResult:
+    """
+    Coefficients and standard errors of one specification.
+
+    The covariance is areg's default (vce='ols') unless replaced with
+    `with_cov` (cluster_inference.cluster_cov); `df_t` is the degrees of
+    freedom of the t distribution used for p-values and intervals.
+    """
+
+    def __init__(self, params, cov, nobs, df_resid, rss, tss_within, n_absorbed, depvar, sample_key,
+                 vce='ols', df_t=None):
+        self.params = params
+        self.cov = cov
+        self.vce = vce
+        self.df_t = df_resid if df_t is None else df_t
+        self.bse = pd.Series(np.sqrt(np.diag(cov)), index=params.index)
+        self.tvalues = params / self.bse
+        self.pvalues = pd.Series(2 * stats.t.sf(np.abs(self.tvalues), self.df_t), index=params.index)
+        self.nobs = nobs
+        self.df_resid = df_resid
+        self.rss = rss
+        self.r2_within = 1 - rss / tss_within if tss_within > 0 else np.nan
+        self.n_absorbed = n_absorbed
+        self.depvar = depvar
+        self.sample_key = sample_key
+        self.tss_within = tss_within
+
+    def with_cov(self, cov, vce, df_t):
+        """The same estimates with another covariance matrix."""
+        return FEResult(self.params, cov, self.nobs, self.df_resid, self.rss, self.tss_within, self.n_absorbed,
+                        self.depvar, self.sample_key, vce=vce, df_t=df_t)
+
+    def summary(self):
+        """Coefficient table as a DataFrame."""
+        ci = stats.t.ppf(0.975, self.df_t) * self.bse
+        return pd.DataFrame({
+            'coef': self.params, 'std err': self.bse, 't': self.tvalues, 'P>|t|': self.pvalues,
+            '[0.025': self.params - ci, '0.975]': self.params + ci,
+        })
+
+    def __repr__(self):
+        return f"FEResult({self.depvar}, N={self.nobs}, absorbed={self.n_absorbed}, vce={self.vce})\n{self.summary()}"
+
+
+def solve_cross_products(xtx, xty, yty, names, nobs, n_absorbed, depvar, sample_key):
+    """
+    OLS on within-transformed data, given its cross-products.
+
+    `xtx`, `xty` and `yty` are X~'X~, X~'y~ and y~'y~. Collinear columns are
+    dropped; the residual degrees of freedom subtract the absorbed levels as
+    areg does.
+    """
+    keep = independent_columns(xtx)
+    names = [names[i] for i in keep]
+    xtx = xtx[np.ix_(keep, keep)]
+    xty = xty[keep]
+    xtx_inv = np.linalg.inv(xtx)
+    beta = xtx_inv @ xty
+
+    rss = yty - beta @ xty
+    df_resid = nobs - len(keep) - n_absorbed
+    sigma2 = rss / df_resid
+
+    params = pd.Series(beta, index=names)
+    cov = pd.DataFrame(sigma2 * xtx_inv, index=names, columns=names)
+    return FEResult(params, cov, nobs, df_resid, rss, yty, n_absorbed, depvar, sample_key)
+
+
+def fit_within(y_tilde, columns, n_absorbed, depvar='y', sample_key=None):
+    """
+    OLS of a demeaned y on demeaned columns (dict name -> array).
+
+    Cross-products are formed column by column, without stacking a copy of
+    the design.
+    """
+    names = list(columns)
+    vectors = [columns[n] for n in names]
+    k = len(vectors)
+    xtx = np.empty((k, k))
+    xty = np.empty(k)
+    for i in range(k):
+        xty[i] = vectors[i] @ y_tilde
+        for j in range(i, k):
+            xtx[i, j] = xtx[j, i] = vectors[i] @ vectors[j]
+    return solve_cross_products(xtx, xty, y_tilde @ y_tilde, names, len(y_tilde), n_absorbed, depvar, sample_key)
+
+
+class AbsorbedData:
+    """
+    A dataset with one or more absorbed fixed effects.
+
+    Demeaned columns are cached per (estimation sample, variable); every
+    specification fitted on the same sample reuses them. Call `clear_cache()`
+    to release the memory.
+
+    As areg, a specification is estimated on the rows where y, the regressors,
+    the factors and the absorbed variables are all non-missing.
+
+    `df` is a DataFrame or a daily_panel.DailyPanel; with a panel, the
+    day-level columns are broadcast to the transactions one at a time, when
+    they are demeaned.
+    """
+
+    def __init__(self, df, absorb='card'):
+        self.df = df
+        self.absorb = [absorb] if isinstance(absorb, str) else list(absorb)
+        codes = [group_codes(df[col], allow_missing=True) for col in self.absorb]
+        self._codes = [c for c, _ in codes]
+        self._n_groups = [g for _, g in codes]
+        # Rows with every absorbed variable present
+        self._absorb_present = np.logical_and.reduce([c >= 0 for c in self._codes])
+        self._samples = {}
+        self._cache = {}
+
+    # --- Estimation samples ---
+
+    def sample(self, subset=None, columns=()):
+        """
+        Return (key, row positions or None, codes, counts) for a subset mask.
+
+        Rows with a missing value in any of `columns` or in an absorbed
+        variable are left out (listwise deletion).
+        """
+        mask = self._absorb_present.copy()
+        if subset is not None:
+            mask &= np.asarray(subset, dtype=bool)
+        if len(columns):
+            for col in columns:
+                mask &= self.df[col].notna().to_numpy()
+        if mask.all():
+            mask = None
+            key = 'all'
+        else:
+            key = hashlib.blake2b(np.packbits(mask).tobytes(), digest_size=16).hexdigest()
+        if key not in self._samples:
+            rows = None if mask is None else np.flatnonzero(mask)
+            codes = [c if rows is None else c[rows] for c in self._codes]
+            counts = [np.bincount(c, minlength=g).astype(np.float64) for c, g in zip(codes, self._n_groups)]
+            self._samples[key] = (rows, codes, counts)
+        return (key,) + self._samples[key]
+
+    def _raw(self, column, rows):
+        values = self.df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(np.float64)
+        values = values.to_numpy(dtype=np.float64)
+        return values if rows is None else values[rows]
+
+    def _indicator(self, column, level, rows):
+        values = self.df[column].to_numpy()
+        if rows is not None:
+            values = values[rows]
+        return (values == level).astype(np.float64)
+
+    def demeaned(self, name, raw, key, codes, counts):
+        """Cached within-transformed column `name` for sample `key`."""
+        cache_key = (key, name)
+        if cache_key not in self._cache:
+            self._cache[cache_key] = demean(raw(), codes, counts)
+        return self._cache[cache_key]
+
+    def clear_cache(self):
+        self._cache.clear()
+        self._samples.clear()
+
+    # --- Estimation ---
+
+    def design(self, y, x, factors=(), subset=None):
+        """
+        Demeaned dependent variable and regressors for a specification.
+
+        Factor variables enter as dummies for every level present in the
+        sample except the lowest one (Stata's default base level).
+        """
+        key, rows, codes, counts = self.sample(subset, columns=[y] + list(x) + list(factors))
+        columns = {}
+        y_tilde = self.demeaned(y, lambda: self._raw(y, rows), key, codes, counts)
+        for col in x:
+            columns[col] = self.demeaned(col, lambda col=col: self._raw(col, rows), key, codes, counts)
+        for col in factors:
+            values = self.df[col] if rows is None else self.df[col].iloc[rows]
+            levels = np.sort(np.asarray(values.dropna().unique()))
+            for level in levels[1:]:
+                name = f'{col}_{level}'
+                columns[name] = self.demeaned(
+                    name, lambda col=col, level=level: self._indicator(col, level, rows), key, codes, counts)
+        return key, y_tilde, columns, counts
+
+    def fit(self, y, x, factors=(), subset=None):
+        """
+        Fit `areg y x i.factors [if subset], absorb(...)`.
+
+        Returns an FEResult with the same coefficients and default standard
+        errors as areg (the intercept is not reported). Collinear regressors
+        are dropped, as Stata marks them 'omitted'.
+        """
+        key, y_tilde, columns, counts = self.design(y, x, factors, subset)
+        n_absorbed = absorbed_dof(self._samples[key][1], counts)
+        return fit_within(y_tilde, columns, n_absorbed, depvar=y, sample_key=key)
+
+    def residuals(self, result):
+        """Within residuals of a fitted result (recomputed from the cached columns)."""
+        y_tilde = self._cache[(result.sample_key, result.depvar)]
+        resid = y_tilde.copy()
+        for name, coef in result.params.items():
+            resid -= coef * self._cache[(result.sample_key, name)]
+        return resid
+
+
+def areg(df, y, x, factors=(), absorb='card', subset=None):
+    """One-off `areg`; use AbsorbedData directly to share demeaned columns."""
+    return AbsorbedData(df, absorb=absorb).fit(y, x, factors=factors, subset=subset)
+
+
+def esttab(results, keep=None, digits=3):
+    """
+    Side-by-side coefficient table like Stata's esttab: b(3) se(3) with stars.
+
+    `results` maps model names to FEResult objects.
+    """
+    rows = []
+    index = []
+    variables = keep
+    if variables is None:
+        variables = []
+        for res in results.values():
+            variables.extend(v for v in res.params.index if v not in variables)
+    for var in variables:
+        coef_row, se_row = [], []
+        for res in results.values():
+            if var in res.params.index:
+                p = res.pvalues[var]
+                stars = '***' if p < 0.01 else '**' if p < 0.05 else '*' if p < 0.1 else ''
+                coef_row.append(f"{res.params[var]:.{digits}f}{stars}")
+                se_row.append(f"({res.bse[var]:.{digits}f})")
+            else:
+                coef_row.append('')
+                se_row.append('')
+        rows.extend([coef_row, se_row])
+        index.extend([var, ''])
+    rows.append([f"{res.nobs}" for res in results.values()])
+    index.append('N')
+    return pd.DataFrame(rows, index=index, columns=list(results))
+
+
+if __name__ == '__main__':
+    # Python replication of the areg models of Tables 2-4 and 6 in
+    # '1. Stata_estimate_code.do'. All models share one AbsorbedData object, so
+    # each variable is demeaned once per estimation sample. The weather and
+    # calendar columns are read once per day (daily_panel.py), and the PM2.5
+    # lags are generated from the daily table when the extract has none.
+    from daily_panel import load_panel
+    from profiling import note, section
+
+    section('load')
+    df = load_panel('data0327.dta', float_dtype='float64')
+    note(rows=len(df))
+    section('fit', rows=len(df))
+    fe = AbsorbedData(df, absorb='card')
+    keep = ['logPM', 'ctemp', 'logPre', 'rh', 'awin', 'vacation_1']
+
+    def fit(x=BASELINE_REGRESSORS, subset=None):
+        return fe.fit('logCash', x, factors=BASELINE_FACTORS, subset=subset)
+
+    # Missing month or Type: the row is in none of the subsamples that split on it
+    month = pd.to_numeric(df['month'])
+    type_ = pd.to_numeric(df['Type'])
+    tables = {
+        'table2': {'bs5': fit()},
+        'table3': {'Baseline': fit(),
+                   'Breakfast': fit(subset=df['Meal'] == 1),
+                   'Lunch': fit(subset=df['Meal'] == 2),
+                   'Dinner': fit(subset=df['Meal'] == 3)},
+        'table4': {'male': fit(subset=df['Gender'] == 1),
+                   'female': fit(subset=df['Gender'] == 0),
+                   'und': fit(subset=type_ == 1),
+                   'grd': fit(subset=type_ > 1),
+                   'noheating': fit(subset=(month > 3) & (month < 11)),
+                   'heating': fit(subset=(month <= 3) | (month >= 11))},
+    }
+    # Table 6: daily average and maximum PM2.5 (with the daily average
+    # temperature), then the lagged PM2.5 (stored, or generated from the daily
+    # table). Each check needs its columns, which not every extract carries.
+    robustness = {
+        'Daily PM': ['logAPM', 'logPre', 'rh', 'awin', 'atemp'],
+        'Max PM': ['logMaxPM', 'logPre', 'rh', 'awin', 'atemp'],
+        '1 Day Lagged': ['L1logPM'] + BASELINE_REGRESSORS,
+        '2 day Lagged': ['L2logPM', 'L1logPM'] + BASELINE_REGRESSORS,
+    }
+    robustness = {name: x for name, x in robustness.items() if all(df.has_column(col) for col in x)}
+    if robustness:
+        tables['table6'] = {'Baseline': fit(), **{name: fit(x) for name, x in robustness.items()}}
+
+    # Standard errors clustered two-way, by student and by day (cluster_inference.py)
+    from cluster_inference import cluster_cov, wild_cluster_bootstrap
+
+    section('cluster_se')
+    for name, results in tables.items():
+        table_keep = keep if name != 'table6' else ['logPM', 'L1logPM', 'L2logPM', 'logAPM', 'logMaxPM']
+        table = esttab(results, keep=table_keep)
+        table.to_csv(f'{name}_python.csv')
+        print(f"\n{name}\n{table}")
+        clustered = {model: cluster_cov(fe, res, clusters=['card', 'Date']) for model, res in results.items()}
+        table = esttab(clustered, keep=table_keep)
+        table.to_csv(f'{name}_cluster_python.csv')
+        print(f"\n{name}, clustered by card and Date\n{table}")
+
+    # Wild cluster bootstrap p-values of the baseline model
+    section('bootstrap', rows=tables['table2']['bs5'].nobs)
+    boot = wild_cluster_bootstrap(fe, tables['table2']['bs5'], params=BASELINE_REGRESSORS, clusters=['card', 'Date'])
+    boot.to_csv('table2_bootstrap_python.csv')
+    print(f"\nbs5, wild cluster bootstrap\n{boot}")
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Shared feature matrix builder for the machine learning scripts.
+
+Replaces the dense `pd.get_dummies(..., dtype=int)` + `pd.concat` step. The
+one-hot block for `card` (one column per student) is stored as a scipy.sparse
+CSR matrix, so memory grows with the number of rows instead of
+rows x students. Column names follow the get_dummies(drop_first=True)
+convention (`month_2`, `card_1001`, ...) so importance outputs line up with
+the earlier results. predict_raw and single_thread serve the models fitted on
+this matrix (importance.py, scenarios.py).
+"""
+import copy
+import glob
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from daily_panel import load_panel
+from data_cache import CACHE_DIR, cache_metadata
+
+# Default model specification shared by the three ML scripts
+TARGET_VARIABLE = 'logCash'
+NUMERICAL_FEATURES = ['logPM', 'logPre', 'rh', 'awin', 'ctemp']
+CATEGORICAL_FEATURES = ['vacation', 'month', 'weekday', 'card']
+
+
+class FeatureEncoder:
+    """
+    One-hot encoder with a stable column index.
+
+    `fit` records the category levels of each categorical column; `transform`
+    then always produces the same columns in the same order, whatever subset
+    of rows (or chunk of the file) it is given. Levels not seen by `fit` are
+    encoded as the dropped reference level.
+    """
+
+    def __init__(self, numerical_features=None, categorical_features=None, drop_first=True):
+        self.numerical_features = list(numerical_features or NUMERICAL_FEATURES)
+        self.categorical_features = list(categorical_features or CATEGORICAL_FEATURES)
+        self.drop_first = drop_first
+        self.levels_ = None
+        self.feature_names_ = None
+
+    def fit(self, df, levels=None):
+        """Record category levels from `df` (or use the given `levels` dict)."""
+        self.levels_ = {}
+        for col in self.categorical_features:
+            if levels is not None and col in levels:
+                self.levels_[col] = pd.Index(levels[col])
+            elif isinstance(df[col].dtype, pd.CategoricalDtype):
+                # Columns from data_cache.load_data already carry sorted levels
+                self.levels_[col] = df[col].cat.categories
+            else:
+                self.levels_[col] = pd.Index(np.sort(df[col].dropna().unique()))
+
+        names = list(self.numerical_features)
+        for col in self.categorical_features:
+            kept = self.levels_[col][1:] if self.drop_first else self.levels_[col]
+            names.extend(f'{col}_{level}' for level in kept)
+        self.feature_names_ = names
+        return self
+
+    def codes(self, df, col):
+        """Integer codes of `col` against the fitted levels (-1 for unseen/missing)."""
+        levels = self.levels_[col]
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype) and values.cat.categories.equals(levels):
+            return values.cat.codes.to_numpy()
+        return levels.get_indexer(values)
+
+    def transform(self, df, dtype=np.float32):
+        """Return the CSR feature matrix for `df`."""
+        n_rows = len(df)
+        n_num = len(self.numerical_features)
+
+        # Numerical block: every entry is stored explicitly, including exact
+        # zeros, so XGBoost does not read them as missing values.
+        rows = [np.repeat(np.arange(n_rows), n_num)]
+        cols = [np.tile(np.arange(n_num), n_rows)]
+        data = [df[self.numerical_features].to_numpy(dtype=dtype).ravel()]
+
+        # One-hot blocks: a single 1 per row and variable (none for the
+        # reference level)
+        offset = n_num
+        for col in self.categorical_features:
+            codes = self.codes(df, col)
+            first = 1 if self.drop_first else 0
+            keep = codes >= first
+            rows.append(np.flatnonzero(keep))
+            cols.append(offset + codes[keep] - first)
+            data.append(np.ones(keep.sum(), dtype=dtype))
+            offset += len(self.levels_[col]) - first
+
+        matrix = sp.coo_matrix(
+            (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(n_rows, offset),
+        )
+        return matrix.tocsr()
+
+    def transform_codes(self, df, dtype=np.float64):
+        """
+        Dense array with the numerical columns followed by one integer-code
+        column per categorical variable (NaN for unseen/missing levels), for
+        LightGBM's `categorical_feature`. Column names are
+        numerical_features + categorical_features.
+        """
+        X = np.empty((len(df), len(self.numerical_features) + len(self.categorical_features)), dtype=dtype)
+        X[:, :len(self.numerical_features)] = df[self.numerical_features].to_numpy(dtype=dtype)
+        for j, col in enumerate(self.categorical_features, start=len(self.numerical_features)):
+            codes = self.codes(df, col)
+            X[:, j] = np.where(codes >= 0, codes, np.nan)
+        return X
+
+    def transform_native(self, df):
+        """
+        Return a DataFrame with the numerical columns and one categorical
+        column per variable, for LightGBM / XGBoost native categorical support.
+        """
+        X = df[self.numerical_features].copy()
+        for col in self.categorical_features:
+            X[col] = pd.Categorical.from_codes(self.codes(df, col), categories=self.levels_[col])
+        return X
+
+
+def build_feature_matrix(df, numerical_features=None, categorical_features=None):
+    """
+    Build the sparse feature matrix used by the ML scripts.
+
+    Returns
+    -------
+    X : scipy.sparse.csr_matrix
+    feature_names : list of str
+        Column names in get_dummies(drop_first=True) order.
+    """
+    encoder = FeatureEncoder(numerical_features, categorical_features).fit(df)
+    return encoder.transform(df), encoder.feature_names_
+
+
+def _feature_paths(file_path, numerical_features, categorical_features):
+    spec = {'source': cache_metadata(file_path)['source'], 'numerical': numerical_features,
+            'categorical': categorical_features}
+    key = hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:16]
+    folder = os.path.join(os.path.dirname(os.path.abspath(file_path)), CACHE_DIR)
+    stem = os.path.join(folder, os.path.splitext(os.path.basename(file_path))[0] + '.features')
+    return folder, stem, f'{stem}-{key}.npz', f'{stem}-{key}.json'
+
+
+def load_feature_matrix(file_path, numerical_features=None, categorical_features=None):
+    """
+    build_feature_matrix for a .dta file, cached next to its columnar cache.
+
+    The cached matrix is keyed by the source file fingerprint and the feature
+    lists, so it is rebuilt when either changes.
+    """
+    numerical_features = list(numerical_features or NUMERICAL_FEATURES)
+    categorical_features = list(categorical_features or CATEGORICAL_FEATURES)
+    folder, stem, matrix_path, names_path = _feature_paths(file_path, numerical_features, categorical_features)
+    if os.path.exists(matrix_path) and os.path.exists(names_path):
+        with open(names_path) as f:
+            return sp.load_npz(matrix_path), json.load(f)
+
+    # The day-level columns are read once per day and broadcast here (daily_panel.py)
+    df = load_panel(file_path, columns=numerical_features + categorical_features).frame(
+        numerical_features + categorical_features)
+    X, feature_names = build_feature_matrix(df, numerical_features, categorical_features)
+    # Written under unique temporary names (not matching '{stem}-*') and moved
+    # into place, so concurrent runs never read or replace a partial file
+    with tempfile.NamedTemporaryFile('w', dir=folder, prefix=os.path.basename(stem) + '.tmp', suffix='.json',
+                                     delete=False) as f:
+        json.dump(feature_names, f)
+    os.replace(f.name, names_path)
+    with tempfile.NamedTemporaryFile(dir=folder, prefix=os.path.basename(stem) + '.tmp', suffix='.npz',
+                                     delete=False) as f:
+        sp.save_npz(f, X, compressed=False)
+    os.replace(f.name, matrix_path)
+    # Only the latest feature matrix of a file is kept: remove the ones written
+    # before this one (a newer one belongs to another run)
+    written = os.path.getmtime(matrix_path)
+    for old in glob.glob(f'{stem}-*'):
+        if old not in (matrix_path, names_path) and os.path.getmtime(old) < written:
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                # Removed by a concurrent run
+                pass
+    return X, feature_names
+
+
+def feature_matrix_info(file_path, numerical_features=None, categorical_features=None):
+    """
+    Shape, number of stored entries and bytes (data, indices and indptr) of
+    the cached feature matrix of load_feature_matrix, read from the .npy
+    headers in the .npz file without loading the arrays. The matrix is built
+    and cached first if needed.
+    """
+    numerical_features = list(numerical_features or NUMERICAL_FEATURES)
+    categorical_features = list(categorical_features or CATEGORICAL_FEATURES)
+    _, _, matrix_path, names_path = _feature_paths(file_path, numerical_features, categorical_features)
+    if not (os.path.exists(matrix_path) and os.path.exists(names_path)):
+        load_feature_matrix(file_path, numerical_features, categorical_features)
+    with np.load(matrix_path) as npz:
+        shape = tuple(int(n) for n in npz['shape'])
+    nbytes = 0
+    with zipfile.ZipFile(matrix_path) as archive:
+        for name in ('data', 'indices', 'indptr'):
+            with archive.open(name + '.npy') as f:
+                version = np.lib.format.read_magic(f)
+                read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+                               else np.lib.format.read_array_header_2_0)
+                array_shape, _, dtype = read_header(f)
+            nbytes += int(np.prod(array_shape)) * dtype.itemsize
+            if name == 'data':
+                nnz = int(np.prod(array_shape))
+    return {'shape': shape, 'nnz': nnz, 'nbytes': nbytes}
+
+
+# --- Models fitted on the feature matrix ---
+
+def single_thread(model):
+    """
+    Copy of `model` that predicts on one thread, for a worker process (the
+    workers are the parallelism). The caller's model is left unchanged.
+    """
+    model = copy.deepcopy(model)
+    if hasattr(model, 'n_jobs'):
+        model.n_jobs = 1
+    if hasattr(model, 'get_booster'):
+        # XGBRegressor: n_jobs set after fit does not reach the fitted booster
+        model.get_booster().set_param('nthread', 1)
+    elif type(model).__name__ == 'Booster' and hasattr(model, 'set_param'):
+        model.set_param('nthread', 1)
+    return model
+
+
+def predict_raw(model, X):
+    """Predictions of `model` for the sparse feature matrix X, as a float64 array."""
+    if type(model).__module__.startswith('xgboost') and type(model).__name__ == 'Booster':
+        return model.inplace_predict(X)
+    if hasattr(model, 'booster_'):
+        # LGBMRegressor: the Booster skips the feature name check a sparse matrix cannot pass
+        return model.booster_.predict(X, num_threads=max(model.n_jobs or 0, 0))
+    return np.asarray(model.predict(X), dtype=np.float64)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Single-pass sufficient statistics for the heterogeneity tables (Tables 3 and 4).
+
+Instead of re-running `areg ... if meal==1, absorb(card)` once per subsample,
+one pass over the data accumulates, for every subsample group:
+
+- the raw cross-products Z'Z of Z = [regressors, factor dummies, y],
+- the number of rows,
+- per (group, card) row counts and column sums.
+
+The within-card cross-products of any group follow from these aggregates,
+    Z~'Z~ = Z'Z - sum_c s_c s_c' / n_c,
+so every subsample model is solved without touching the rows again. The pass
+runs over row chunks in a process pool; partial results are added together.
+
+Example
+-------
+    engine = GroupedRegression(df, splits={'Meal': 'Meal', 'Gender': 'Gender'})
+    stats = engine.run(df, n_jobs=4)
+    results = engine.fit_all(stats)        # {('all', None): FEResult, ('Meal', 1): ...}
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+from fe_regression import BASELINE_FACTORS, BASELINE_REGRESSORS, solve_cross_products
+
+# Rows per chunk handed to a worker process
+CHUNK_SIZE = 500_000
+
+
+def add_split_columns(df):
+    """
+    Add the derived subsample indicators used in Table 4 (graduate, heating
+    season). An indicator is missing where its source column is, so the row
+    is left out of that split only.
+    """
+    month = pd.to_numeric(df['month'])
+    type_ = pd.to_numeric(df['Type'])
+    df = df.copy()
+    df['graduate'] = (type_ > 1).astype(np.float64).where(type_.notna())
+    df['heating'] = ((month <= 3) | (month >= 11)).astype(np.float64).where(month.notna())
+    return df
+
+
+# Subsample dimensions of Tables 3 and 4: name -> column holding the group label
+TABLE_SPLITS = {'Meal': 'Meal', 'Gender': 'Gender', 'graduate': 'graduate', 'heating': 'heating'}
+
+
+def _levels(values):
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.categories
+    return pd.Index(np.sort(values.dropna().unique()))
+
+
+class GroupedRegression:
+    """
+    Specification and solver for one FE model fitted on many subsamples.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Used only to record the levels of the factors, the absorbed variable
+        and the split columns (categoricals from data_cache are read for free).
+    splits : dict
+        Split name -> column name. Every value of the column is a subsample.
+    """
+
+    def __init__(self, df, y='logCash', x=None, factors=None, absorb='card', splits=None):
+        self.y = y
+        self.x = list(x or BASELINE_REGRESSORS)
+        self.factors = list(factors or BASELINE_FACTORS)
+        self.absorb = absorb
+        self.splits = dict(TABLE_SPLITS if splits is None else splits)
+        self.factor_levels = {col: _levels(df[col]) for col in self.factors}
+        self.absorb_levels = _levels(df[absorb])
+        self.split_levels = {name: _levels(df[col]) for name, col in self.splits.items()}
+
+        # Design columns: regressors, dummies for every level but the lowest, then y
+        self.names = list(self.x)
+        for col in self.factors:
+            self.names.extend(f'{col}_{level}' for level in self.factor_levels[col][1:])
+        self.names.append(y)
+
+        # Shifting the continuous columns by their mean leaves the within
+        # estimates unchanged and limits cancellation in Z'Z - sum s s'/n.
+        self.center = np.zeros(len(self.names))
+        self.center[:len(self.x)] = [df[col].astype(np.float64).mean() for col in self.x]
+        self.center[-1] = df[y].astype(np.float64).mean()
+
+    # --- One pass over the data ---
+
+    def design(self, chunk):
+        """Raw design Z = [x, dummies, y] of a chunk as float64."""
+        Z = np.empty((len(chunk), len(self.names)))
+        j = 0
+        for col in self.x:
+            Z[:, j] = chunk[col].to_numpy(dtype=np.float64)
+            j += 1
+        for col in self.factors:
+            codes = self.factor_levels[col].get_indexer(chunk[col])
+            n_dummies = len(self.factor_levels[col]) - 1
+            Z[:, j:j + n_dummies] = codes[:, None] == np.arange(1, n_dummies + 1)
+            j += n_dummies
+        Z[:, j] = chunk[self.y].to_numpy(dtype=np.float64)
+        return Z - self.center
+
+    def accumulate(self, chunk):
+        """Sufficient statistics of one chunk, for the full sample and every split group."""
+        # Listwise deletion, as areg: rows with a missing y, regressor, factor or
+        # absorbed variable (card code -1) are left out
+        card = self.absorb_levels.get_indexer(chunk[self.absorb])
+        complete = chunk[[self.y] + self.x + self.factors].notna().all(axis=1).to_numpy() & (card >= 0)
+        if not complete.all():
+            chunk = chunk[complete]
+            card = card[complete]
+        Z = self.design(chunk)
+        n_cards = len(self.absorb_levels)
+        p = Z.shape[1]
+
+        stats = {}
+        groups = [('all', np.zeros(len(chunk), dtype=np.int64), 1)]
+        for name, col in self.splits.items():
+            groups.append((name, self.split_levels[name].get_indexer(chunk[col]), len(self.split_levels[name])))
+
+        for name, codes, n_levels in groups:
+            zz = np.zeros((n_levels, p, p))
+            for level in range(n_levels):
+                rows = codes == level
+                if rows.any():
+                    zz[level] = Z[rows].T @ Z[rows]
+            # Rows with a missing group label (code -1) go to a dropped extra cell
+            cell = np.where(codes >= 0, codes, n_levels) * n_cards + card
+            n_cells = (n_levels + 1) * n_cards
+            cell_n = np.bincount(cell, minlength=n_cells)[:n_levels * n_cards]
+            cell_sums = np.column_stack([
+                np.bincount(cell, weights=Z[:, j], minlength=n_cells)[:n_levels * n_cards] for j in range(p)
+            ])
+            stats[name] = {
+                'zz': zz,
+                'cell_n': cell_n.reshape(n_levels, n_cards),
+                'cell_sums': cell_sums.reshape(n_levels, n_cards, p),
+            }
+        return stats
+
+    @staticmethod
+    def merge(a, b):
+        """Add two partial results (from different chunks)."""
+        return {name: {key: a[name][key] + b[name][key] for key in a[name]} for name in a}
+
+    def run(self, df, n_jobs=None, chunk_size=CHUNK_SIZE):
+        """One pass over `df` in chunks, spread over `n_jobs` processes."""
+        chunks = [df.iloc[start:start + chunk_size] for start in range(0, len(df), chunk_size)]
+        n_jobs = n_jobs or os.cpu_count()
+        if n_jobs == 1 or len(chunks) == 1:
+            partials = map(self.accumulate, chunks)
+            return reduce(self.merge, partials)
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            return reduce(self.merge, pool.map(self.accumulate, chunks))
+
+    # --- Solving the subsample models from the aggregates ---
+
+    def fit(self, stats, split='all', level=None):
+        """FEResult of the subsample `split == level` (the full sample by default)."""
+        index = 0 if split == 'all' else self.split_levels[split].get_loc(level)
+        group = stats[split]
+        zz = group['zz'][index]
+        cell_n = group['cell_n'][index]
+        present = cell_n > 0
+        sums = group['cell_sums'][index][present]
+
+        # Within-card cross-products from the raw ones and the per-card sums
+        within = zz - sums.T @ (sums / cell_n[present, None])
+        xtx, xty, yty = within[:-1, :-1], within[:-1, -1], within[-1, -1]
+
+        key = 'all' if split == 'all' else f'{split}={level}'
+        return solve_cross_products(xtx, xty, yty, self.names[:-1], int(cell_n.sum()), int(present.sum()),
+                                    self.y, key)
+
+    def fit_all(self, stats):
+        """Solve the full-sample model and every subsample model."""
+        results = {('all', None): self.fit(stats)}
+        for split, levels in self.split_levels.items():
+            for level in levels:
+                if stats[split]['cell_n'][levels.get_loc(level)].sum() > 0:
+                    results[(split, level)] = self.fit(stats, split, level)
+        return results
+
+
+if __name__ == '__main__':
+    # Tables 3 and 4 from a single pass over the data
+    from data_cache import load_data
+    from fe_regression import esttab
+
+    columns = ['logCash', 'card', 'Meal', 'Gender', 'Type'] + BASELINE_REGRESSORS + BASELINE_FACTORS
+    df = add_split_columns(load_data('data0327.dta', columns=columns))
+    engine = GroupedRegression(df)
+    results = engine.fit_all(engine.run(df))
+
+    keep = ['logPM', 'ctemp', 'logPre', 'rh', 'awin', 'vacation_1']
+    table3 = esttab({'Baseline': results[('all', None)], 'Breakfast': results[('Meal', 1)],
+                     'Lunch': results[('Meal', 2)], 'Dinner': results[('Meal', 3)]}, keep=keep)
+    table4 = esttab({'male': results[('Gender', 1)], 'female': results[('Gender', 0)],
+                     'und': results[('graduate', 0)], 'grd': results[('graduate', 1)],
+                     'noheating': results[('heating', 0)], 'heating': results[('heating', 1)]}, keep=keep)
+    print(f"\ntable3\n{table3}\n\ntable4\n{table4}")
@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+Feature importance of the original variables for the ML scripts.
+
+The scripts report importance per column of the one-hot matrix (`month_2`,
+`weekday_3`, one `card_*` per student). Here the columns are grouped back
+into the nine variables of the specification (features.NUMERICAL_FEATURES +
+features.CATEGORICAL_FEATURES) and each group is treated as one feature:
+
+- permutation importance: increase in mean squared error when the rows of a
+  whole group are permuted together (one pass for `card`, not one per dummy).
+  The (group, repeat) permutations are spread over worker processes in blocks.
+- TreeSHAP: interventional Shapley values with the groups as players,
+  computed exactly from the trees for every (row, background row) pair of a
+  sample, vectorized over the pairs. Global importance is the mean |SHAP|.
+
+Both work with RandomForestRegressor, XGBoost and LightGBM models fitted on
+the sparse matrix of features.build_feature_matrix.
+
+Usage
+-----
+    table = grouped_importance(model, X_final, Y, feature_names, numerical_features, categorical_features)
+    plot_grouped_importance(table['shap'], title='Mean |SHAP| (Random Forest)')
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from math import factorial
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import matplotlib.pyplot as plt
+
+from features import CATEGORICAL_FEATURES, NUMERICAL_FEATURES, predict_raw, single_thread
+
+# Rows used for permutation importance (sampled from the training data)
+PERMUTATION_ROWS = 100_000
+PERMUTATION_REPEATS = 5
+# Rows explained and background rows of the TreeSHAP sample
+SHAP_ROWS = 500
+SHAP_BACKGROUND = 100
+# (row, background row) pairs walked through a tree at once
+SHAP_PAIRS = 20_000
+
+
+def feature_groups(feature_names, numerical_features=None, categorical_features=None):
+    """
+    Column indices of every original variable, in specification order.
+
+    Numerical variables are one column; a categorical variable owns the
+    one-hot columns named '<variable>_<level>'.
+    """
+    numerical_features = list(NUMERICAL_FEATURES if numerical_features is None else numerical_features)
+    categorical_features = list(CATEGORICAL_FEATURES if categorical_features is None else categorical_features)
+    names = pd.Index(feature_names)
+    groups = {}
+    for col in numerical_features:
+        groups[col] = np.flatnonzero(names == col)
+    # Dummies come after the numerical columns, so 'card_...' cannot match a numerical name
+    dummies = pd.Series(names[len(numerical_features):])
+    for col in categorical_features:
+        groups[col] = len(numerical_features) + np.flatnonzero(dummies.str.startswith(f'{col}_'))
+    covered = np.concatenate(list(groups.values()))
+    if len(covered) != len(names) or len(np.unique(covered)) != len(names):
+        raise ValueError("Error: feature names do not match the numerical and categorical feature lists.")
+    return groups
+
+
+def _column_groups(groups, n_columns):
+    column_group = np.empty(n_columns, dtype=np.int64)
+    for g, columns in enumerate(groups.values()):
+        column_group[columns] = g
+    return column_group
+
+
+# --- Permutation importance ---
+
+# State shared by the worker processes, set once per worker by _init_worker
+_STATE = {}
+
+
+def _init_worker(state):
+    _STATE.update(state)
+    if 'model' in _STATE:
+        _STATE['model'] = single_thread(_STATE['model'])
+
+
+def _permutation_block(tasks):
+    """MSE of the model with the rows of one group permuted, for every (group, repeat) of a block."""
+    s = _STATE
+    n_rows = s['shape'][0]
+    results = []
+    for g, repeat in tasks:
+        rng = np.random.default_rng([s['seed'], g, repeat])
+        order = np.empty(n_rows, dtype=np.int64)
+        # Row i of the permuted matrix takes the group's entries of row perm[i]
+        order[rng.permutation(n_rows)] = np.arange(n_rows)
+        in_group = s['entry_group'] == g
+        rows = np.where(in_group, order[s['rows']], s['rows'])
+        # Explicit zeros are kept, XGBoost reads missing entries as missing
+        X = sp.csr_matrix((s['data'], (rows, s['cols'])), shape=s['shape'])
+        residual = s['y'] - predict_raw(s['model'], X)
+        results.append((g, repeat, float(residual @ residual) / n_rows))
+    return results
+
+
+def permutation_importance(model, X, y, groups, n_rows=PERMUTATION_ROWS, n_repeats=PERMUTATION_REPEATS,
+                           n_jobs=None, seed=42):
+    """
+    Increase in MSE when each group of columns is permuted, on a sample of `n_rows` rows.
+
+    Returns a DataFrame indexed by group with columns 'importance' (mean over
+    repeats) and 'std'. Results depend on `seed` only, not on `n_jobs`.
+    """
+    X = sp.csr_matrix(X)
+    y = np.asarray(y, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    if X.shape[0] > n_rows:
+        rows = np.sort(rng.choice(X.shape[0], n_rows, replace=False))
+        X, y = X[rows], y[rows]
+    coo = X.tocoo()
+    baseline = y - predict_raw(model, X)
+    baseline = float(baseline @ baseline) / len(y)
+
+    tasks = [(g, repeat) for g in range(len(groups)) for repeat in range(n_repeats)]
+    state = {
+        'model': model,
+        'rows': coo.row.astype(np.int64),
+        'cols': coo.col,
+        'data': coo.data,
+        'entry_group': _column_groups(groups, X.shape[1])[coo.col],
+        'shape': X.shape,
+        'y': y,
+        'seed': seed,
+    }
+    n_jobs = min(n_jobs or os.cpu_count(), len(tasks))
+    if n_jobs == 1:
+        _init_worker(state)
+        blocks = [_permutation_block(tasks)]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(state,)) as pool:
+            blocks = list(pool.map(_permutation_block, np.array_split(np.array(tasks), n_jobs)))
+
+    losses = np.empty((len(groups), n_repeats))
+    for block in blocks:
+        for g, repeat, loss in block:
+            losses[g, repeat] = loss
+    return pd.DataFrame({'importance': losses.mean(axis=1) - baseline, 'std': losses.std(axis=1)},
+                        index=pd.Index(list(groups), name='feature'))
+
+
+# --- TreeSHAP ---
+
+class TreeArrays:
+    """
+    One tree as flat node arrays. Node 0 is the root; leaves have feature -1.
+
+    A row goes left at a node when value < threshold (`strict`) or value <=
+    threshold. Missing values go to the default child (`missing` == 0); with
+    `missing` == 1 zeros do too (LightGBM 'Zero'); with `missing` == 2 NaN is
+    read as 0 (LightGBM 'None').
+    """
+
+    def __init__(self, feature, threshold, left, right, value, default_left=None, strict=False, missing=None):
+        n_nodes = len(feature)
+        self.feature = np.asarray(feature, dtype=np.int64)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int64)
+        self.right = np.asarray(right, dtype=np.int64)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.default_left = np.ones(n_nodes, bool) if default_left is None else np.asarray(default_left, bool)
+        self.strict = strict
+        self.missing = np.zeros(n_nodes, np.int8) if missing is None else np.asarray(missing, np.int8)
+
+    def goes_left(self, node, values):
+        isnan = np.isnan(values)
+        missing = self.missing[node]
+        values = np.where(isnan & (missing == 2), 0.0, values)
+        threshold = self.threshold[node]
+        with np.errstate(invalid='ignore'):
+            left = values < threshold if self.strict else values <= threshold
+        to_default = (isnan & (missing != 2)) | ((missing == 1) & (values == 0))
+        return np.where(to_default, self.default_left[node], left)
+
+
+def _sklearn_trees(model):
+    estimators = getattr(model, 'estimators_', [model])
+    trees = []
+    for estimator in np.ravel(estimators):
+        t = estimator.tree_
+        # Averaged forest: every tree carries 1 / n_trees of the prediction
+        trees.append(TreeArrays(np.where(t.children_left < 0, -1, t.feature), t.threshold, t.children_left,
+                                t.children_right, t.value[:, 0, 0] / len(np.ravel(estimators))))
+    return trees
+
+
+def _xgboost_trees(booster):
+    # The JSON model holds the float32 split values exactly (the text dump rounds them)
+    model = json.loads(booster.save_raw(raw_format='json'))
+    trees = []
+    for tree in model['learner']['gradient_booster']['model']['trees']:
+        left = np.asarray(tree['left_children'])
+        leaf = left < 0
+        conditions = np.asarray(tree['split_conditions'], dtype=np.float32).astype(np.float64)
+        # Leaves store their value in split_conditions
+        trees.append(TreeArrays(np.where(leaf, -1, tree['split_indices']), conditions, left,
+                                tree['right_children'], np.where(leaf, conditions, 0.0),
+                                default_left=np.asarray(tree['default_left'], bool), strict=True))
+    return trees
+
+
+def _lightgbm_trees(booster):
+    trees = []
+    for info in booster.dump_model()['tree_info']:
+        nodes = []
+
+        def walk(node):
+            position = len(nodes)
+            nodes.append(None)
+            if 'leaf_value' in node:
+                nodes[position] = (-1, 0.0, -1, -1, node['leaf_value'], True, 0)
+                return position
+            if node['decision_type'] != '<=':
+                raise ValueError("Error: categorical LightGBM splits are not supported, fit on the one-hot matrix.")
+            left, right = walk(node['left_child']), walk(node['right_child'])
+            missing = {'NaN': 0, 'Zero': 1, 'None': 2}[node['missing_type']]
+            nodes[position] = (node['split_feature'], node['threshold'], left, right, 0.0, node['default_left'],
+                               missing)
+            return position
+
+        walk(info['tree_structure'])
+        feature, threshold, left, right, value, default_left, missing = map(list, zip(*nodes))
+        trees.append(TreeArrays(feature, threshold, left, right, value, default_left, missing=missing))
+    return trees
+
+
+def model_trees(model):
+    """
+    Trees of a fitted model and whether absent sparse entries are missing
+    values (XGBoost) rather than zeros.
+    """
+    module = type(model).__module__
+    if module.startswith('xgboost'):
+        booster = model.get_booster() if hasattr(model, 'get_booster') else model
+        return _xgboost_trees(booster), True
+    if module.startswith('lightgbm'):
+        booster = model.booster_ if hasattr(model, 'booster_') else model
+        return _lightgbm_trees(booster), False
+    if module.startswith('sklearn'):
+        return _sklearn_trees(model), False
+    raise ValueError(f"Error: TreeSHAP is not implemented for {type(model).__name__}.")
+
+
+def _dense(X, absent_is_missing):
+    """Dense copy of a small sparse sample; absent entries are NaN when the model reads them as missing."""
+    X = sp.coo_matrix(X)
+    dense = np.full(X.shape, np.nan if absent_is_missing else 0.0)
+    dense[X.row, X.col] = X.data
+    return dense
+
+
+def _shapley_weights(n_groups):
+    """Weights of a leaf reached with a groups following x and b groups following the background row."""
+    w_x = np.zeros((n_groups + 1, n_groups + 1))
+    w_b = np.zeros((n_groups + 1, n_groups + 1))
+    for a in range(n_groups + 1):
+        for b in range(n_groups + 1 - a):
+            if a:
+                w_x[a, b] = factorial(a - 1) * factorial(b) / factorial(a + b)
+            if b:
+                w_b[a, b] = factorial(a) * factorial(b - 1) / factorial(a + b)
+    return w_x, w_b
+
+
+def _popcount(masks, n_groups):
+    return sum((masks >> g) & 1 for g in range(n_groups))
+
+
+def tree_shap_pairs(tree, X, B, x_index, b_index, column_group, n_groups):
+    """
+    Shapley values of the groups for f(x) - f(b) of one tree, for every (x, b) pair.
+
+    A coalition S of groups evaluates the tree on the hybrid row with the
+    columns of S from x and the rest from b. Walking the tree, a node splits
+    the pair's path only when x and b go different ways; the path then
+    branches, one side recording the group as taken from x, the other from b.
+    A leaf reached with groups A from x and C from b contributes its value
+    with the Shapley weight to each group of A (positive) and C (negative).
+    Returns an array (n_pairs, n_groups).
+    """
+    n_pairs = len(x_index)
+    w_x, w_b = _shapley_weights(n_groups)
+    phi = np.zeros(n_pairs * n_groups)
+    pair = np.arange(n_pairs)
+    node = np.zeros(n_pairs, dtype=np.int64)
+    from_x = np.zeros(n_pairs, dtype=np.int64)
+    from_b = np.zeros(n_pairs, dtype=np.int64)
+    while len(pair):
+        leaf = tree.feature[node] < 0
+        if leaf.any():
+            a = _popcount(from_x[leaf], n_groups)
+            b = _popcount(from_b[leaf], n_groups)
+            value = tree.value[node[leaf]]
+            for g in range(n_groups):
+                weight = np.where((from_x[leaf] >> g) & 1, value * w_x[a, b], 0.0)
+                weight -= np.where((from_b[leaf] >> g) & 1, value * w_b[a, b], 0.0)
+                phi += np.bincount(pair[leaf] * n_groups + g, weights=weight, minlength=n_pairs * n_groups)
+            keep = ~leaf
+            pair, node, from_x, from_b = pair[keep], node[keep], from_x[keep], from_b[keep]
+            if not len(pair):
+                break
+
+        feature = tree.feature[node]
+        bit = np.int64(1) << column_group[feature]
+        x_left = tree.goes_left(node, X[x_index[pair], feature])
+        b_left = tree.goes_left(node, B[b_index[pair], feature])
+        x_child = np.where(x_left, tree.left[node], tree.right[node])
+        b_child = np.where(b_left, tree.left[node], tree.right[node])
+        # Groups already taken from one side must keep following that side
+        follow_x = (x_child == b_child) | ((from_x & bit) != 0)
+        follow_b = ~follow_x & ((from_b & bit) != 0)
+        branch = ~follow_x & ~follow_b
+        pair = np.concatenate([pair[~branch], pair[branch], pair[branch]])
+        node = np.concatenate([np.where(follow_x, x_child, b_child)[~branch], x_child[branch], b_child[branch]])
+        from_x, from_b = (np.concatenate([from_x[~branch], from_x[branch] | bit[branch], from_x[branch]]),
+                          np.concatenate([from_b[~branch], from_b[branch], from_b[branch] | bit[branch]]))
+    return phi.reshape(n_pairs, n_groups)
+
+
+def _shap_block(tree_indices):
+    s = _STATE
+    n_x, n_b = len(s['X']), len(s['B'])
+    phi = np.zeros((n_x, s['n_groups']))
+    x_index = np.repeat(np.arange(n_x), n_b)
+    b_index = np.tile(np.arange(n_b), n_x)
+    for start in range(0, len(x_index), SHAP_PAIRS):
+        chunk = slice(start, start + SHAP_PAIRS)
+        for t in tree_indices:
+            pairs = tree_shap_pairs(s['trees'][t], s['X'], s['B'], x_index[chunk], b_index[chunk],
+                                    s['column_group'], s['n_groups'])
+            phi += np.bincount(np.repeat(x_index[chunk], s['n_groups']) * s['n_groups']
+                               + np.tile(np.arange(s['n_groups']), len(pairs)),
+                               weights=pairs.ravel(), minlength=phi.size).reshape(phi.shape)
+    return phi / n_b
+
+
+def tree_shap(model, X, groups, n_rows=SHAP_ROWS, n_background=SHAP_BACKGROUND, n_jobs=None,
+              seed=42):
+    """
+    Interventional TreeSHAP values of the groups for a sample of `n_rows` rows,
+    against `n_background` background rows sampled from X.
+
+    Returns a DataFrame (rows x groups) of SHAP values; each row sums to the
+    prediction minus the mean prediction over the background rows.
+    """
+    X = sp.csr_matrix(X)
+    rng = np.random.default_rng([seed, 1])
+    rows = np.sort(rng.choice(X.shape[0], min(n_rows, X.shape[0]), replace=False))
+    background = np.sort(rng.choice(X.shape[0], min(n_background, X.shape[0]), replace=False))
+    trees, absent_is_missing = model_trees(model)
+    state = {
+        'trees': trees,
+        'X': _dense(X[rows], absent_is_missing),
+        'B': _dense(X[background], absent_is_missing),
+        'column_group': _column_groups(groups, X.shape[1]),
+        'n_groups': len(groups),
+    }
+    n_jobs = min(n_jobs or os.cpu_count(), len(trees))
+    if n_jobs == 1:
+        _init_worker(state)
+        phi = _shap_block(range(len(trees)))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(state,)) as pool:
+            phi = sum(pool.map(_shap_block, np.array_split(np.arange(len(trees)), n_jobs)))
+    return pd.DataFrame(phi, index=pd.Index(rows, name='row'), columns=pd.Index(list(groups), name='feature'))
+
+
+def grouped_importance(model, X, y, feature_names, numerical_features=None, categorical_features=None,
+                       n_jobs=None, seed=42):
+    """
+    Permutation importance and mean |SHAP| of the original variables.
+
+    Returns a DataFrame indexed by variable with columns 'permutation',
+    'permutation_std' and 'shap', sorted by 'shap'.
+    """
+    groups = feature_groups(feature_names, numerical_features, categorical_features)
+    permutation = permutation_importance(model, X, y, groups, n_jobs=n_jobs, seed=seed)
+    shap_values = tree_shap(model, X, groups, n_jobs=n_jobs, seed=seed)
+    table = pd.DataFrame({'permutation': permutation['importance'], 'permutation_std': permutation['std'],
+                          'shap': shap_values.abs().mean()})
+    return table.sort_values('shap', ascending=False)
+
+
+def plot_grouped_importance(importance, ax=None, title='Feature importance', xlabel='F score', ylabel='Features',
+                            height=0.2, xerr=None, grid=True, digits=4):
+    """
+    Horizontal bar chart of grouped importance, in the style of
+    xgb.plot_importance / lgb.plot_importance (largest at the top, values
+    printed next to the bars).
+    """
+    importance = pd.Series(importance).sort_values()
+    ax = ax or plt.gca()
+    if xerr is not None:
+        xerr = pd.Series(xerr).reindex(importance.index)
+    ax.barh(range(len(importance)), importance.to_numpy(), height=height, align='center', xerr=xerr)
+    for y, value in enumerate(importance):
+        ax.text(value, y, f' {value:.{digits}g}', va='center')
+    ax.set_yticks(range(len(importance)))
+    ax.set_yticklabels(importance.index)
+    ax.set_ylim(-1, len(importance))
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    ax.grid(grid)
+    return ax
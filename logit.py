@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Logit solver for the `miss` (takeout) models of Section 3 of the .do file.
+
+Newton-Raphson (IRLS) where every iteration is one pass over row chunks, so
+the data can be streamed from the columnar cache (data_cache.iter_chunks)
+instead of held in memory. Nested specifications (logit01 -> logit05) are
+warm-started from the smaller model, subsample fits (logit1 -> logit7) run in
+parallel across processes, and results report odds-ratio effects directly.
+
+Example
+-------
+    spec = LogitSpec(df, 'miss', ['logPM', 'logPre', 'rh', 'awin', 'ctemp'],
+                     factors=['vacation', 'month', 'weekday'])
+    result = fit_logit(spec, frame_chunks(df))
+    print(result.odds_ratios())
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from fe_regression import BASELINE_FACTORS, BASELINE_REGRESSORS, independent_columns
+
+# Rows per chunk of a pass over in-memory data
+CHUNK_SIZE = 1_000_000
+
+
+def frame_chunks(df, chunk_size=CHUNK_SIZE, subset=None):
+    """Return a callable that yields `df` (or its `subset` rows) in chunks, once per call."""
+    rows = None if subset is None else np.flatnonzero(np.asarray(subset, dtype=bool))
+
+    def chunks():
+        n = len(df) if rows is None else len(rows)
+        for start in range(0, n, chunk_size):
+            if rows is None:
+                yield df.iloc[start:start + chunk_size]
+            else:
+                yield df.iloc[rows[start:start + chunk_size]]
+    return chunks
+
+
+class LogitSpec:
+    """
+    Variables of one logit specification: constant, regressors, and dummies
+    for every level of each factor but the lowest (Stata's i. base level).
+    Factor levels are recorded once from `df` so every chunk gets the same columns.
+    Rows with a missing y, regressor or factor are dropped from every chunk, as
+    `logit` drops them.
+    """
+
+    def __init__(self, df, y='miss', x=None, factors=None, levels=None):
+        self.y = y
+        self.x = list(BASELINE_REGRESSORS if x is None else x)
+        self.factors = list(BASELINE_FACTORS if factors is None else factors)
+        self.levels = {}
+        for col in self.factors:
+            if levels is not None and col in levels:
+                self.levels[col] = pd.Index(levels[col])
+            elif isinstance(df[col].dtype, pd.CategoricalDtype):
+                self.levels[col] = df[col].cat.categories
+            else:
+                self.levels[col] = pd.Index(np.sort(df[col].dropna().unique()))
+        self.names = ['_cons'] + self.x
+        for col in self.factors:
+            self.names.extend(f'{col}_{level}' for level in self.levels[col][1:])
+
+    def design(self, chunk):
+        complete = chunk[[self.y] + self.x + self.factors].notna().all(axis=1).to_numpy()
+        if not complete.all():
+            chunk = chunk[complete]
+        X = np.empty((len(chunk), len(self.names)))
+        X[:, 0] = 1.0
+        j = 1
+        for col in self.x:
+            X[:, j] = chunk[col].to_numpy(dtype=np.float64)
+            j += 1
+        for col in self.factors:
+            codes = self.levels[col].get_indexer(chunk[col])
+            n_dummies = len(self.levels[col]) - 1
+            X[:, j:j + n_dummies] = codes[:, None] == np.arange(1, n_dummies + 1)
+            j += n_dummies
+        return X, chunk[self.y].to_numpy(dtype=np.float64)
+
+
+class LogitResult:
+    """Coefficients and observed-information standard errors, as `logit` reports them."""
+
+    def __init__(self, params, cov, nobs, loglik, iterations, converged):
+        self.params = params
+        self.cov = cov
+        self.bse = pd.Series(np.sqrt(np.diag(cov)), index=params.index)
+        self.zvalues = params / self.bse
+        self.pvalues = pd.Series(2 * stats.norm.sf(np.abs(self.zvalues)), index=params.index)
+        self.nobs = nobs
+        self.loglik = loglik
+        self.iterations = iterations
+        self.converged = converged
+        # Large-sample inference: used by spline_sweep for normal critical values
+        self.df_resid = np.inf
+
+    def odds_ratios(self, level=0.95):
+        """Odds ratios exp(b), odds-ratio effects exp(b) - 1 and their confidence limits."""
+        crit = stats.norm.ppf(0.5 + level / 2)
+        return pd.DataFrame({
+            'odds_ratio': np.exp(self.params),
+            'effect': np.expm1(self.params),
+            'effect_lb': np.expm1(self.params - crit * self.bse),
+            'effect_ub': np.expm1(self.params + crit * self.bse),
+            'P>|z|': self.pvalues,
+        })
+
+    def summary(self):
+        crit = stats.norm.ppf(0.975)
+        return pd.DataFrame({
+            'coef': self.params, 'std err': self.bse, 'z': self.zvalues, 'P>|z|': self.pvalues,
+            '[0.025': self.params - crit * self.bse, '0.975]': self.params + crit * self.bse,
+        })
+
+    def __repr__(self):
+        return f"LogitResult(N={self.nobs}, loglik={self.loglik:.3f}, iterations={self.iterations})\n{self.summary()}"
+
+
+def _pass(spec, chunks, beta, active):
+    """One pass over the data: log-likelihood, gradient and Hessian at `beta`."""
+    k = len(active)
+    hessian = np.zeros((k, k))
+    gradient = np.zeros(k)
+    loglik = 0.0
+    nobs = 0
+    for chunk in chunks():
+        X, y = spec.design(chunk)
+        X = X[:, active]
+        eta = X @ beta
+        p = 1.0 / (1.0 + np.exp(-eta))
+        loglik += np.sum(y * eta - np.logaddexp(0.0, eta))
+        gradient += X.T @ (y - p)
+        hessian += X.T @ (X * (p * (1.0 - p))[:, None])
+        nobs += len(y)
+    return loglik, gradient, hessian, nobs
+
+
+def fit_logit(spec, chunks, start=None, tol=1e-10, maxiter=50):
+    """
+    Fit the logit model by Newton-Raphson, one pass over `chunks()` per iteration.
+
+    Parameters
+    ----------
+    spec : LogitSpec
+    chunks : callable
+        Returns an iterable of DataFrame chunks each time it is called
+        (frame_chunks(df) for in-memory data, or a lambda around
+        data_cache.iter_chunks for streaming from disk).
+    start : pandas.Series, optional
+        Warm start. Coefficients not in `start` begin at zero, so the result of
+        a smaller nested model is a valid starting point.
+    """
+    beta = np.zeros(len(spec.names))
+    if start is not None:
+        shared = [n for n in start.index if n in spec.names]
+        beta[[spec.names.index(n) for n in shared]] = start[shared].to_numpy()
+
+    # Start with every column; columns found collinear in the first pass
+    # (e.g. dummies of months outside a subsample) are dropped, as Stata omits them.
+    active = np.arange(len(spec.names))
+    loglik, gradient, hessian, nobs = _pass(spec, chunks, beta, active)
+    keep = independent_columns(hessian)
+    if len(keep) < len(active):
+        active = active[keep]
+        beta = beta[keep]
+        loglik, gradient, hessian, nobs = _pass(spec, chunks, beta, active)
+
+    converged = False
+    for iteration in range(1, maxiter + 1):
+        step = np.linalg.solve(hessian, gradient)
+        # Scaled gradient g'H^-1 g, the convergence criterion Stata uses
+        if gradient @ step < tol:
+            converged = True
+            break
+        # Step halving if the full Newton step lowers the log-likelihood
+        for _ in range(30):
+            new = _pass(spec, chunks, beta + step, active)
+            if new[0] >= loglik - 1e-12 * abs(loglik):
+                break
+            step = step / 2
+        beta = beta + step
+        loglik, gradient, hessian, nobs = new
+
+    names = [spec.names[i] for i in active]
+    cov = np.linalg.inv(hessian)
+    return LogitResult(pd.Series(beta, index=names), pd.DataFrame(cov, index=names, columns=names),
+                       nobs, loglik, iteration, converged)
+
+
+def fit_nested(df, y, specifications, chunk_size=CHUNK_SIZE):
+    """
+    Fit a sequence of nested specifications (list of (x, factors) pairs), each
+    warm-started from the previous result. Returns the list of results.
+    """
+    results = []
+    start = None
+    for x, factors in specifications:
+        spec = LogitSpec(df, y, x, factors)
+        result = fit_logit(spec, frame_chunks(df, chunk_size), start=start)
+        results.append(result)
+        start = result.params
+    return results
+
+
+# --- Parallel subsample fits ---
+
+# Data shared by the worker processes, set once per worker by _init_worker
+_STATE = {}
+
+
+def _init_worker(state):
+    _STATE.update(state)
+
+
+def _fit_subsample(task):
+    name, subset = task
+    s = _STATE
+    spec = LogitSpec(s['df'], s['y'], s['x'], s['factors'], levels=s['levels'])
+    return name, fit_logit(spec, frame_chunks(s['df'], s['chunk_size'], subset), start=s['start'])
+
+
+def fit_subsamples(df, subsets, y='miss', x=None, factors=None, n_jobs=None, start=None, chunk_size=CHUNK_SIZE):
+    """
+    Fit the same specification on several subsamples in parallel.
+
+    `subsets` maps a model name to a boolean mask (None for the full sample).
+    All fits are warm-started from `start` (typically the full-sample result).
+    Returns {name: LogitResult} in the order of `subsets`.
+    """
+    spec = LogitSpec(df, y, x, factors)
+    state = {'df': df, 'y': y, 'x': spec.x, 'factors': spec.factors, 'levels': spec.levels,
+             'start': start, 'chunk_size': chunk_size}
+    tasks = [(name, None if mask is None else np.asarray(mask, dtype=bool)) for name, mask in subsets.items()]
+    n_jobs = min(n_jobs or os.cpu_count(), len(tasks))
+    if n_jobs == 1:
+        _init_worker(state)
+        return dict(map(_fit_subsample, tasks))
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(state,)) as pool:
+        return dict(pool.map(_fit_subsample, tasks))
+
+
+def _column(df, name):
+    """Column `name` matched case-insensitively (the .dta files mix 'gender' and 'Gender')."""
+    return next(df[c] for c in df.columns if c.lower() == name.lower())
+
+
+if __name__ == '__main__':
+    # Section 3 of the .do file: logit01-05 (nested) and Table 5 (logit1-7)
+    from data_cache import load_data
+    from fe_regression import esttab
+    from profiling import note, section
+
+    section('load')
+    df = load_data('Eatingout.dta', float_dtype='float64')
+    note(rows=len(df))
+    section('fit_nested', rows=len(df))
+    weather = ['logPM', 'logPre', 'rh', 'awin', 'ctemp']
+    nested = fit_nested(df, 'miss', [
+        (['logPM'], []),
+        (weather, []),
+        (weather, ['vacation']),
+        (weather, ['vacation', 'month']),
+        (weather, ['vacation', 'month', 'weekday']),
+    ])
+    print(esttab({f'logit0{i + 1}': r for i, r in enumerate(nested)}, keep=weather))
+
+    section('fit_table5', rows=len(df))
+    gender = _column(df, 'gender').astype(int)
+    type_ = _column(df, 'type').astype(int)
+    month = df['month'].astype(int)
+    table5 = fit_subsamples(df, {
+        'baseline': None,
+        'female': gender == 0,
+        'male': gender == 1,
+        'UND': type_ == 1,
+        'Grd': type_ > 1,
+        'No Winter': (month > 3) & (month < 11),
+        'Winter': (month <= 3) | (month >= 11),
+    }, start=nested[-1].params)
+    table = esttab(table5, keep=weather + ['vacation_1'])
+    table.to_csv('table5_python.csv')
+    print(f"\ntable5\n{table}")
+    print("\nOdds-ratio effects of logPM:")
+    print(pd.DataFrame({name: r.odds_ratios().loc['logPM'] for name, r in table5.items()}).T)
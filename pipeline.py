@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental runner for the replication pipeline.
+
+Stages (dependencies in brackets):
+
+    load            build the columnar caches of data0327.dta / Eatingout.dta
+    features        sparse ML feature matrix (features.load_feature_matrix)   [load]
+    table1          daily_cube.py (Table 1)                                    [load]
+    fe_regressions  fe_regression.py, logit.py (Tables 2-6)                    [load]
+    spline_sweep    spline_sweep.py (Figure3.csv, Figure4.csv)                 [load]
+    ml_rf, ml_xgb, ml_lgbm   '4. Random Forest.py', '2. Xgboost.py', '3. LightGBM.py'  [features]
+    fig2            Figure 2 section of '5. Figure2&3&4.py'                    [load]
+    fig3, fig4      Figure 3 / Figure 4 sections                               [spline_sweep]
+
+Every stage has a key: a hash of its code (the script, or its own section of
+the figure script, plus the local modules it imports), its parameters, the
+keys of the stages it depends on and, for `load`, the fingerprints (size and
+modification time) of the .dta files. A stage whose key is unchanged and
+whose outputs exist is skipped. Outputs are also stored under their key in
+.pipeline/, so going back to an earlier version restores them instead of
+recomputing. Stages whose dependencies are done run concurrently in a process
+pool. Each run writes a timing report to .pipeline/reports/.
+
+Editing the styling of one figure only changes the key of that figure stage.
+
+Usage
+-----
+    python pipeline.py --workdir E:/data              # run what is stale
+    python pipeline.py --workdir E:/data --dry-run    # only show what would run
+    python pipeline.py --workdir E:/data --force fig3 ml_xgb
+    python pipeline.py --workdir E:/data --only fig2 fig3
+    python pipeline.py --workdir E:/data --profile    # stage records of every script (profiling.py)
+"""
+import argparse
+import ast
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STATE_DIR = '.pipeline'
+FIGURE_SCRIPT = '5. Figure2&3&4.py'
+# Markers that split the figure script into a shared preamble and one section per figure
+FIGURE_MARKERS = {'fig2': '# --- FIGURE 2', 'fig3': '# --- FIGURE 3', 'fig4': '# --- FIGURE 4'}
+DATASETS = ['data0327.dta', 'Eatingout.dta']
+# Float dtypes of the columnar caches the stages read (data_cache keeps one cache per dtype)
+CACHE_DTYPES = ['float32', 'float64']
+
+
+class Stage:
+    """
+    One pipeline stage.
+
+    Parameters
+    ----------
+    name : str
+    deps : list of str
+        Stages that must be up to date first; their keys enter this stage's key.
+    scripts : list of str
+        Scripts run in order (`python <script>` in the working directory), or
+        a figure section name ('fig2', ...) for the figure script.
+    outputs : list of str
+        Files written to the working directory, stored under the stage key.
+    optional_outputs : list of str
+        Files the stage writes only for some data (e.g. Table 6 needs the
+        lagged PM2.5 columns); stored and restored when present, but not
+        required for the stage to be up to date.
+    params : dict
+        Extra parameters entering the key (and passed to `action` stages).
+    action : callable, optional
+        Function run in a worker process instead of scripts: action(workdir, **params).
+    modules : list of str
+        Local modules whose code enters the key of an `action` stage.
+    """
+
+    def __init__(self, name, deps=(), scripts=(), outputs=(), params=None, action=None, modules=(),
+                 optional_outputs=()):
+        self.name = name
+        self.deps = list(deps)
+        self.scripts = list(scripts)
+        self.outputs = list(outputs)
+        self.optional_outputs = list(optional_outputs)
+        self.params = dict(params or {})
+        self.action = action
+        self.modules = list(modules)
+
+
+# --- Stage actions (run in the worker processes) ---
+
+def build_caches(workdir, datasets=DATASETS, float_dtypes=CACHE_DTYPES):
+    from data_cache import cache_metadata
+    for name in datasets:
+        path = os.path.join(workdir, name)
+        if os.path.exists(path):
+            for float_dtype in float_dtypes:
+                cache_metadata(path, float_dtype=float_dtype)
+
+
+def build_features(workdir, dataset='data0327.dta'):
+    from features import load_feature_matrix
+    load_feature_matrix(os.path.join(workdir, dataset))
+
+
+STAGES = [
+    Stage('load', action=build_caches, params={'datasets': DATASETS, 'float_dtypes': CACHE_DTYPES},
+          modules=['data_cache.py']),
+    Stage('features', deps=['load'], action=build_features, params={'dataset': 'data0327.dta'},
+          modules=['features.py']),
+    Stage('table1', deps=['load'], scripts=['daily_cube.py'], outputs=['table1_python.csv']),
+    Stage('fe_regressions', deps=['load'], scripts=['fe_regression.py', 'logit.py'],
+          outputs=['table2_python.csv', 'table3_python.csv', 'table4_python.csv',
+                   'table5_python.csv', 'table2_cluster_python.csv', 'table3_cluster_python.csv',
+                   'table4_cluster_python.csv', 'table2_bootstrap_python.csv'],
+          optional_outputs=['table6_python.csv', 'table6_cluster_python.csv']),
+    Stage('spline_sweep', deps=['load'], scripts=['spline_sweep.py'], outputs=['Figure3.csv', 'Figure4.csv']),
+    Stage('ml_rf', deps=['features'], scripts=['4. Random Forest.py'],
+          outputs=['feature_importance.png', 'feature_importance_rf_grouped.png']),
+    Stage('ml_xgb', deps=['features'], scripts=['2. Xgboost.py'],
+          outputs=['feature_importance_xgb_gain.png', 'feature_importance_xgb_weight.png',
+                   'feature_importance_xgb_grouped.png', 'xgb_model.json']),
+    Stage('ml_lgbm', deps=['features'], scripts=['3. LightGBM.py'],
+          outputs=['feature_importance_lgbm.png', 'feature_importance_lgbm_grouped.png',
+                   'lgbm_model.txt']),
+    # Uses the saved XGBoost / LightGBM models when the ML stages have written them
+    Stage('scenarios', deps=['load', 'ml_xgb', 'ml_lgbm'], scripts=['scenarios.py'],
+          outputs=['scenarios_logCash.csv', 'scenarios_miss.csv']),
+    Stage('fig2', deps=['load'], scripts=['fig2'], outputs=['Fig2.JPG']),
+    Stage('fig3', deps=['spline_sweep'], scripts=['fig3'], outputs=['Fig3.JPG']),
+    Stage('fig4', deps=['spline_sweep'], scripts=['fig4'], outputs=['Fig4.JPG']),
+]
+
+
+# --- Keys ---
+
+def _local_imports(path, seen=None):
+    """The script plus every module of this folder it imports, recursively."""
+    seen = set() if seen is None else seen
+    if path in seen:
+        return seen
+    seen.add(path)
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        names = []
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+            names = [node.module]
+        for name in names:
+            module = os.path.join(HERE, name.split('.')[0] + '.py')
+            if os.path.exists(module):
+                _local_imports(module, seen)
+    return seen
+
+
+def figure_section(name):
+    """Source of one figure: the shared preamble of the figure script plus that figure's section."""
+    with open(os.path.join(HERE, FIGURE_SCRIPT), encoding='utf-8') as f:
+        source = f.read()
+    starts = sorted(source.index(marker) for marker in FIGURE_MARKERS.values())
+    start = source.index(FIGURE_MARKERS[name])
+    end = min([s for s in starts if s > start], default=len(source))
+    return source[:starts[0]] + source[start:end]
+
+
+def _code_hash(stage):
+    digest = hashlib.sha256()
+    files = set()
+    for script in stage.scripts:
+        if script in FIGURE_MARKERS:
+            section = figure_section(script)
+            digest.update(section.encode())
+            # Modules imported by the preamble (data_cache, raincloud, daily_cube, ...)
+            for node in ast.walk(ast.parse(section)):
+                if isinstance(node, ast.ImportFrom) and node.module:
+                    module = os.path.join(HERE, node.module + '.py')
+                    if os.path.exists(module):
+                        files |= _local_imports(module)
+        else:
+            files |= _local_imports(os.path.join(HERE, script))
+    for module in stage.modules:
+        files |= _local_imports(os.path.join(HERE, module))
+    for path in sorted(files):
+        with open(path, 'rb') as f:
+            digest.update(os.path.basename(path).encode() + b'\0' + f.read())
+    return digest.hexdigest()
+
+
+def _data_fingerprints(workdir):
+    fingerprints = {}
+    for name in DATASETS:
+        path = os.path.join(workdir, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprints[name] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprints
+
+
+def stage_keys(workdir, stages=STAGES):
+    """Key of every stage, in dependency order."""
+    keys = {}
+    for stage in stages:
+        content = {
+            'stage': stage.name,
+            'code': _code_hash(stage),
+            'params': stage.params,
+            'deps': {dep: keys[dep] for dep in stage.deps},
+        }
+        if stage.name == 'load':
+            content['data'] = _data_fingerprints(workdir)
+        keys[stage.name] = hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()[:20]
+    return keys
+
+
+# --- Running ---
+
+def _run_stage(stage, workdir, state_dir):
+    """Run one stage in a worker process; returns (name, wall seconds, error or None)."""
+    start = time.perf_counter()
+    env = dict(os.environ, PM25_WORKDIR=workdir, MPLBACKEND=os.environ.get('MPLBACKEND', 'Agg'),
+               PYTHONPATH=os.pathsep.join([HERE] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    log_path = os.path.join(state_dir, 'logs', f'{stage.name}.log')
+    try:
+        if stage.action is not None:
+            sys.path.insert(0, HERE)
+            stage.action(workdir, **stage.params)
+        with open(log_path, 'w') as log:
+            for script in stage.scripts:
+                if script in FIGURE_MARKERS:
+                    path = os.path.join(state_dir, f'{script}.py')
+                    with open(path, 'w', encoding='utf-8') as f:
+                        f.write(figure_section(script))
+                else:
+                    path = os.path.join(HERE, script)
+                subprocess.run([sys.executable, path], cwd=workdir, env=env, stdout=log,
+                               stderr=subprocess.STDOUT, check=True)
+    except Exception as error:
+        return stage.name, time.perf_counter() - start, f"{type(error).__name__}: {error} (log: {log_path})"
+    return stage.name, time.perf_counter() - start, None
+
+
+def _store(stage, key, workdir, state_dir):
+    folder = os.path.join(state_dir, 'store', stage.name, key)
+    os.makedirs(folder, exist_ok=True)
+    for output in stage.outputs + stage.optional_outputs:
+        source = os.path.join(workdir, output)
+        if os.path.exists(source):
+            shutil.copy2(source, os.path.join(folder, output))
+
+
+def _restore(stage, key, workdir, state_dir):
+    """Copy the stored outputs of `key` back into the working directory, if all of them were stored."""
+    folder = os.path.join(state_dir, 'store', stage.name, key)
+    stored = [os.path.join(folder, output) for output in stage.outputs]
+    if not os.path.isdir(folder) or not all(os.path.exists(path) for path in stored):
+        return False
+    for path, output in zip(stored, stage.outputs):
+        shutil.copy2(path, os.path.join(workdir, output))
+    for output in stage.optional_outputs:
+        if os.path.exists(os.path.join(folder, output)):
+            shutil.copy2(os.path.join(folder, output), os.path.join(workdir, output))
+    return True
+
+
+def plan(workdir, stages=STAGES, force=(), only=None):
+    """Status of every stage: 'fresh', 'restore' or 'run' (stale), and the stage keys."""
+    state_dir = os.path.join(workdir, STATE_DIR)
+    state_path = os.path.join(state_dir, 'state.json')
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    keys = stage_keys(workdir, stages)
+    status = {}
+    for stage in stages:
+        if only is not None and stage.name not in only:
+            continue
+        key = keys[stage.name]
+        outputs_exist = all(os.path.exists(os.path.join(workdir, o)) for o in stage.outputs)
+        if stage.name in force:
+            status[stage.name] = 'run'
+        elif state.get(stage.name) == key and outputs_exist:
+            status[stage.name] = 'fresh'
+        elif stage.outputs and os.path.isdir(os.path.join(state_dir, 'store', stage.name, key)):
+            status[stage.name] = 'restore'
+        else:
+            status[stage.name] = 'run'
+    return status, keys, state
+
+
+def run(workdir, stages=STAGES, n_jobs=None, force=(), only=None, dry_run=False):
+    """Bring the pipeline up to date. Returns the timing report (list of dicts)."""
+    workdir = os.path.abspath(workdir)
+    state_dir = os.path.join(workdir, STATE_DIR)
+    for sub in ('logs', 'store', 'reports'):
+        os.makedirs(os.path.join(state_dir, sub), exist_ok=True)
+    status, keys, state = plan(workdir, stages, force, only)
+    by_name = {stage.name: stage for stage in stages}
+    if dry_run:
+        return [{'stage': name, 'status': s, 'key': keys[name]} for name, s in status.items()]
+
+    report = []
+    run_start = time.perf_counter()
+    for name, s in status.items():
+        if s == 'fresh':
+            report.append({'stage': name, 'status': 'fresh', 'key': keys[name], 'wall_s': 0.0})
+        elif s == 'restore':
+            start = time.perf_counter()
+            if _restore(by_name[name], keys[name], workdir, state_dir):
+                state[name] = keys[name]
+                report.append({'stage': name, 'status': 'restored', 'key': keys[name],
+                               'wall_s': time.perf_counter() - start})
+            else:
+                status[name] = 'run'
+
+    pending = {name for name, s in status.items() if s == 'run'}
+    done = {name for name, s in status.items() if s != 'run'}
+    # Dependencies outside the selection (--only) are taken as they are
+    done |= {stage.name for stage in stages if stage.name not in status}
+    failed = set()
+    with ProcessPoolExecutor(max_workers=n_jobs or os.cpu_count()) as pool:
+        if pending and 'load' not in pending:
+            # Caches missing or stale outside the `load` stage (--only) are built once
+            # here, not by several stages at the same time
+            pool.submit(build_caches, workdir).result()
+        running = {}
+        while pending or running:
+            ready = [name for name in pending if all(dep in done or dep in failed for dep in by_name[name].deps)]
+            for name in sorted(ready):
+                deps = by_name[name].deps
+                if any(dep in failed for dep in deps):
+                    pending.discard(name)
+                    failed.add(name)
+                    report.append({'stage': name, 'status': 'skipped', 'key': keys[name], 'wall_s': 0.0,
+                                   'error': 'a dependency failed'})
+                else:
+                    pending.discard(name)
+                    print(f"[pipeline] running {name}")
+                    running[pool.submit(_run_stage, by_name[name], workdir, state_dir)] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, wall, error = future.result()
+                del running[future]
+                record = {'stage': name, 'status': 'ran' if error is None else 'failed', 'key': keys[name],
+                          'wall_s': wall}
+                if error is None:
+                    _store(by_name[name], keys[name], workdir, state_dir)
+                    state[name] = keys[name]
+                    done.add(name)
+                else:
+                    record['error'] = error
+                    failed.add(name)
+                    state.pop(name, None)
+                report.append(record)
+                print(f"[pipeline] {name} {record['status']} in {wall:.1f} s")
+                # Save progress after every stage, so an interrupted run keeps it
+                with open(os.path.join(state_dir, 'state.json'), 'w') as f:
+                    json.dump(state, f, indent=2)
+
+    with open(os.path.join(state_dir, 'state.json'), 'w') as f:
+        json.dump(state, f, indent=2)
+    report_path = os.path.join(state_dir, 'reports', time.strftime('%Y%m%d-%H%M%S') + '.json')
+    with open(report_path, 'w') as f:
+        json.dump({'workdir': workdir, 'total_wall_s': time.perf_counter() - run_start, 'stages': report}, f,
+                  indent=2)
+    print(f"Timing report saved as '{report_path}'")
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workdir', default='.', help="Folder with the .dta files; outputs are written here")
+    parser.add_argument('--jobs', type=int, default=None, help="Stages run at the same time (default: all cores)")
+    parser.add_argument('--force', nargs='+', default=[], help="Rerun these stages even if fresh")
+    parser.add_argument('--only', nargs='+', default=None, help="Only consider these stages")
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--profile', action='store_true',
+                        help="Record the stages of every script in <workdir>/profile_runs.jsonl (profiling.py)")
+    args = parser.parse_args(argv)
+    if args.profile:
+        # Inherited by the stage scripts through their environment
+        os.environ['PM25_PROFILE'] = '1'
+
+    names = [stage.name for stage in STAGES]
+    for name in args.force + (args.only or []):
+        if name not in names:
+            parser.error(f"unknown stage '{name}', expected one of {names}")
+    report = run(args.workdir, n_jobs=args.jobs, force=args.force, only=args.only, dry_run=args.dry_run)
+    for record in report:
+        line = f"{record['stage']:>15} {record['status']:>9} {record['key'][:8]}"
+        if 'wall_s' in record:
+            line += f" {record['wall_s']:8.1f} s"
+        if record.get('error'):
+            line += f"  {record['error']}"
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
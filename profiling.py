@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Stage-level profiling of the scripts.
+
+Off unless PM25_PROFILE=1 is set in the environment (or `enable()` is
+called). When on, every stage of a run records:
+
+- wall time and CPU time (of this process, and of the worker processes that
+  finished during the stage),
+- peak resident memory during the stage (Linux resets the peak per stage;
+  elsewhere the peak of the run so far is reported),
+- rows processed and the threads of the model / the process.
+
+At exit one JSON line per run is appended to PM25_PROFILE_LOG (default
+'profile_runs.jsonl' in the working directory). PM25_PROFILE_STAGES=fit,importance
+also profiles these stages: cProfile files '<script>.<stage>.prof' (pstats,
+snakeviz), or with PM25_PROFILE_SAMPLER=py-spy a py-spy speedscope profile
+'<script>.<stage>.speedscope.json' when py-spy is installed.
+
+When profiling is off, `section`, `stage` and `note` return after one flag
+check, so the instrumentation can stay in the scripts.
+
+Usage
+-----
+In a script, a section lasts until the next one (or the end of the run):
+
+    section('load')
+    df = load_data('data0327.dta')
+    note(rows=len(df))
+
+In library code:
+
+    with stage('fit', rows=len(y), model=model):
+        model.fit(X, y)
+
+`python profiling.py` prints the stages of the latest runs, with the change
+against the previous run of the same script.
+"""
+import atexit
+import json
+import os
+import platform
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows: no CPU time of worker processes, peak memory from psutil if installed
+    resource = None
+
+ENV_FLAG = 'PM25_PROFILE'
+ENV_LOG = 'PM25_PROFILE_LOG'
+ENV_STAGES = 'PM25_PROFILE_STAGES'
+ENV_SAMPLER = 'PM25_PROFILE_SAMPLER'
+DEFAULT_LOG = 'profile_runs.jsonl'
+# Packages whose versions are recorded (when the run imported them)
+TRACKED_PACKAGES = ['numpy', 'pandas', 'scipy', 'sklearn', 'xgboost', 'lightgbm', 'pyarrow']
+
+_NULL = nullcontext()
+_RUN = None
+
+
+def _env_enabled():
+    return os.environ.get(ENV_FLAG, '').lower() not in ('', '0', 'false', 'no')
+
+
+def _proc_status(field):
+    # Linux: values in kB (VmRSS, VmHWM) or counts (Threads); None elsewhere
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _reset_peak_rss():
+    """Reset the kernel's peak RSS counter (VmHWM); False if not supported."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _max_rss_mb(children=False):
+    if resource is None:
+        if children:
+            return None
+        try:
+            import psutil
+        except ImportError:
+            return None
+        return psutil.Process().memory_info().peak_wset / 1024 ** 2
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def _children_cpu():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _round(value, digits=1):
+    return None if value is None else round(value, digits)
+
+
+def model_threads(model):
+    """Threads a fitted model predicts / trains with (n_jobs, nthread), None if unknown."""
+    n_jobs = getattr(model, 'n_jobs', None)
+    if n_jobs is None and isinstance(getattr(model, 'params', None), dict):
+        # LightGBM Booster
+        n_jobs = model.params.get('num_threads')
+    if n_jobs is None and hasattr(model, 'save_config'):
+        config = json.loads(model.save_config())
+        n_jobs = int(config['learner']['generic_param'].get('nthread', 0))
+    if n_jobs is None:
+        return None
+    return os.cpu_count() if n_jobs in (0, -1) else int(n_jobs)
+
+
+class _Stage:
+    """An open stage: its start readings, then the record written when it closes."""
+
+    def __init__(self, run, name, rows=None, threads=None, model=None):
+        self.run = run
+        self.record = {'stage': name, 'parent': run.stack[-1].record['stage'] if run.stack else None,
+                       'rows': rows, 'threads': threads if model is None else model_threads(model)}
+        self.profiler = None
+        # Peak RSS (kB) seen before the nested stages reset the counter
+        self.peak_seen = 0
+
+    def __enter__(self):
+        current = _proc_status('VmHWM') or 0
+        for outer in self.run.stack:
+            outer.peak_seen = max(outer.peak_seen, current)
+        self.run.stack.append(self)
+        if self.record['stage'] in self.run.profile_stages:
+            self.profiler = self.run.start_profile(self.record['stage'])
+        self.peak_reset = _reset_peak_rss()
+        self.start = (time.perf_counter(), time.process_time(), _children_cpu())
+        return self
+
+    def __exit__(self, *exc):
+        wall, cpu, children = self.start
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        children = _children_cpu() - children
+        if self.profiler is not None:
+            self.record['profile'] = self.run.stop_profile(self.profiler)
+        peak = _proc_status('VmHWM')
+        if peak is not None:
+            peak = max(peak, self.peak_seen)
+        rss = _proc_status('VmRSS')
+        self.record.update({
+            'wall_s': round(wall, 4),
+            'cpu_s': round(cpu, 4),
+            'children_cpu_s': round(children, 4),
+            # > 1 when threads or worker processes ran in parallel
+            'cpu_util': round((cpu + children) / wall, 2) if wall > 0 else None,
+            'rss_mb': None if rss is None else round(rss / 1024, 1),
+            'peak_rss_mb': _round(peak / 1024 if peak is not None else _max_rss_mb()),
+            'peak_scope': 'stage' if self.peak_reset and peak is not None else 'run',
+            'process_threads': _proc_status('Threads'),
+        })
+        if self.record['rows'] and wall > 0:
+            self.record['rows_per_s'] = round(self.record['rows'] / wall, 1)
+        if exc[0] is not None:
+            self.record['error'] = exc[0].__name__
+        self.run.stack.remove(self)
+        for outer in self.run.stack:
+            outer.peak_seen = max(outer.peak_seen, peak or 0)
+        self.run.stages.append(self.record)
+        return False
+
+
+class _Run:
+    """The stages of one script run; written as one JSON line at exit."""
+
+    def __init__(self, log_path=None, profile_stages=None, sampler=None):
+        self.log_path = os.path.abspath(log_path or os.environ.get(ENV_LOG) or DEFAULT_LOG)
+        if profile_stages is None:
+            profile_stages = [s for s in os.environ.get(ENV_STAGES, '').split(',') if s]
+        self.profile_stages = set(profile_stages)
+        self.sampler = sampler or os.environ.get(ENV_SAMPLER, 'cprofile')
+        self.script = os.path.basename(sys.argv[0]) or 'python'
+        self.started = datetime.now().isoformat(timespec='seconds')
+        self.start = (time.perf_counter(), time.process_time())
+        self.stack = []
+        self.stages = []
+        self.section = None
+        atexit.register(self.write)
+
+    def _profile_path(self, name, suffix):
+        stem = os.path.splitext(self.script)[0].replace(' ', '_')
+        return os.path.join(os.path.dirname(self.log_path), f'{stem}.{name}.{suffix}')
+
+    def start_profile(self, name):
+        if self.sampler == 'py-spy' and shutil.which('py-spy'):
+            path = self._profile_path(name, 'speedscope.json')
+            process = subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()), '--format', 'speedscope',
+                                        '--subprocesses', '--output', path],
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            return ('py-spy', process, path)
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return ('cprofile', profiler, self._profile_path(name, 'prof'))
+
+    def stop_profile(self, handle):
+        kind, profiler, path = handle
+        if kind == 'py-spy':
+            # py-spy writes its output when interrupted
+            profiler.send_signal(signal.SIGINT)
+            try:
+                profiler.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                profiler.kill()
+        else:
+            profiler.disable()
+            profiler.dump_stats(path)
+        return path
+
+    def write(self):
+        if self.section is not None:
+            self.section.__exit__(None, None, None)
+            self.section = None
+        wall, cpu = self.start
+        versions = {name: getattr(sys.modules[name], '__version__', None)
+                    for name in TRACKED_PACKAGES if name in sys.modules}
+        record = {
+            'script': self.script,
+            'argv': sys.argv[1:],
+            'started': self.started,
+            'wall_s': round(time.perf_counter() - wall, 4),
+            'cpu_s': round(time.process_time() - cpu, 4),
+            'children_cpu_s': round(_children_cpu(), 4),
+            # The per-stage resets also lower the kernel's peak of the run
+            'peak_rss_mb': _round(max([_max_rss_mb() or 0] + [s['peak_rss_mb'] or 0 for s in self.stages])),
+            'children_peak_rss_mb': _round(_max_rss_mb(children=True)),
+            'host': platform.node(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'versions': versions,
+            'workdir': os.getcwd(),
+            'stages': self.stages,
+        }
+        with open(self.log_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def enable(log_path=None, profile_stages=None, sampler=None):
+    """Start recording this run (as PM25_PROFILE=1 does at import)."""
+    global _RUN
+    if _RUN is None:
+        _RUN = _Run(log_path, profile_stages, sampler)
+    return _RUN
+
+
+def enabled():
+    return _RUN is not None
+
+
+def stage(name, rows=None, threads=None, model=None):
+    """Context manager timing one stage (a no-op when profiling is off)."""
+    if _RUN is None:
+        return _NULL
+    return _Stage(_RUN, name, rows=rows, threads=threads, model=model)
+
+
+def section(name, rows=None, threads=None, model=None):
+    """Close the current section of a script and open the next one."""
+    if _RUN is None:
+        return
+    if _RUN.section is not None:
+        _RUN.section.__exit__(None, None, None)
+    _RUN.section = _Stage(_RUN, name, rows=rows, threads=threads, model=model).__enter__()
+
+
+def note(rows=None, threads=None, model=None):
+    """Set the rows / threads of the innermost open stage."""
+    if _RUN is None or not _RUN.stack:
+        return
+    record = _RUN.stack[-1].record
+    if rows is not None:
+        record['rows'] = int(rows)
+    if model is not None:
+        record['threads'] = model_threads(model)
+    if threads is not None:
+        record['threads'] = threads
+
+
+if _env_enabled():
+    enable()
+
+
+# --- Reading the log ---
+
+def read_runs(log_path=DEFAULT_LOG):
+    with open(log_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summary(runs, last=1):
+    """
+    Stages of the latest `last` run(s) of every script, with the wall-time
+    ratio against the previous run of the same script.
+    """
+    import pandas as pd
+
+    rows = []
+    by_script = {}
+    for run in runs:
+        by_script.setdefault(run['script'], []).append(run)
+    for script, history in by_script.items():
+        for i in range(max(len(history) - last, 0), len(history)):
+            previous = {s['stage']: s for s in history[i - 1]['stages']} if i > 0 else {}
+            for record in history[i]['stages']:
+                before = previous.get(record['stage'])
+                rows.append({
+                    'script': script, 'started': history[i]['started'], 'stage': record['stage'],
+                    'wall_s': record['wall_s'], 'cpu_util': record.get('cpu_util'),
+                    'peak_rss_mb': record.get('peak_rss_mb'), 'rows': record.get('rows'),
+                    'threads': record.get('threads'),
+                    'vs_previous': round(record['wall_s'] / before['wall_s'], 2)
+                    if before and before['wall_s'] > 0 else None,
+                })
+    return pd.DataFrame(rows).astype({'rows': 'Int64'})
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="Summarise the runs recorded with PM25_PROFILE=1.")
+    parser.add_argument('log', nargs='?', default=DEFAULT_LOG)
+    parser.add_argument('--last', type=int, default=1, help="Runs per script to show")
+    args = parser.parse_args()
+    with pd.option_context('display.width', 200, 'display.max_rows', None):
+        print(summary(read_runs(args.log), last=args.last).to_string(index=False))
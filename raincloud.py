@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Aggregate-first raincloud plots for Fig 2(b)-(d).
+
+The raw-row version calls pt.half_violinplot, sns.stripplot and sns.boxplot on
+every transaction, so the KDEs are evaluated on all rows and millions of strip
+markers are drawn. Here each group is first reduced to a fine histogram (plus
+count, sum, sum of squares, min and max) in one vectorized pass; the three
+layers are then drawn from that summary:
+
+- half violin: Gaussian KDE of the binned values, with the bandwidth rule,
+  support, count scaling and placement of pt.half_violinplot;
+- strip: a shaded image whose opacity is the expected share of each pixel
+  covered by the jittered markers, i.e. what the scatter converges to;
+- box: quartiles, whiskers and notches interpolated from the histogram, drawn
+  with Axes.bxp.
+
+Render time and memory depend on the number of bins and groups, not rows.
+Summaries of chunks can be combined with `update` when a fixed `value_range`
+is given.
+"""
+import colorsys
+
+import numpy as np
+import pandas as pd
+import matplotlib as mpl
+import matplotlib.pyplot as plt
+import seaborn as sns
+from matplotlib.colors import to_rgb
+
+# Histogram resolution; quantiles and KDEs are accurate to (max - min) / N_BINS
+N_BINS = 4096
+# Rows of the shaded strip layer (must divide N_BINS)
+STRIP_ROWS = 256
+
+
+class RaincloudSummary:
+    """
+    Per-group histogram and moments of `values`.
+
+    Parameters
+    ----------
+    levels : sequence
+        Group levels, in plotting order.
+    value_range : (float, float)
+        Range covered by the histogram bins. Values outside it go to the edge bins.
+    """
+
+    def __init__(self, levels, value_range, n_bins=N_BINS, name=None):
+        if n_bins % STRIP_ROWS:
+            raise ValueError(f"Error: n_bins must be a multiple of {STRIP_ROWS}.")
+        self.levels = list(levels)
+        self.lo, self.hi = float(value_range[0]), float(value_range[1])
+        self.n_bins = n_bins
+        self.name = name
+        n_groups = len(self.levels)
+        self.hist = np.zeros((n_groups, n_bins))
+        self.count = np.zeros(n_groups)
+        self.sum = np.zeros(n_groups)
+        self.sumsq = np.zeros(n_groups)
+        self.min = np.full(n_groups, np.inf)
+        self.max = np.full(n_groups, -np.inf)
+
+    @classmethod
+    def from_values(cls, groups, values, value_range=None, n_bins=N_BINS):
+        """Summary of one in-memory column; levels are the categories (or sorted unique values) of `groups`."""
+        groups = pd.Series(groups)
+        if isinstance(groups.dtype, pd.CategoricalDtype):
+            levels = groups.cat.categories
+        else:
+            levels = np.sort(groups.dropna().unique())
+        values = np.asarray(values, dtype=np.float64)
+        if value_range is None:
+            value_range = (np.nanmin(values), np.nanmax(values))
+        summary = cls(levels, value_range, n_bins, name=groups.name)
+        return summary.update(groups, values)
+
+    def update(self, groups, values):
+        """Add a chunk of rows (rows with a missing value or an unknown group are skipped)."""
+        codes = pd.Index(self.levels).get_indexer(pd.Series(groups))
+        values = np.asarray(values, dtype=np.float64)
+        keep = (codes >= 0) & ~np.isnan(values)
+        codes, values = codes[keep], values[keep]
+        n_groups = len(self.levels)
+
+        scale = self.n_bins / (self.hi - self.lo) if self.hi > self.lo else 0.0
+        bins = np.clip(((values - self.lo) * scale).astype(np.int64), 0, self.n_bins - 1)
+        self.hist += np.bincount(codes * self.n_bins + bins, minlength=n_groups * self.n_bins).reshape(
+            n_groups, self.n_bins)
+        self.count += np.bincount(codes, minlength=n_groups)
+        self.sum += np.bincount(codes, weights=values, minlength=n_groups)
+        self.sumsq += np.bincount(codes, weights=values * values, minlength=n_groups)
+        extremes = pd.Series(values).groupby(codes).agg(['min', 'max'])
+        self.min[extremes.index] = np.minimum(self.min[extremes.index], extremes['min'])
+        self.max[extremes.index] = np.maximum(self.max[extremes.index], extremes['max'])
+        return self
+
+    @property
+    def centers(self):
+        width = (self.hi - self.lo) / self.n_bins
+        return self.lo + (np.arange(self.n_bins) + 0.5) * width
+
+    def std(self):
+        """Sample standard deviation (ddof=1) of every group."""
+        n = self.count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = (self.sumsq - self.sum ** 2 / n) / (n - 1)
+        return np.sqrt(np.maximum(var, 0.0))
+
+    def densities(self, bw=0.2, cut=0.0, gridsize=100):
+        """
+        KDE support and density of every group, as pt.half_violinplot computes them:
+        scipy's gaussian_kde with bandwidth factor `bw` (kernel sd = bw * std)
+        evaluated on `gridsize` points from min - bw*cut to max + bw*cut.
+        """
+        result = []
+        centers = self.centers
+        for g in range(len(self.levels)):
+            if self.count[g] < 2:
+                # No spread to estimate a bandwidth from: nothing to draw
+                result.append((np.empty(0), np.empty(0)))
+                continue
+            bandwidth = bw * self.std()[g]
+            support = np.linspace(self.min[g] - bandwidth * cut, self.max[g] + bandwidth * cut, gridsize)
+            used = self.hist[g] > 0
+            z = (support[:, None] - centers[used]) / bandwidth
+            density = np.exp(-0.5 * z * z) @ self.hist[g, used] / (self.count[g] * bandwidth * np.sqrt(2 * np.pi))
+            result.append((support, density))
+        return result
+
+    def quantile(self, g, q):
+        """Quantiles of group `g`, linearly interpolated within histogram bins (clipped to min/max)."""
+        cumulative = np.concatenate([[0.0], np.cumsum(self.hist[g])])
+        edges = np.linspace(self.lo, self.hi, self.n_bins + 1)
+        values = np.interp(np.asarray(q) * self.count[g], cumulative, edges)
+        return np.clip(values, self.min[g], self.max[g])
+
+    def box_stats(self, whis=1.5):
+        """Statistics for Axes.bxp, following matplotlib's boxplot_stats (with notches)."""
+        stats = []
+        edges = np.linspace(self.lo, self.hi, self.n_bins + 1)
+        for g, level in enumerate(self.levels):
+            if self.count[g] == 0:
+                continue
+            q1, med, q3 = self.quantile(g, [0.25, 0.5, 0.75])
+            iqr = q3 - q1
+            occupied = np.flatnonzero(self.hist[g])
+            # Most extreme occupied bins inside the whisker reach
+            low = occupied[edges[occupied + 1] >= q1 - whis * iqr]
+            high = occupied[edges[occupied] <= q3 + whis * iqr]
+            whislo = self.min[g] if low[0] == occupied[0] else max(edges[low[0]], q1 - whis * iqr)
+            whishi = self.max[g] if high[-1] == occupied[-1] else min(edges[high[-1] + 1], q3 + whis * iqr)
+            notch = 1.57 * iqr / np.sqrt(self.count[g])
+            stats.append({'label': level, 'med': med, 'q1': q1, 'q3': q3, 'whislo': min(whislo, q1),
+                          'whishi': max(whishi, q3), 'cilo': med - notch, 'cihi': med + notch, 'fliers': []})
+        return stats
+
+
+def _violin_edgecolor(colors):
+    # pt.half_violinplot outlines with a gray darker than the darkest palette color
+    lum = min(colorsys.rgb_to_hls(*to_rgb(c))[1] for c in colors) * 0.6
+    return (lum, lum, lum)
+
+
+def _strip_image(summary, g, color, ax, jitter, size):
+    """RGBA column of the density-shaded strip layer of group `g`."""
+    fig = ax.figure
+    bbox = ax.get_position()
+    # Axes size in points, so the shading does not depend on the output dpi
+    width_pt = bbox.width * fig.get_figwidth() * 72
+    height_pt = bbox.height * fig.get_figheight() * 72
+    (x0, x1), (y0, y1) = ax.get_xlim(), ax.get_ylim()
+    # Coarser rows than the histogram: the scatter's sampling noise is not reproduced
+    hist = summary.hist[g].reshape(STRIP_ROWS, -1).sum(axis=1)
+    row_height_pt = (summary.hi - summary.lo) / STRIP_ROWS * height_pt / abs(y1 - y0)
+    strip_width_pt = 2 * jitter * width_pt / abs(x1 - x0)
+    # Expected share of the area covered by markers of diameter `size` points
+    marker_area = np.pi / 4 * size ** 2
+    markers_per_pt2 = hist / (row_height_pt * strip_width_pt)
+    image = np.zeros((STRIP_ROWS, 1, 4))
+    image[:, 0, :3] = to_rgb(color)
+    image[:, 0, 3] = -np.expm1(-markers_per_pt2 * marker_area)
+    return image
+
+
+def raincloud(summary, ax=None, palette=None, bw=0.2, cut=0.0, width=0.6, offset=0.15, saturation=0.75,
+              jitter=1.0, size=0.25, box_width=0.1, notch=True, medianprops=None, whiskerprops=None):
+    """
+    Draw a raincloud plot (half violin, strip and box) from a RaincloudSummary.
+
+    The defaults reproduce the raw-row calls of Fig 2: half_violinplot(bw=.2,
+    cut=0, scale="count", width=.6), stripplot(size=0.25, jitter=1, zorder=0)
+    and boxplot(color="black", width=.1, notch=True, showfliers=False).
+    Set the y limits before calling, the strip shading uses the axes scale.
+    """
+    ax = ax or plt.gca()
+    n_groups = len(summary.levels)
+    colors = sns.color_palette(palette, n_colors=n_groups)
+    ax.set_xlim(-0.5, n_groups - 0.5)
+
+    # Strip layer
+    for g, color in enumerate(colors):
+        if summary.count[g]:
+            ax.imshow(_strip_image(summary, g, color, ax, jitter, size), origin='lower', aspect='auto',
+                      interpolation='bilinear', zorder=0,
+                      extent=(g - jitter, g + jitter, summary.lo, summary.hi))
+
+    # Half violins, scaled by count: the widest violin is the largest group
+    edgecolor = _violin_edgecolor(colors)
+    max_count = summary.count.max()
+    for g, (support, density) in enumerate(summary.densities(bw, cut)):
+        if support.size < 2:
+            continue
+        density = density / density.max() * summary.count[g] / max_count
+        ax.fill_betweenx(support, g - offset - density * width / 2, g - offset,
+                         facecolor=sns.desaturate(colors[g], saturation), edgecolor=edgecolor,
+                         linewidth=mpl.rcParams['lines.linewidth'])
+
+    # Boxes
+    stats = summary.box_stats()
+    positions = [g for g in range(n_groups) if summary.count[g]]
+    ax.bxp(stats, positions=positions, widths=box_width, shownotches=notch, showfliers=False, showcaps=True,
+           patch_artist=True, manage_ticks=False, zorder=10,
+           boxprops={'facecolor': 'none', 'edgecolor': 'black', 'zorder': 10},
+           whiskerprops=dict({'color': 'black'}, **(whiskerprops or {'linewidth': 2, 'zorder': 10})),
+           capprops={'color': 'black', 'zorder': 10},
+           medianprops=medianprops or {'color': 'black'})
+
+    ax.set_xlim(-0.5, n_groups - 0.5)
+    ax.set_xticks(range(n_groups))
+    ax.set_xticklabels([str(level) for level in summary.levels])
+    if summary.name is not None:
+        ax.set_xlabel(summary.name)
+    return ax
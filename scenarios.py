@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+Counterfactual PM2.5 scenarios over the fitted models.
+
+A scenario replaces logPM, e.g. PM2.5 capped at 75 ug/m3, cut by 20%, or
+another year's daily series, and every model predicts every transaction
+under every scenario:
+
+- IndexModel: the areg / spline regressions of logCash (fe_regression.py,
+  spline_sweep.py, with the card effects recovered from the data) and the
+  logit / spline logit models of miss (logit.py), as probabilities.
+  The part of the index that does not involve PM2.5 is computed once per
+  chunk; the scenarios only change the logPM (or spline) terms, evaluated
+  for all scenarios at once as an (n rows, n scenarios) matrix.
+- TreeModel: XGBoost, LightGBM and random forest models trained on the
+  one-hot matrix of features.py. The matrix of a chunk is built once; for
+  each scenario only the rows whose logPM changes are predicted again, with
+  their logPM entries swapped in.
+
+Chunks of rows are spread over processes and only the sums by day and group
+are kept, so no copy of X_final is made per scenario.
+
+Example
+-------
+    scenarios = [baseline(), cap(75), cap(35), scale(-20), swap_year(daily_pm(df), 2018)]
+    models = {'areg': fe_model(bs5, df), 'xgb': TreeModel(booster, encoder)}
+    table = run_scenarios(df, models, scenarios, by=['Meal'])
+    print(scenario_effects(table))
+"""
+import copy
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from fe_regression import BASELINE_FACTORS
+from features import predict_raw, single_thread
+from spline_sweep import rcs_basis, spline_names
+
+# Rows per task
+CHUNK_SIZE = 200_000
+
+
+# --- Scenarios ---
+
+class Scenario:
+    """A named counterfactual: `transform(logpm, chunk)` returns the new logPM of the chunk's rows."""
+
+    def __init__(self, name, transform):
+        self.name = name
+        self.transform = transform
+
+    def apply(self, logpm, chunk):
+        return np.asarray(self.transform(logpm, chunk), dtype=np.float64)
+
+    def __repr__(self):
+        return f"Scenario({self.name})"
+
+
+def baseline():
+    """The observed PM2.5."""
+    return Scenario('baseline', lambda logpm, chunk: logpm)
+
+
+def cap(threshold):
+    """PM2.5 capped at `threshold` ug/m3 (e.g. 75 or 35, China's daily Grade II and I standards)."""
+    return Scenario(f'cap{threshold:g}', lambda logpm, chunk: np.minimum(logpm, np.log(threshold)))
+
+
+def scale(percent):
+    """PM2.5 changed by `percent` % (-20 cuts it by a fifth)."""
+    return Scenario(f'scale{percent:+g}%', lambda logpm, chunk: logpm + np.log1p(percent / 100))
+
+
+def daily_pm(df, date='Date', pm='logPM'):
+    """Daily logPM series of a panel (PM2.5 is a city-level daily variable)."""
+    return df.groupby(date, observed=True)[pm].mean()
+
+
+def swap_year(daily, year, date='Date'):
+    """
+    logPM of the same calendar day of `year`, from a daily series (daily_pm).
+    Days missing in `year` (and 29 February) keep their observed PM2.5.
+    """
+    source = daily[pd.DatetimeIndex(daily.index).year == year]
+    days = pd.DatetimeIndex(source.index)
+    lookup = pd.Series(source.to_numpy(dtype=np.float64), index=days.month * 100 + days.day)
+
+    def transform(logpm, chunk):
+        dates = pd.DatetimeIndex(chunk[date])
+        position = lookup.index.get_indexer(dates.month * 100 + dates.day)
+        return np.where(position >= 0, lookup.to_numpy()[np.maximum(position, 0)], logpm)
+    return Scenario(f'year{year}', transform)
+
+
+# --- Models ---
+
+class IndexModel:
+    """
+    Predictions of a linear-index model: x'b, plus the card effect of an areg
+    fit, through the logistic link for a logit fit.
+
+    `params` are the coefficients of an FEResult or LogitResult: regressors
+    by column name, dummies of `factors` as '<factor>_<level>', '_cons', and logPM
+    either as itself or, with `knots`, as the spline columns of
+    spline_sweep. Use fe_model for areg results.
+    """
+
+    def __init__(self, params, knots=None, pm='logPM', link='identity', factors=BASELINE_FACTORS,
+                 card_effects=None, absorb='card'):
+        if link not in ('identity', 'logit'):
+            raise ValueError("Error: link must be 'identity' or 'logit'.")
+        self.pm = pm
+        self.knots = None if knots is None else np.asarray(knots, dtype=np.float64)
+        self.link = link
+        self.card_effects = card_effects
+        self.mean_effect = 0.0 if card_effects is None else float(card_effects.mean())
+        self.absorb = absorb
+        pm_names = [pm] if knots is None else spline_names(len(knots))
+        self.pm_params = params.reindex(pm_names).fillna(0.0).to_numpy()
+        self.constant = float(params.get('_cons', 0.0))
+        self.columns = {}
+        self.dummies = {}
+        for name, coef in params.items():
+            if name in pm_names or name == '_cons':
+                continue
+            factor = next((f for f in factors if name.startswith(f + '_')), None)
+            if factor is not None:
+                self.dummies.setdefault(factor, {})[name[len(factor) + 1:]] = coef
+            else:
+                self.columns[name] = coef
+
+    def _pm_terms(self, logpm):
+        if self.knots is None:
+            return logpm * self.pm_params[0]
+        basis = rcs_basis(logpm.ravel(), self.knots)
+        return (basis @ self.pm_params).reshape(logpm.shape)
+
+    def base_index(self, chunk):
+        """The index without its PM2.5 terms."""
+        index = np.full(len(chunk), self.constant)
+        for col, coef in self.columns.items():
+            index += coef * chunk[col].to_numpy(dtype=np.float64)
+        for factor, coefs in self.dummies.items():
+            # One lookup per factor: the coefficient of each distinct level (0 for the base level)
+            values, inverse = np.unique(chunk[factor].to_numpy(), return_inverse=True)
+            index += np.array([coefs.get(f'{value}', 0.0) for value in values])[inverse]
+        if self.card_effects is not None:
+            position = self.card_effects.index.get_indexer(chunk[self.absorb].to_numpy())
+            effects = self.card_effects.to_numpy()
+            index += np.where(position >= 0, effects[np.maximum(position, 0)], self.mean_effect)
+        return index
+
+    def predict(self, chunk, logpm):
+        """Predictions for the (n rows, n scenarios) matrix of logPM values."""
+        index = self.base_index(chunk)[:, None] + self._pm_terms(logpm)
+        return 1.0 / (1.0 + np.exp(-index)) if self.link == 'logit' else index
+
+
+def fe_model(result, df, knots=None, y='logCash', pm='logPM', factors=BASELINE_FACTORS, absorb='card', subset=None):
+    """
+    IndexModel of an areg result, with its card effects (mean of y - x'b per
+    card over the estimation sample `df[subset]`). Cards not in the sample
+    get the average effect. As in AbsorbedData, rows with a missing y,
+    regressor, factor or card are not in the sample.
+    """
+    model = IndexModel(result.params, knots=knots, pm=pm, factors=factors, absorb=absorb)
+    sample = df if subset is None else df[np.asarray(subset, dtype=bool)]
+    columns = [y, pm, absorb] + list(model.columns) + list(model.dummies)
+    complete = sample[columns].notna().all(axis=1).to_numpy()
+    if not complete.all():
+        sample = sample[complete]
+    residual = sample[y].to_numpy(dtype=np.float64) - model.predict(
+        sample, sample[pm].to_numpy(dtype=np.float64)[:, None])[:, 0]
+    codes, cards = pd.factorize(sample[absorb].to_numpy())
+    counts = np.bincount(codes)
+    effects = np.bincount(codes, weights=residual) / counts
+    model.card_effects = pd.Series(effects, index=pd.Index(cards))
+    model.mean_effect = float(effects @ counts / counts.sum())
+    return model
+
+
+class TreeModel:
+    """
+    An XGBoost, LightGBM or random forest model trained on the one-hot
+    matrix of features.py; `encoder` is the FeatureEncoder of that matrix
+    (e.g. FeatureEncoder(numerical_features, categorical_features).fit(df)).
+    """
+
+    def __init__(self, model, encoder, pm='logPM'):
+        self.model = model
+        self.encoder = encoder
+        self.column = encoder.numerical_features.index(pm)
+
+    def predict(self, chunk, logpm):
+        X = self.encoder.transform(chunk)
+        observed = X.data[X.indices == self.column]
+        base = predict_raw(self.model, X)
+        out = np.repeat(base[:, None], logpm.shape[1], axis=1)
+        for s in range(logpm.shape[1]):
+            values = logpm[:, s].astype(X.dtype)
+            rows = np.flatnonzero(values != observed)
+            if len(rows):
+                # Only the rows whose logPM changes are predicted again
+                sub = X[rows]
+                sub.data[sub.indices == self.column] = values[rows]
+                out[rows, s] = predict_raw(self.model, sub)
+        return out
+
+
+# --- Engine ---
+
+# State shared by the worker processes, set once per worker by _init_worker
+_STATE = {}
+
+
+def _init_worker(state):
+    _STATE.update(state)
+    models = dict(_STATE['models'])
+    for name, model in models.items():
+        if isinstance(model, TreeModel):
+            models[name] = copy.copy(model)
+            models[name].model = single_thread(model.model)
+    _STATE['models'] = models
+
+
+def _run_chunk(bounds):
+    """Per-group counts and prediction sums (groups, scenarios, models) of one chunk."""
+    s = _STATE
+    chunk = s['df'].iloc[bounds[0]:bounds[1]]
+    observed = chunk[s['pm']].to_numpy(dtype=np.float64)
+    logpm = np.column_stack([scenario.apply(observed, chunk) for scenario in s['scenarios']])
+    codes, groups = pd.factorize(pd.MultiIndex.from_frame(chunk[s['keys']]))
+    indicator = sp.csr_matrix((np.ones(len(codes)), (codes, np.arange(len(codes)))), shape=(len(groups), len(codes)))
+    sums = np.stack([indicator @ model.predict(chunk, logpm) for model in s['models'].values()], axis=2)
+    return groups, np.bincount(codes, minlength=len(groups)), sums
+
+
+def run_scenarios(df, models, scenarios, by=(), date='Date', pm='logPM', n_jobs=None, chunk_size=CHUNK_SIZE):
+    """
+    Mean prediction of every model under every scenario, by day and group.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Transactions (or meal slots) with the models' variables.
+    models : dict
+        Name -> IndexModel / TreeModel; columns of the result.
+    scenarios : list of Scenario
+    by : list of str
+        Grouping variables besides `date` (e.g. ['Meal'] or ['Gender']).
+
+    Returns
+    -------
+    DataFrame indexed by (scenario, date, *by) with the row count 'n' and one
+    column per model.
+    """
+    names = [scenario.name for scenario in scenarios]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Error: Scenario names must be unique, got {names}.")
+    keys = [date] + list(by)
+    tasks = [(start, min(start + chunk_size, len(df))) for start in range(0, len(df), chunk_size)]
+    state = {'df': df, 'models': models, 'scenarios': scenarios, 'keys': keys, 'pm': pm}
+    n_jobs = min(n_jobs or os.cpu_count(), len(tasks))
+    if n_jobs == 1:
+        _init_worker(state)
+        parts = list(map(_run_chunk, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(state,)) as pool:
+            parts = list(pool.map(_run_chunk, tasks))
+
+    columns = pd.MultiIndex.from_product([names, list(models)], names=['scenario', 'model'])
+    frames = []
+    for groups, counts, sums in parts:
+        frame = pd.DataFrame(sums.reshape(len(groups), -1), index=groups.set_names(keys), columns=columns)
+        frame[('n', '')] = counts
+        frames.append(frame)
+    totals = pd.concat(frames).groupby(level=list(range(len(keys)))).sum()
+    counts = totals.pop(('n', ''))
+    means = totals.div(counts, axis=0).stack(level='scenario', future_stack=True)
+    means = means.reorder_levels(['scenario'] + keys).reindex(names, level='scenario')
+    means.insert(0, 'n', counts.reindex(means.index.droplevel('scenario')).to_numpy())
+    means.columns.name = None
+    return means
+
+
+def scenario_effects(table, reference='baseline', by=()):
+    """
+    Change of each model's mean prediction against the `reference`
+    scenario, over the whole sample or by the grouping variables `by`
+    (days weighted by their number of rows).
+    """
+    models = [c for c in table.columns if c != 'n']
+    weighted = table[models].mul(table['n'], axis=0)
+    levels = ['scenario'] + list(by)
+    totals = weighted.groupby(level=levels, sort=False).sum()
+    means = totals.div(table['n'].groupby(level=levels, sort=False).sum(), axis=0)
+    if by:
+        return means - means.xs(reference, level='scenario')
+    return means - means.loc[reference]
+
+
+if __name__ == '__main__':
+    # Counterfactual PM2.5 scenarios for the baseline and spline models of
+    # logCash (data0327.dta, also the saved XGBoost / LightGBM models when
+    # present) and of miss (Eatingout.dta). Writes scenarios_logCash.csv and
+    # scenarios_miss.csv (by day) and prints the average effects.
+    from data_cache import load_data
+    from features import CATEGORICAL_FEATURES, NUMERICAL_FEATURES, FeatureEncoder
+    from fe_regression import BASELINE_REGRESSORS, AbsorbedData
+    from logit import LogitSpec, fit_logit, frame_chunks
+    from profiling import section
+    from spline_sweep import SPLINE_CONTROLS, choice_sweep, expenditure_sweep
+
+    SCENARIO_KNOTS = 5
+
+    def standard_scenarios(df):
+        daily = daily_pm(df)
+        years = sorted(set(pd.DatetimeIndex(daily.index).year))
+        return ([baseline(), cap(150), cap(75), cap(35), scale(-10), scale(-20), scale(-50)]
+                + [swap_year(daily, year) for year in years])
+
+    section('load')
+    columns = ['Date', 'logCash', 'card', 'Meal'] + BASELINE_REGRESSORS + BASELINE_FACTORS
+    columns += [c for c in NUMERICAL_FEATURES + CATEGORICAL_FEATURES if c not in columns]
+    df = load_data('data0327.dta', columns=columns, float_dtype='float64')
+    section('fit', rows=len(df))
+    knots, spline = expenditure_sweep(df, knots_range=[SCENARIO_KNOTS])[SCENARIO_KNOTS]
+    models = {
+        'areg': fe_model(AbsorbedData(df).fit('logCash', BASELINE_REGRESSORS, factors=BASELINE_FACTORS), df),
+        'spline': fe_model(spline, df, knots=knots),
+    }
+    encoder = FeatureEncoder(NUMERICAL_FEATURES, CATEGORICAL_FEATURES).fit(df)
+    if os.path.exists('xgb_model.json'):
+        import xgboost as xgb
+        models['xgb'] = TreeModel(xgb.Booster(model_file='xgb_model.json'), encoder)
+    if os.path.exists('lgbm_model.txt'):
+        import lightgbm as lgb
+        models['lgbm'] = TreeModel(lgb.Booster(model_file='lgbm_model.txt'), encoder)
+    section('scenarios', rows=len(df))
+    table = run_scenarios(df, models, standard_scenarios(df), by=['Meal'])
+    table.to_csv('scenarios_logCash.csv')
+    print(f"\nlogCash, change against the observed PM2.5\n{scenario_effects(table)}")
+
+    section('load')
+    columns = ['Date', 'miss', 'logPM'] + SPLINE_CONTROLS + BASELINE_FACTORS
+    df = load_data('Eatingout.dta', columns=columns, float_dtype='float64')
+    section('fit', rows=len(df))
+    logit = fit_logit(LogitSpec(df, 'miss', BASELINE_REGRESSORS, BASELINE_FACTORS), frame_chunks(df))
+    knots, spline = choice_sweep(df, knots_range=[SCENARIO_KNOTS])[SCENARIO_KNOTS]
+    models = {'logit': IndexModel(logit.params, link='logit'),
+              'spline': IndexModel(spline.params, knots=knots, link='logit')}
+    section('scenarios', rows=len(df))
+    table = run_scenarios(df, models, standard_scenarios(df))
+    table.to_csv('scenarios_miss.csv')
+    print(f"\nProbability of miss, change against the observed PM2.5\n{scenario_effects(table)}")
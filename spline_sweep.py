@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Restricted cubic spline sensitivity sweep (Sections 2.4 and 3.3 of the .do file).
+
+Python version of the `forvalues i = 3/7 { mkspline ..., nknots(`i') cubic }`
+loops that write Figure3.csv (areg of logCash) and Figure4.csv (logit of miss).
+Knots follow Harrell's percentiles (the
+`mkspline` defaults), the basis is built with vectorized NumPy, and all knot
+counts are fitted concurrently in a process pool. The fixed-effect demeaning of
+the dependent variable and the controls is done once and shared by every knot
+count; only the k-1 spline columns are demeaned per fit. The logit fits are
+warm-started from the linear-in-logPM model, fitted once.
+
+The output CSV keeps the Stata schema (X, spline_est_3 ... spline_est_7) and
+adds 95% confidence bands (spline_lb_k, spline_ub_k). Figure4.csv also holds
+the odds-ratio effects exp(estimate) - 1 (odds_est_k, odds_lb_k, odds_ub_k).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from daily_panel import DailyPanel, fit_day_level
+from fe_regression import BASELINE_FACTORS, AbsorbedData, absorbed_dof, demean, fit_within, group_codes
+from logit import LogitSpec, fit_logit, frame_chunks
+
+# Knot counts of the sensitivity analysis
+SWEEP_KNOTS = range(3, 8)
+# Plotting grid: `gen X = _n*0.25 if _n<26`
+X_GRID = np.arange(1, 26) * 0.25
+# Controls of the spline models (logPM enters through the spline columns)
+SPLINE_CONTROLS = ['logPre', 'rh', 'awin', 'ctemp']
+
+# Knot percentiles used by `mkspline, nknots() cubic` (Harrell 2001)
+HARRELL_PERCENTILES = {
+    3: [10, 50, 90],
+    4: [5, 35, 65, 95],
+    5: [5, 27.5, 50, 72.5, 95],
+    6: [5, 23, 41, 59, 77, 95],
+    7: [2.5, 18.3333, 34.1667, 50, 65.8333, 81.6667, 97.5],
+}
+
+
+def harrell_knots(x, n_knots):
+    """Knot locations at Harrell's percentiles of the non-missing `x` (Stata's default percentile definition)."""
+    x = np.asarray(x, dtype=np.float64)
+    return np.percentile(x[~np.isnan(x)], HARRELL_PERCENTILES[n_knots], method='averaged_inverted_cdf')
+
+
+def rcs_basis(x, knots):
+    """
+    Restricted cubic spline basis as generated by `mkspline ..., cubic`.
+
+    Returns an (n, k-1) array: the first column is x itself, the others are
+    the truncated cubic terms, linear beyond the outer knots and scaled by
+    (t_k - t_1)^2.
+    """
+    x = np.asarray(x, dtype=np.float64)[:, None]
+    t = np.asarray(knots, dtype=np.float64)
+    k = len(t)
+    inner = t[:k - 2]
+    cube = lambda v: np.maximum(v, 0.0) ** 3
+    terms = (cube(x - inner)
+             - cube(x - t[k - 2]) * (t[k - 1] - inner) / (t[k - 1] - t[k - 2])
+             + cube(x - t[k - 1]) * (t[k - 2] - inner) / (t[k - 1] - t[k - 2]))
+    return np.hstack([x, terms / (t[k - 1] - t[0]) ** 2])
+
+
+def spline_names(n_knots):
+    return [f'spline{n_knots}_{j}' for j in range(1, n_knots)]
+
+
+def spline_curve(params, cov, knots, df_resid, n_knots, grid=X_GRID, level=0.95):
+    """
+    Predicted effect sum_j b_j * spline_j(grid) and its confidence band.
+
+    The effect is measured relative to logPM = 0, as in the .do file.
+    """
+    names = spline_names(n_knots)
+    basis = rcs_basis(grid, knots)
+    b = params[names].to_numpy()
+    V = cov.loc[names, names].to_numpy()
+    estimate = basis @ b
+    se = np.sqrt(np.einsum('ij,jk,ik->i', basis, V, basis))
+    crit = stats.t.ppf(0.5 + level / 2, df_resid) if np.isfinite(df_resid) else stats.norm.ppf(0.5 + level / 2)
+    return estimate, estimate - crit * se, estimate + crit * se
+
+
+# --- Expenditure model (Figure 3) ---
+
+# State shared by the worker processes, set once per worker by _init_worker
+_STATE = {}
+
+
+def _init_worker(state):
+    _STATE.update(state)
+
+
+def _fit_expenditure_spline(n_knots):
+    s = _STATE
+    knots = harrell_knots(s['pm'], n_knots)
+    basis = rcs_basis(s['pm'], knots)
+    columns = dict(s['controls'])
+    for name, column in zip(spline_names(n_knots), basis.T):
+        columns[name] = demean(column, s['codes'], s['counts'])
+    result = fit_within(s['y'], columns, s['n_absorbed'], depvar=s['depvar'], sample_key=f'nknots={n_knots}')
+    return n_knots, knots, result
+
+
+def _run_sweep(fit_one, state, knots_range, n_jobs):
+    knots_range = list(knots_range)
+    n_jobs = min(n_jobs or os.cpu_count(), len(knots_range))
+    if n_jobs == 1:
+        _init_worker(state)
+        fits = list(map(fit_one, knots_range))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(state,)) as pool:
+            fits = list(pool.map(fit_one, knots_range))
+    return {n_knots: (knots, result) for n_knots, knots, result in fits}
+
+
+def _day_level_sweep(panel, knots_range, y, pm, absorb):
+    """expenditure_sweep on a DailyPanel: the spline columns are day-level, as every other regressor."""
+    card = group_codes(panel[absorb], allow_missing=True)[0]
+    day_complete = np.logical_and.reduce([panel.daily(col).notna().to_numpy()
+                                          for col in [pm] + SPLINE_CONTROLS + BASELINE_FACTORS])
+    sample = panel[y].notna().to_numpy() & (card >= 0) & day_complete[panel.day]
+    pm_days = panel.daily(pm).to_numpy(dtype=np.float64)
+    fits = {}
+    for n_knots in knots_range:
+        # Knots at the percentiles of the sample transactions, as mkspline places them
+        knots = harrell_knots(pm_days[panel.day[sample]], n_knots)
+        names = spline_names(n_knots)
+        days = panel.days.assign(**dict(zip(names, rcs_basis(pm_days, knots).T)))
+        with_spline = DailyPanel(panel.rows, days, panel.day, panel.date)
+        fits[n_knots] = (knots, fit_day_level(with_spline, y, SPLINE_CONTROLS + names, BASELINE_FACTORS, absorb))
+    return fits
+
+
+def expenditure_sweep(df, knots_range=SWEEP_KNOTS, n_jobs=None, y='logCash', pm='logPM', absorb='card'):
+    """
+    Fit `areg y controls i.vac i.month i.weekday spline*, absorb(card)` for
+    every knot count. Returns {n_knots: (knots, FEResult)}.
+
+    With a daily_panel.DailyPanel whose PM2.5, controls and factors are all
+    day-level, every fit is solved from day-collapsed cross-products
+    (fit_day_level), without demeaning any transaction-level column; the knots
+    are fitted one after the other.
+    """
+    if isinstance(df, DailyPanel) and set([pm] + SPLINE_CONTROLS + BASELINE_FACTORS) <= set(df.day_columns):
+        return _day_level_sweep(df, knots_range, y, pm, absorb)
+    fe = AbsorbedData(df, absorb=absorb)
+    # The sample also drops the rows with a missing PM2.5 (the spline columns)
+    key, y_tilde, controls, counts = fe.design(y, SPLINE_CONTROLS, BASELINE_FACTORS, subset=df[pm].notna())
+    rows, codes = fe._samples[key][:2]
+    pm_values = df[pm].to_numpy(dtype=np.float64)
+    state = {
+        'y': y_tilde,
+        'controls': controls,
+        'pm': pm_values if rows is None else pm_values[rows],
+        'codes': codes,
+        'counts': counts,
+        'n_absorbed': absorbed_dof(codes, counts),
+        'depvar': y,
+    }
+    return _run_sweep(_fit_expenditure_spline, state, knots_range, n_jobs)
+
+
+# --- Consumption choice model (Figure 4) ---
+
+def _fit_choice_spline(n_knots):
+    s = _STATE
+    knots = harrell_knots(s['pm'], n_knots)
+    names = spline_names(n_knots)
+    data = s['df'].assign(**dict(zip(names, rcs_basis(s['pm'], knots).T)))
+    spec = LogitSpec(data, s['depvar'], SPLINE_CONTROLS + names, BASELINE_FACTORS, levels=s['levels'])
+    # The first spline column is logPM itself: start from the linear model
+    start = s['start'].rename({s['pm_name']: names[0]})
+    return n_knots, knots, fit_logit(spec, frame_chunks(data), start=start)
+
+
+def choice_sweep(df, knots_range=SWEEP_KNOTS, n_jobs=None, y='miss', pm='logPM'):
+    """
+    Fit `logit y controls i.vac i.month i.weekday spline*` for every knot count.
+    Returns {n_knots: (knots, LogitResult)}.
+    """
+    columns = [y] + SPLINE_CONTROLS + BASELINE_FACTORS
+    linear_spec = LogitSpec(df, y, [pm] + SPLINE_CONTROLS, BASELINE_FACTORS)
+    linear = fit_logit(linear_spec, frame_chunks(df))
+    state = {
+        'df': df[columns],
+        'pm': df[pm].to_numpy(dtype=np.float64),
+        'pm_name': pm,
+        'levels': linear_spec.levels,
+        'start': linear.params,
+        'depvar': y,
+    }
+    return _run_sweep(_fit_choice_spline, state, knots_range, n_jobs)
+
+
+def sweep_table(fits, grid=X_GRID, odds=False):
+    """
+    Figure3/Figure4.csv layout: X, spline_est_k for every k, then the bands.
+    With `odds=True` (logit fits) the odds-ratio effects are appended too.
+    """
+    table = pd.DataFrame({'X': grid})
+    bands = {}
+    effects = {}
+    for n_knots, (knots, result) in sorted(fits.items()):
+        estimate, lower, upper = spline_curve(result.params, result.cov, knots, result.df_resid, n_knots, grid)
+        table[f'spline_est_{n_knots}'] = estimate
+        bands[f'spline_lb_{n_knots}'] = lower
+        bands[f'spline_ub_{n_knots}'] = upper
+        if odds:
+            effects[f'odds_est_{n_knots}'] = np.expm1(estimate)
+            effects[f'odds_lb_{n_knots}'] = np.expm1(lower)
+            effects[f'odds_ub_{n_knots}'] = np.expm1(upper)
+    return pd.concat([table, pd.DataFrame(bands), pd.DataFrame(effects)], axis=1)
+
+
+if __name__ == '__main__':
+    # Figure3.csv and Figure4.csv, read by '5. Figure2&3&4.py'
+    from daily_panel import load_panel
+    from data_cache import load_data
+    from profiling import section
+
+    section('load')
+    # logCash and card per transaction, the weather and calendar columns per day
+    columns = ['logCash', 'logPM', 'card'] + SPLINE_CONTROLS + BASELINE_FACTORS
+    df = load_panel('data0327.dta', columns=columns, float_dtype='float64')
+    section('fit_expenditure', rows=len(df))
+    fits = expenditure_sweep(df)
+    for n_knots, (knots, result) in sorted(fits.items()):
+        print(f"knots={n_knots}: {np.round(knots, 4)}")
+    sweep_table(fits).to_csv('Figure3.csv', index=False)
+    print("Spline estimates saved as 'Figure3.csv'")
+
+    section('load')
+    columns = ['miss', 'logPM'] + SPLINE_CONTROLS + BASELINE_FACTORS
+    df = load_data('Eatingout.dta', columns=columns, float_dtype='float64')
+    section('fit_choice', rows=len(df))
+    fits = choice_sweep(df)
+    sweep_table(fits, odds=True).to_csv('Figure4.csv', index=False)
+    print("Spline estimates saved as 'Figure4.csv'")
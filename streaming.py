@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Out-of-core training for the XGBoost and LightGBM scripts.
+
+The data is read from the columnar cache (data_cache.py) in row chunks and
+never materialised as one X_final:
+
+- XGBoost: a DataIter feeds sparse CSR chunks (features.FeatureEncoder) into a
+  QuantileDMatrix, which keeps only the quantised matrix in memory. With
+  `external_memory_dir` the quantised pages are written to disk as well
+  (ExtMemQuantileDMatrix).
+- LightGBM: one lgb.Sequence per `chunk_size` rows of a Parquet row group,
+  decoded only when LightGBM reads it. LightGBM samples rows for binning and
+  then pushes the rows batch by batch. The Dataset needs dense
+  batches, so `card` and the other factors are passed as native categorical
+  columns instead of thousands of one-hot columns.
+
+Peak memory is bounded by `chunk_size` (plus the label vector and the
+model's binned data), not by the number of rows.
+"""
+import os
+
+import numpy as np
+import lightgbm as lgb
+import xgboost as xgb
+
+from data_cache import cache_metadata, iter_chunks, iter_row_group, row_group_sizes
+from features import TARGET_VARIABLE, FeatureEncoder
+
+# Rows per chunk read from the cache
+CHUNK_SIZE = 100_000
+
+# Same settings as XGBRegressor(...) in '2. Xgboost.py'
+XGB_PARAMS = {'objective': 'reg:squarederror', 'learning_rate': 0.1, 'max_depth': 5,
+              'tree_method': 'hist', 'seed': 42}
+XGB_ROUNDS = 100
+# Same settings as LGBMRegressor(random_state=42) in '3. LightGBM.py'
+LGB_PARAMS = {'objective': 'regression', 'seed': 42, 'verbose': -1}
+LGB_ROUNDS = 100
+
+
+def streaming_encoder(file_path, numerical_features=None, categorical_features=None):
+    """FeatureEncoder fitted from the category levels stored in the cache metadata (no data pass)."""
+    levels = cache_metadata(file_path)['categories']
+    encoder = FeatureEncoder(numerical_features, categorical_features)
+    return encoder.fit(None, levels=levels)
+
+
+# --- XGBoost ---
+
+class ChunkIter(xgb.DataIter):
+    """Feeds sparse feature chunks from the cache to XGBoost."""
+
+    def __init__(self, file_path, encoder, target=TARGET_VARIABLE, chunk_size=CHUNK_SIZE, cache_prefix=None):
+        self.file_path = file_path
+        self.encoder = encoder
+        self.target = target
+        self.chunk_size = chunk_size
+        self.columns = [target] + encoder.numerical_features + encoder.categorical_features
+        self._chunks = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self._chunks is None:
+            self._chunks = iter_chunks(self.file_path, columns=self.columns, chunk_size=self.chunk_size)
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            return False
+        input_data(data=self.encoder.transform(chunk), label=chunk[self.target].to_numpy(),
+                   feature_names=self.encoder.feature_names_)
+        return True
+
+    def reset(self):
+        self._chunks = None
+
+
+def xgb_streaming_dmatrix(file_path, encoder=None, chunk_size=CHUNK_SIZE, external_memory_dir=None, max_bin=256):
+    """
+    Build the XGBoost training matrix chunk by chunk.
+
+    In memory by default (QuantileDMatrix: only the quantised values are kept);
+    with `external_memory_dir` the pages are cached on disk.
+    """
+    encoder = encoder or streaming_encoder(file_path)
+    if external_memory_dir is None:
+        return xgb.QuantileDMatrix(ChunkIter(file_path, encoder, chunk_size=chunk_size), max_bin=max_bin)
+    os.makedirs(external_memory_dir, exist_ok=True)
+    cache_prefix = os.path.join(external_memory_dir, 'xgb_cache')
+    data_iter = ChunkIter(file_path, encoder, chunk_size=chunk_size, cache_prefix=cache_prefix)
+    if hasattr(xgb, 'ExtMemQuantileDMatrix'):
+        return xgb.ExtMemQuantileDMatrix(data_iter, max_bin=max_bin)
+    # Older XGBoost: a DMatrix built from an iterator with a cache prefix is external memory
+    return xgb.DMatrix(data_iter)
+
+
+def train_xgboost_streaming(file_path, params=None, num_boost_round=XGB_ROUNDS, chunk_size=CHUNK_SIZE,
+                            external_memory_dir=None):
+    """Train the XGBoost model of '2. Xgboost.py' out of core. Returns the Booster."""
+    dtrain = xgb_streaming_dmatrix(file_path, chunk_size=chunk_size, external_memory_dir=external_memory_dir)
+    return xgb.train(dict(XGB_PARAMS, **(params or {})), dtrain, num_boost_round=num_boost_round)
+
+
+# --- LightGBM ---
+
+class ChunkSequence(lgb.Sequence):
+    """
+    Chunk number `chunk` (of `batch_size` rows) of one Parquet row group of
+    the cache as a LightGBM Sequence.
+
+    Only the most recently used chunk is kept decoded (shared by all
+    instances), so at most `batch_size` rows are held at a time. The chunks
+    of a row group are read from one batch reader that is kept open: LightGBM's
+    sorted sampling and sequential pushes ask for them in order, so each
+    chunk is decoded about twice in total.
+    """
+
+    _loaded = (None, None)
+    # Batch reader of a row group and the key of the chunk it yields next
+    _reader = (None, None)
+
+    def __init__(self, file_path, row_group, chunk, n_rows, encoder, batch_size):
+        self.file_path = file_path
+        self.row_group = row_group
+        self.chunk = chunk
+        self.n_rows = n_rows
+        self.encoder = encoder
+        self.batch_size = batch_size
+
+    def _matrix(self):
+        key = (self.file_path, self.row_group, self.chunk)
+        if ChunkSequence._loaded[0] != key:
+            ChunkSequence._loaded = (None, None)
+            if ChunkSequence._reader[0] != key:
+                # Out of order: start again at the beginning of the row group
+                columns = self.encoder.numerical_features + self.encoder.categorical_features
+                reader = iter_row_group(self.file_path, self.row_group, columns=columns,
+                                        chunk_size=self.batch_size)
+                for _ in range(self.chunk):
+                    next(reader)
+            else:
+                reader = ChunkSequence._reader[1]
+            chunk = next(reader)
+            ChunkSequence._reader = ((self.file_path, self.row_group, self.chunk + 1), reader)
+            ChunkSequence._loaded = (key, self.encoder.transform_codes(chunk))
+        return ChunkSequence._loaded[1]
+
+    def __getitem__(self, idx):
+        return self._matrix()[idx]
+
+    def __len__(self):
+        return self.n_rows
+
+
+def lgb_streaming_dataset(file_path, encoder=None, chunk_size=CHUNK_SIZE, target=TARGET_VARIABLE, params=None):
+    """
+    Build the LightGBM Dataset incrementally from the cache row groups.
+
+    Columns are numerical_features + categorical_features, the latter as
+    integer codes declared as categorical features.
+    """
+    encoder = encoder or streaming_encoder(file_path)
+    seqs = [ChunkSequence(file_path, i, start // chunk_size, min(chunk_size, n - start), encoder, chunk_size)
+            for i, n in enumerate(row_group_sizes(file_path)) for start in range(0, n, chunk_size)]
+    label = np.concatenate([chunk[target].to_numpy(dtype=np.float32)
+                            for chunk in iter_chunks(file_path, columns=[target], chunk_size=chunk_size)])
+    feature_names = encoder.numerical_features + encoder.categorical_features
+    return lgb.Dataset(seqs, label=label, feature_name=feature_names,
+                       categorical_feature=encoder.categorical_features,
+                       params=dict(LGB_PARAMS, **(params or {})), free_raw_data=True)
+
+
+def train_lightgbm_streaming(file_path, params=None, num_boost_round=LGB_ROUNDS, chunk_size=CHUNK_SIZE):
+    """
+    Train the LightGBM model of '3. LightGBM.py' out of core. Returns the
+    Booster; booster.feature_importance() is the equivalent of
+    LGBMRegressor.feature_importances_.
+    """
+    train_set = lgb_streaming_dataset(file_path, chunk_size=chunk_size, params=params)
+    return lgb.train(dict(LGB_PARAMS, **(params or {})), train_set, num_boost_round=num_boost_round)
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic panels with the schemas of data0327.dta and Eatingout.dta.
+
+The raw transaction data cannot be shared, so this module writes stand-in
+datasets with every column the .do file and the Python scripts use, at any
+scale. Generation is split into shards that run in parallel; each shard has
+its own seed (derived from the master seed and the shard number), so the
+output does not depend on the number of worker processes.
+
+Outcomes are generated from known ("planted") coefficients:
+
+- logCash = card effect + month/weekday effects + EXPENDITURE_COEFFICIENTS . x + noise
+- miss ~ Bernoulli(logistic(CHOICE_COEFFICIENTS . x + month/weekday effects))
+
+so estimator changes can be checked for correctness as well as speed
+(`--check` fits both models on the generated data and prints the estimates).
+
+Usage
+-----
+    python synthetic_data.py --rows 1000000 --cards 5000 --out synthetic
+    python synthetic_data.py --rows 100000000 --shards 40 --formats parquet
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Planted coefficients of the expenditure model (areg logCash ..., absorb(card))
+EXPENDITURE_COEFFICIENTS = {'logPM': -0.05, 'logPre': 0.01, 'rh': -0.001, 'awin': 0.005,
+                            'ctemp': -0.002, 'vacation': -0.03}
+# Planted coefficients of the consumption choice model (logit miss ...)
+CHOICE_COEFFICIENTS = {'_cons': -2.0, 'logPM': 0.3, 'logPre': 0.05, 'rh': 0.005, 'awin': -0.02,
+                       'ctemp': -0.01, 'vacation': 0.2}
+
+FIRST_DATE = '2019-03-01'
+N_DAYS = 245
+# Random-stream ids: keep the day and student tables independent of the shards
+_DAY_STREAM, _STUDENT_STREAM, _SHARD_STREAM = 0, 1, 2
+
+
+def day_table(n_days=N_DAYS, seed=0, first_date=FIRST_DATE):
+    """
+    Daily weather, pollution and calendar variables (identical for every shard).
+
+    PM2.5 follows an AR(1) in logs; the lagged columns come from two extra
+    pre-sample days so they have no missing values.
+    """
+    rng = np.random.default_rng([seed, _DAY_STREAM])
+    n = n_days + 2
+    log_pm = np.empty(n)
+    log_pm[0] = 4.0
+    shocks = rng.normal(0.0, 0.45, n)
+    for t in range(1, n):
+        log_pm[t] = 4.0 + 0.6 * (log_pm[t - 1] - 4.0) + shocks[t]
+
+    dates = pd.date_range(first_date, periods=n_days)
+    season = np.cos(2 * np.pi * (dates.dayofyear.to_numpy() - 200) / 365.25)
+    ctemp = 12.0 + 14.0 * season + rng.normal(0.0, 2.5, n_days)
+    rain = np.where(rng.random(n_days) < 0.25, rng.gamma(1.2, 6.0, n_days), 0.0)
+    days = pd.DataFrame({
+        'Date': dates,
+        'month': dates.month.astype(np.int8),
+        'weekday': dates.weekday.astype(np.int8),
+        'vacation': (rng.random(n_days) < 0.08).astype(np.int8),
+        'logPM': log_pm[2:],
+        'L1logPM': log_pm[1:-1],
+        'L2logPM': log_pm[:-2],
+        'total_pre': rain,
+        'logPre': np.log1p(rain),
+        'rh': np.clip(55.0 + 15.0 * season + rng.normal(0.0, 12.0, n_days), 5.0, 100.0),
+        'awin': rng.gamma(2.5, 0.8, n_days),
+        'ctemp': ctemp,
+        'maxtemp': ctemp + rng.uniform(3.0, 8.0, n_days),
+        'mintemp': ctemp - rng.uniform(3.0, 8.0, n_days),
+        'atemp': ctemp + rng.normal(0.0, 0.5, n_days),
+    })
+    days['logAPM'] = days['logPM'] + rng.normal(0.0, 0.05, n_days)
+    days['logMaxPM'] = days['logPM'] + rng.gamma(2.0, 0.2, n_days)
+    days['PM'] = np.exp(days['logPM'])
+    days['APM25'] = np.exp(days['logMaxPM'])
+    # Calendar effects, not reported in the tables but present in the outcomes
+    days['month_effect'] = rng.normal(0.0, 0.05, 13)[days['month']]
+    days['weekday_effect'] = rng.normal(0.0, 0.03, 7)[days['weekday']]
+    return days
+
+
+def student_table(n_cards, seed=0):
+    """Card-level attributes: gender, degree type and the individual effect."""
+    rng = np.random.default_rng([seed, _STUDENT_STREAM])
+    return pd.DataFrame({
+        'card': np.arange(100_001, 100_001 + n_cards, dtype=np.int32),
+        'Gender': (rng.random(n_cards) < 0.55).astype(np.int8),
+        'Type': rng.choice(np.array([1, 2, 3], dtype=np.int8), n_cards, p=[0.6, 0.3, 0.1]),
+        'card_effect': rng.normal(0.0, 0.3, n_cards),
+    })
+
+
+def _linear_index(frame, coefficients):
+    index = np.full(len(frame), coefficients.get('_cons', 0.0))
+    for name, coef in coefficients.items():
+        if name != '_cons':
+            index += coef * frame[name].to_numpy(dtype=np.float64)
+    return index
+
+
+def generate_shard(kind, shard, n_rows, card_range, n_cards, n_days=N_DAYS, seed=0,
+                   expenditure=None, choice=None):
+    """
+    Rows of one shard. Every shard owns a contiguous range of cards, so all
+    rows of a student are in the same shard.
+
+    kind : 'data0327' (transactions, logCash) or 'Eatingout' (meal slots, miss)
+    """
+    rng = np.random.default_rng([seed, _SHARD_STREAM, 0 if kind == 'data0327' else 1, shard])
+    days = day_table(n_days, seed)
+    students = student_table(n_cards, seed).iloc[card_range[0]:card_range[1]].reset_index(drop=True)
+
+    df = days.iloc[rng.integers(0, n_days, n_rows)].reset_index(drop=True)
+    df = pd.concat([df, students.iloc[rng.integers(0, len(students), n_rows)].reset_index(drop=True)], axis=1)
+    df['Meal'] = rng.choice(np.array([1, 2, 3], dtype=np.int8), n_rows, p=[0.25, 0.45, 0.30])
+    calendar = df['month_effect'].to_numpy() + df['weekday_effect'].to_numpy()
+
+    if kind == 'data0327':
+        meal_effect = np.array([0.0, -0.6, 0.2, 0.1])[df['Meal']]
+        log_cash = (2.3 + df['card_effect'].to_numpy() + meal_effect + calendar
+                    + _linear_index(df, expenditure or EXPENDITURE_COEFFICIENTS)
+                    + rng.normal(0.0, 0.35, n_rows))
+        df['logCash'] = log_cash
+        df['cash'] = np.round(np.exp(log_cash) * 100)
+        df = df.drop(columns=['card_effect', 'month_effect', 'weekday_effect'])
+    elif kind == 'Eatingout':
+        eta = calendar + _linear_index(df, choice or CHOICE_COEFFICIENTS)
+        df['miss'] = (rng.random(n_rows) < 1.0 / (1.0 + np.exp(-eta))).astype(np.int8)
+        # The Stata file uses lower-case names for the student attributes
+        df = df.drop(columns=['card_effect', 'month_effect', 'weekday_effect', 'Meal'])
+        df = df.rename(columns={'Gender': 'gender', 'Type': 'type'})
+    else:
+        raise ValueError(f"Unknown dataset '{kind}', expected 'data0327' or 'Eatingout'")
+
+    # Compact storage types, as data_cache would produce
+    for col in df.columns:
+        if df[col].dtype == np.float64:
+            df[col] = df[col].astype(np.float32)
+    return df
+
+
+def shard_plan(n_rows, n_cards, n_shards):
+    """(rows, (first card, last card + 1)) for every shard."""
+    row_edges = np.linspace(0, n_rows, n_shards + 1).astype(int)
+    card_edges = np.linspace(0, n_cards, n_shards + 1).astype(int)
+    return [(int(row_edges[i + 1] - row_edges[i]), (int(card_edges[i]), int(card_edges[i + 1])))
+            for i in range(n_shards)]
+
+
+def _write_shard(task):
+    kind, shard, n_rows, card_range, n_cards, n_days, seed, out_dir, formats, single = task
+    df = generate_shard(kind, shard, n_rows, card_range, n_cards, n_days, seed)
+    stem = kind if single else f'{kind}_part{shard:05d}'
+    paths = []
+    if 'parquet' in formats:
+        paths.append(os.path.join(out_dir, stem + '.parquet'))
+        df.to_parquet(paths[-1], index=False)
+    if 'dta' in formats:
+        paths.append(os.path.join(out_dir, stem + '.dta'))
+        df.to_stata(paths[-1], write_index=False, convert_dates={'Date': 'td'}, version=118)
+    return paths
+
+
+def generate(kind, n_rows, n_cards, out_dir='.', n_shards=1, n_jobs=None, seed=0, n_days=N_DAYS,
+             formats=('dta',)):
+    """
+    Write a synthetic dataset as one file per shard and format.
+
+    With a single shard the file is named like the real one (data0327.dta,
+    Eatingout.dta), so the scripts run on it unchanged.
+    """
+    if n_cards < n_shards:
+        raise ValueError("Error: Need at least one card per shard.")
+    os.makedirs(out_dir, exist_ok=True)
+    single = n_shards == 1
+    tasks = [(kind, shard, rows, cards, n_cards, n_days, seed, out_dir, tuple(formats), single)
+             for shard, (rows, cards) in enumerate(shard_plan(n_rows, n_cards, n_shards))]
+    n_jobs = min(n_jobs or os.cpu_count(), len(tasks))
+    if n_jobs == 1:
+        written = list(map(_write_shard, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            written = list(pool.map(_write_shard, tasks))
+    return [path for paths in written for path in paths]
+
+
+def _compare(result, planted):
+    # The vacation dummy is reported as vacation_1
+    names = {name: 'vacation_1' if name == 'vacation' else name for name in planted}
+    return pd.DataFrame({
+        'planted': pd.Series(planted),
+        'estimate': pd.Series({name: result.params[names[name]] for name in planted}),
+        'std err': pd.Series({name: result.bse[names[name]] for name in planted}),
+    })
+
+
+def check(out_dir='.'):
+    """Fit the baseline models on single-shard Parquet output and compare with the planted coefficients."""
+    from fe_regression import BASELINE_FACTORS, BASELINE_REGRESSORS, AbsorbedData
+    from logit import LogitSpec, fit_logit, frame_chunks
+
+    df = pd.read_parquet(os.path.join(out_dir, 'data0327.parquet'))
+    result = AbsorbedData(df, absorb='card').fit('logCash', BASELINE_REGRESSORS, factors=BASELINE_FACTORS)
+    print(f"data0327: areg logCash, absorb(card)\n{_compare(result, EXPENDITURE_COEFFICIENTS)}")
+
+    df = pd.read_parquet(os.path.join(out_dir, 'Eatingout.parquet'))
+    result = fit_logit(LogitSpec(df, 'miss'), frame_chunks(df))
+    print(f"\nEatingout: logit miss\n{_compare(result, CHOICE_COEFFICIENTS)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kind', nargs='+', default=['data0327', 'Eatingout'], choices=['data0327', 'Eatingout'])
+    parser.add_argument('--rows', type=int, default=1_000_000, help="Rows per dataset")
+    parser.add_argument('--cards', type=int, default=5_000, help="Number of students")
+    parser.add_argument('--days', type=int, default=N_DAYS)
+    parser.add_argument('--shards', type=int, default=1)
+    parser.add_argument('--jobs', type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--formats', nargs='+', default=['dta', 'parquet'], choices=['dta', 'parquet'])
+    parser.add_argument('--out', default='.')
+    parser.add_argument('--check', action='store_true', help="Re-estimate the planted coefficients (single shard)")
+    args = parser.parse_args(argv)
+
+    for kind in args.kind:
+        paths = generate(kind, args.rows, args.cards, args.out, args.shards, args.jobs, args.seed, args.days,
+                         args.formats)
+        print(f"{kind}: wrote {len(paths)} file(s) to '{args.out}'")
+    if args.check:
+        check(args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+"""
+Budgeted hyperparameter search for the XGBoost and LightGBM scripts.
+
+The scripts train with fixed settings (XGBRegressor(n_estimators=100,
+learning_rate=0.1, max_depth=5), LGBMRegressor() defaults) that are never
+checked out of sample. `search` tunes them:
+
+- validation is time-blocked: the last `valid_share` of the days (by `Date`)
+  is held out, the model is trained on the earlier days;
+- trials are random configurations (trial 0 is the current fixed setting),
+  compared by successive halving on the number of boosting rounds: every
+  trial gets `min_rounds`, the best 1/`eta` continue to `eta` times as many
+  rounds, and so on up to `max_rounds`. Promoted XGBoost trials continue
+  training from their booster (LightGBM cannot continue on a Dataset loaded
+  from binary, so its trials are retrained, which costs at most
+  1/(eta - 1) more rounds). A trial that early-stops on the validation days
+  is not trained further;
+- LightGBM bins the training days once, in the main process, and the
+  workers load the saved binary Dataset. A QuantileDMatrix cannot be saved or
+  shared between processes, so each XGBoost worker bins its own copy once and
+  reuses it for all of its trials; `n_parallel` is then capped so that the
+  copies fit in `XGB_MEMORY_SHARE` of the available memory;
+- `n_parallel` trials run at the same time, each with
+  `max_threads // n_parallel` threads;
+- no new trial starts after `budget` seconds and running trials stop at
+  the deadline (with their best score so far).
+
+Outputs (in the working directory): tuning_<model>_best.json with the best
+parameters and number of rounds, and tuning_<model>_trials.csv with one row
+per trial and rung (parameters, rounds, validation RMSE, wall and CPU time).
+
+Usage
+-----
+    python tuning.py --model lgbm --budget 1800
+    best = search('data0327.dta', model='xgb', budget=600)
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+import xgboost as xgb
+
+from data_cache import load_data
+from features import CATEGORICAL_FEATURES, NUMERICAL_FEATURES, TARGET_VARIABLE, feature_matrix_info, load_feature_matrix
+from streaming import LGB_PARAMS, XGB_PARAMS
+
+# Share of the days (the most recent ones) used for validation
+VALID_SHARE = 0.2
+MIN_ROUNDS = 50
+MAX_ROUNDS = 1350
+ETA = 3
+EARLY_STOPPING_ROUNDS = 20
+MAX_BIN = 256
+# Binning settings of the shared LightGBM Dataset; min_child_samples is tuned, so no
+# features are dropped by the pre-filter that depends on it
+LGB_DATASET_PARAMS = {'max_bin': MAX_BIN, 'feature_pre_filter': False, 'verbose': -1}
+# Share of the available memory the per-worker XGBoost data may take
+XGB_MEMORY_SHARE = 0.5
+
+# The fixed settings of '2. Xgboost.py' / '3. LightGBM.py' (trial 0). Parameter names are those
+# of XGBRegressor / LGBMRegressor, so the best configuration can be passed to set_params
+BASELINES = {
+    'xgb': {'learning_rate': 0.1, 'max_depth': 5},
+    'lgbm': {'learning_rate': 0.1, 'num_leaves': 31, 'min_child_samples': 20},
+}
+
+
+def sample_params(model, rng):
+    """A random configuration of the search space of `model` ('xgb' or 'lgbm')."""
+    if model == 'xgb':
+        return {
+            'learning_rate': float(np.exp(rng.uniform(np.log(0.02), np.log(0.3)))),
+            'max_depth': int(rng.integers(3, 11)),
+            'min_child_weight': float(np.exp(rng.uniform(0, np.log(100)))),
+            'subsample': float(rng.uniform(0.5, 1.0)),
+            'colsample_bytree': float(rng.uniform(0.5, 1.0)),
+            'reg_lambda': float(np.exp(rng.uniform(np.log(1e-3), np.log(10)))),
+        }
+    if model == 'lgbm':
+        return {
+            'learning_rate': float(np.exp(rng.uniform(np.log(0.02), np.log(0.3)))),
+            'num_leaves': int(np.exp(rng.uniform(np.log(15), np.log(256)))),
+            'min_child_samples': int(np.exp(rng.uniform(np.log(10), np.log(500)))),
+            'colsample_bytree': float(rng.uniform(0.5, 1.0)),
+            'subsample': float(rng.uniform(0.5, 1.0)),
+            'subsample_freq': 1,
+            'reg_lambda': float(np.exp(rng.uniform(np.log(1e-3), np.log(10)))),
+        }
+    raise ValueError(f"Error: unknown model '{model}', expected 'xgb' or 'lgbm'.")
+
+
+def time_split(dates, valid_share=VALID_SHARE):
+    """Boolean mask of the validation rows: the last `valid_share` of the distinct days."""
+    days = np.unique(dates)
+    if len(days) < 2:
+        raise ValueError("Error: a time-blocked split needs at least two distinct dates.")
+    cutoff = days[min(len(days) - 1, int(np.floor(len(days) * (1 - valid_share))))]
+    return np.asarray(dates >= cutoff)
+
+
+def load_split(file_path, numerical_features=None, categorical_features=None, target=TARGET_VARIABLE,
+               valid_share=VALID_SHARE):
+    """Cached feature matrix, label and validation mask of a .dta file."""
+    X, feature_names = load_feature_matrix(file_path, numerical_features, categorical_features)
+    df = load_data(file_path, columns=['Date', target])
+    return X, df[target].to_numpy(dtype=np.float32), time_split(df['Date'].to_numpy(), valid_share), feature_names
+
+
+# --- Workers ---
+
+# State shared by the worker processes, set once per worker by _init_worker
+_STATE = {}
+
+
+def _init_worker(state):
+    _STATE.update(state)
+    if state['model'] == 'lgbm':
+        # Bins computed once by _save_lgb_bins
+        train = lgb.Dataset(state['train_path'], params=LGB_DATASET_PARAMS)
+        _STATE['train'] = train
+        _STATE['valid'] = lgb.Dataset(state['valid_path'], reference=train, params=LGB_DATASET_PARAMS)
+    else:
+        X, y, valid, _ = load_split(state['file_path'], state['numerical'], state['categorical'],
+                                    state['target'], state['valid_share'])
+        train = xgb.QuantileDMatrix(X[~valid], y[~valid], max_bin=MAX_BIN, nthread=state['threads'])
+        _STATE['train'] = train
+        _STATE['valid'] = xgb.QuantileDMatrix(X[valid], y[valid], ref=train, nthread=state['threads'])
+
+
+def _available_memory():
+    """Available physical memory in bytes (MemAvailable on Linux, psutil elsewhere), None if unknown."""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.virtual_memory().available
+
+
+def _xgb_worker_bytes(state):
+    """
+    Peak memory of one XGBoost worker's data: the feature matrix and label
+    read by _init_worker, and the QuantileDMatrix (a bin index per stored
+    entry and a row offset per row) built from it. Estimated from the cached
+    matrix's headers, without loading it.
+    """
+    info = feature_matrix_info(state['file_path'], state['numerical'], state['categorical'])
+    n_rows = info['shape'][0]
+    # float32 label
+    return info['nbytes'] + n_rows * 4 + info['nnz'] * 4 + n_rows * 8
+
+
+def _save_lgb_bins(state, folder, threads):
+    """Bin the training and validation days once and save both as LightGBM binary Datasets."""
+    X, y, valid, feature_names = load_split(state['file_path'], state['numerical'], state['categorical'],
+                                            state['target'], state['valid_share'])
+    params = dict(LGB_PARAMS, **LGB_DATASET_PARAMS, num_threads=threads)
+    train = lgb.Dataset(X[~valid], y[~valid], feature_name=feature_names, params=params)
+    train.construct().save_binary(os.path.join(folder, 'train.bin'))
+    lgb.Dataset(X[valid], y[valid], reference=train, params=params).construct().save_binary(
+        os.path.join(folder, 'valid.bin'))
+    return os.path.join(folder, 'train.bin'), os.path.join(folder, 'valid.bin')
+
+
+class _Deadline(xgb.callback.TrainingCallback):
+    def __init__(self, deadline):
+        self.deadline = deadline
+        super().__init__()
+
+    def after_iteration(self, model, epoch, evals_log):
+        return time.time() > self.deadline
+
+
+def _lgb_deadline(deadline):
+    def callback(env):
+        if time.time() > deadline:
+            raise lgb.callback.EarlyStopException(env.iteration, env.evaluation_result_list)
+    callback.order = 40
+    return callback
+
+
+def _train_trial(trial, params, rounds, booster, deadline):
+    """
+    Train one trial to `rounds` boosting rounds, continuing from `booster`
+    (XGBoost). Returns a dict with the booster, its validation RMSE and the costs.
+    """
+    s = _STATE
+    start, cpu_start = time.perf_counter(), time.process_time()
+    if s['model'] == 'xgb':
+        done = 0 if booster is None else booster.num_boosted_rounds()
+        evals_result = {}
+        booster = xgb.train(dict(XGB_PARAMS, nthread=s['threads'], eval_metric='rmse', **params), s['train'],
+                            num_boost_round=rounds - done, evals=[(s['valid'], 'valid')], xgb_model=booster,
+                            early_stopping_rounds=EARLY_STOPPING_ROUNDS, evals_result=evals_result,
+                            verbose_eval=False, callbacks=[_Deadline(deadline)])
+        scores = evals_result['valid']['rmse']
+        best_iteration = done + int(np.argmin(scores))
+        trained = booster.num_boosted_rounds()
+    else:
+        evals_result = {}
+        params = dict(LGB_PARAMS, **LGB_DATASET_PARAMS, num_threads=s['threads'], metric='rmse', **params)
+        model = lgb.train(params, s['train'], num_boost_round=rounds, valid_sets=[s['valid']], valid_names=['valid'],
+                          callbacks=[lgb.early_stopping(EARLY_STOPPING_ROUNDS, verbose=False),
+                                     lgb.record_evaluation(evals_result), _lgb_deadline(deadline)])
+        scores = evals_result['valid']['rmse']
+        best_iteration = int(np.argmin(scores))
+        trained = len(scores)
+        # Nothing to continue from: only the score goes back to the main process
+        booster = None
+        del model
+    return {
+        'trial': trial,
+        'booster': booster,
+        'rounds': trained,
+        'best_iteration': best_iteration,
+        'valid_rmse': float(np.min(scores)),
+        # Stopped before the rung budget: early stopping or the deadline
+        'stopped': trained < rounds,
+        'wall_s': time.perf_counter() - start,
+        'cpu_s': time.process_time() - cpu_start,
+        'threads': s['threads'],
+    }
+
+
+# --- Search ---
+
+def _rungs(min_rounds, max_rounds, eta):
+    rungs = [min_rounds]
+    while rungs[-1] * eta <= max_rounds:
+        rungs.append(rungs[-1] * eta)
+    return rungs
+
+
+def search(file_path, model='lgbm', n_trials=27, budget=3600, n_parallel=None, max_threads=None,
+           min_rounds=MIN_ROUNDS, max_rounds=MAX_ROUNDS, eta=ETA, valid_share=VALID_SHARE,
+           numerical_features=None, categorical_features=None, target=TARGET_VARIABLE, seed=42, out_dir='.'):
+    """
+    Successive-halving search of the `model` ('xgb' or 'lgbm') hyperparameters.
+
+    Parameters
+    ----------
+    n_trials : int
+        Configurations started at the first rung (trial 0 is the fixed setting of the script).
+    budget : float
+        Wall-clock seconds for the whole search.
+    n_parallel, max_threads : int
+        Trials run at the same time, and the total number of threads they share
+        (default: all cores, split over min(4, cores) trials).
+
+    Returns
+    -------
+    dict
+        Best parameters, number of boosting rounds and validation RMSE (also
+        written to tuning_<model>_best.json).
+    """
+    deadline = time.time() + budget
+    max_threads = max_threads or os.cpu_count()
+    n_parallel = max(1, min(n_parallel or min(4, max_threads), max_threads, n_trials))
+    rng = np.random.default_rng(seed)
+    configs = [dict(BASELINES[model])] + [sample_params(model, rng) for _ in range(n_trials - 1)]
+
+    state = {
+        'model': model,
+        'file_path': file_path,
+        'numerical': list(numerical_features or NUMERICAL_FEATURES),
+        'categorical': list(categorical_features or CATEGORICAL_FEATURES),
+        'target': target,
+        'valid_share': valid_share,
+    }
+    if model == 'xgb':
+        # Every XGBoost worker holds its own copy of the binned data
+        available = _available_memory()
+        if available is not None:
+            fits = max(1, int(available * XGB_MEMORY_SHARE // _xgb_worker_bytes(state)))
+            if fits < n_parallel:
+                print(f"[tuning] n_parallel capped at {fits}: one binned copy per worker")
+                n_parallel = fits
+    state['threads'] = max(1, max_threads // n_parallel)
+    tmp_dir = None
+    if model == 'lgbm':
+        tmp_dir = tempfile.mkdtemp(prefix='tuning_')
+        # In a child process: the trial workers are forked from this one, and
+        # forking after OpenMP has started its threads can deadlock them
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            state['train_path'], state['valid_path'] = pool.submit(_save_lgb_bins, state, tmp_dir,
+                                                                   max_threads).result()
+
+    log = []
+    boosters = {}
+    results = {}
+    alive = list(range(len(configs)))
+    try:
+        with ProcessPoolExecutor(max_workers=n_parallel, initializer=_init_worker, initargs=(state,)) as pool:
+            for rung, rounds in enumerate(_rungs(min_rounds, max_rounds, eta)):
+                queue = [t for t in alive if not (t in results and results[t]['stopped'])]
+                running = {}
+                while queue or running:
+                    while queue and len(running) < n_parallel and time.time() < deadline:
+                        t = queue.pop(0)
+                        running[pool.submit(_train_trial, t, configs[t], rounds, boosters.get(t), deadline)] = t
+                    if not running:
+                        break
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        del running[future]
+                        result = future.result()
+                        t = result.pop('trial')
+                        boosters[t] = result.pop('booster')
+                        if t in results and results[t]['valid_rmse'] < result['valid_rmse']:
+                            # The continued rounds did not improve on the earlier best
+                            result.update(best_iteration=results[t]['best_iteration'],
+                                          valid_rmse=results[t]['valid_rmse'])
+                        results[t] = result
+                        log.append(dict({'trial': t, 'rung': rung, 'rung_rounds': rounds}, **result,
+                                        **{f'param_{k}': v for k, v in configs[t].items()}))
+                        print(f"[tuning] trial {t:3d} rung {rung} rounds {result['rounds']:5d} "
+                              f"rmse {result['valid_rmse']:.5f} ({result['wall_s']:.1f} s)")
+                if time.time() >= deadline:
+                    print("[tuning] wall-clock budget used up")
+                    break
+                # Keep the best 1/eta of the trials that reached this rung
+                scored = sorted((results[t]['valid_rmse'], t) for t in alive if t in results)
+                alive = [t for _, t in scored[:max(1, len(scored) // eta)]]
+                boosters = {t: boosters[t] for t in alive}
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if not results:
+        raise ValueError("Error: the budget ran out before any trial finished.")
+    best_trial = min(results, key=lambda t: results[t]['valid_rmse'])
+    best = {
+        'model': model,
+        'trial': best_trial,
+        'params': configs[best_trial],
+        'n_rounds': results[best_trial]['best_iteration'] + 1,
+        'valid_rmse': results[best_trial]['valid_rmse'],
+        'baseline_rmse': results[0]['valid_rmse'] if 0 in results else None,
+        'valid_share': valid_share,
+        'n_trials': len(configs),
+        'wall_s': budget - max(0.0, deadline - time.time()),
+    }
+    best_path = os.path.join(out_dir, f'tuning_{model}_best.json')
+    with open(best_path, 'w') as f:
+        json.dump(best, f, indent=2)
+    pd.DataFrame(log).to_csv(os.path.join(out_dir, f'tuning_{model}_trials.csv'), index=False)
+    print(f"Best configuration saved as '{best_path}'")
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Budgeted hyperparameter search (successive halving).")
+    parser.add_argument('--file', default='data0327.dta')
+    parser.add_argument('--model', choices=['xgb', 'lgbm'], default='lgbm')
+    parser.add_argument('--trials', type=int, default=27)
+    parser.add_argument('--budget', type=float, default=3600, help="Wall-clock seconds")
+    parser.add_argument('--parallel', type=int, default=None, help="Trials run at the same time")
+    parser.add_argument('--threads', type=int, default=None, help="Total threads shared by the trials")
+    parser.add_argument('--min-rounds', type=int, default=MIN_ROUNDS)
+    parser.add_argument('--max-rounds', type=int, default=MAX_ROUNDS)
+    parser.add_argument('--eta', type=int, default=ETA)
+    parser.add_argument('--valid-share', type=float, default=VALID_SHARE)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args(argv)
+    best = search(args.file, model=args.model, n_trials=args.trials, budget=args.budget, n_parallel=args.parallel,
+                  max_threads=args.threads, min_rounds=args.min_rounds, max_rounds=args.max_rounds, eta=args.eta,
+                  valid_share=args.valid_share, seed=args.seed)
+    print(json.dumps(best, indent=2))
+
+
+if __name__ == '__main__':
+    main()